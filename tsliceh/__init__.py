@@ -1,8 +1,11 @@
 import datetime
+import json
 import os
 import uuid
 
-from sqlalchemy import Column, JSON, Boolean, String, DateTime, TypeDecorator, CHAR
+from sqlalchemy import Column, JSON, Boolean, String, DateTime, TypeDecorator, CHAR, Float, Integer, BigInteger, Index, \
+    inspect, text, event
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy.orm import scoped_session, sessionmaker, declarative_base
 from sqlalchemy.dialects.postgresql import UUID
 
@@ -58,30 +61,158 @@ class Session3DSlicer(SQLAlchemyBase):
     url_path = Column(String(1024), nullable=True)
     service_address = Column(String(1024), nullable=True)
     container_name = Column(String(128), nullable=True)
+    host = Column(String(128), nullable=True)  # Docker host of the container, if several (see "DockerHosts")
     restart = Column(Boolean, nullable=False, default=False)
     gpu = Column(Boolean, nullable=False, default=False)
-    info = Column(JSON)
+    shared = Column(Boolean, nullable=False, default=False)
+    shared_interactive = Column(Boolean, nullable=False, default=False)
+    cpu_pct = Column(Float, nullable=True)  # Last CPU sample
+    cpu_limit = Column(Float, nullable=True)  # Reduced CPU allowance while idle, None -> full (see "tsliceh.activity")
+    scratch_bytes = Column(BigInteger, nullable=True)  # Last sample of the space used in its scratch filesystem
+    state = Column(String(16), nullable=False, default="routed")  # Launch phase (see "tsliceh.launch_jobs")
+    reservation_id = Column(GUID, nullable=True)  # Launched ahead of a reservation (see "tsliceh.reservations")
+    held = Column(Boolean, nullable=False, default=False)  # Reserved and not claimed by its user yet
+    info = Column(JSON)  # Free form. Not used by the hub since sharing flags and activity have their own columns
 
 
-def create_local_orm(conn_str):
+class Reservation(SQLAlchemyBase):
+    __tablename__ = "reservations"
+    id = Column(GUID, nullable=False, primary_key=True, default=uuid.uuid4)
+    name = Column(String(128), nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    created_by = Column(String(64), nullable=True)
+    starts_at = Column(DateTime, nullable=False)
+    ends_at = Column(DateTime, nullable=False)
+    users = Column(JSON)  # User ids, including the members of "group" when it was last resolved
+    group = Column(String(128), nullable=True)  # LDAP group
+    profile = Column(String(32), nullable=False, default="default")  # Resource profile of the sessions
+    state = Column(String(16), nullable=False, default="scheduled")  # "scheduled" -> "launched" -> "released"
+
+
+class ActivitySample(SQLAlchemyBase):
+    """ One activity sample of a session per sweep of the sessions checker (see "tsliceh.activity") """
+    __tablename__ = "session_activity"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    session_uuid = Column(GUID, nullable=False)
+    user = Column(String(64), nullable=False)
+    t = Column(DateTime, nullable=False, index=True)
+    cpu = Column(Float, nullable=True)
+    rx = Column(Float, nullable=True)
+    tx = Column(Float, nullable=True)
+    proxy = Column(Float, nullable=True)
+    active = Column(Boolean, nullable=False)
+    __table_args__ = (Index("ix_session_activity_session_t", "session_uuid", "t"),)
+
+
+_async_drivers = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg", "postgres": "postgresql+asyncpg"}
+
+
+def engine_options(url, echo=False, pool_size=10, max_overflow=20, pool_recycle=1800, sqlite_busy_timeout_ms=30000):
+    """
+    Options of "create_engine" for a database URL: pooled connections checked before use (pre-ping) for server
+    databases, WAL journal and busy timeout for SQLite
+
+    :return: (create_engine keyword arguments, SQLite PRAGMAs to execute in each new connection)
+    """
+    if url.get_backend_name() == "sqlite":
+        connect_args = {"timeout": sqlite_busy_timeout_ms / 1000}
+        if url.get_driver_name() in ("", "pysqlite"):
+            connect_args["check_same_thread"] = False
+        pragmas = ["PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL",
+                   f"PRAGMA busy_timeout={int(sqlite_busy_timeout_ms)}"]
+        return dict(echo=echo, connect_args=connect_args), pragmas
+    else:
+        return dict(echo=echo, pool_size=pool_size, max_overflow=max_overflow, pool_recycle=pool_recycle,
+                    pool_pre_ping=True), []
+
+
+def _execute_pragmas(engine_, pragmas):
+    if pragmas:
+        @event.listens_for(engine_, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+    return engine_
+
+
+def create_local_orm(conn_str, **options):
+    """ Synchronous engine (scripts, migrations). See "engine_options" for "options" """
     from sqlalchemy import create_engine
-    return create_engine(conn_str, echo=True, connect_args={"check_same_thread": False})
+    url = make_url(conn_str)
+    kwargs, pragmas = engine_options(url, **options)
+    return _execute_pragmas(create_engine(url, **kwargs), pragmas)
+
+
+def create_async_orm(conn_str, **options):
+    """
+    Asynchronous engine used by the hub. The driver is chosen from the URL ("sqlite://" -> aiosqlite,
+    "postgresql://" -> asyncpg) unless it is explicit. See "engine_options" for "options"
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+    url = make_url(conn_str)
+    if url.get_driver_name() in ("", "pysqlite", "psycopg2") and url.get_backend_name() in _async_drivers:
+        url = url.set(drivername=_async_drivers[url.get_backend_name()])
+    kwargs, pragmas = engine_options(url, **options)
+    engine_ = create_async_engine(url, **kwargs)
+    _execute_pragmas(engine_.sync_engine, pragmas)
+    return engine_
 
 
 def create_session_factory(engine_):
-    """ Return a session factory for a given engine """
+    """ Return a session factory for a given engine (AsyncSession factory for an asynchronous engine) """
+    from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+    if isinstance(engine_, AsyncEngine):
+        return sessionmaker(engine_, class_=AsyncSession, autoflush=False, expire_on_commit=False)
     return scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine_))
 
 
-def create_tables(engine_, declarative_base_=SQLAlchemyBase):
-    """ Create tables of a declarative base using an engine """
+def create_tables(connectable, declarative_base_=SQLAlchemyBase):
+    """
+    Create tables of a declarative base, and the columns added to existing tables.
+    With an asynchronous engine: "await conn.run_sync(create_tables)"
+
+    :param connectable: Engine or Connection
+    """
+    if isinstance(connectable, Engine):
+        with connectable.begin() as conn:
+            return create_tables(conn, declarative_base_)
     tables = declarative_base_.metadata.tables
-    connection = engine_.connect()
-    table_existence = [engine_.dialect.has_table(connection, tables[t].name) for t in tables]
-    connection.close()
+    table_existence = [connectable.dialect.has_table(connectable, tables[t].name) for t in tables]
     if False in table_existence:
-        declarative_base_.metadata.bind = engine_
-        declarative_base_.metadata.create_all()
+        declarative_base_.metadata.create_all(bind=connectable)
+    return add_missing_columns(connectable, declarative_base_)
+
+
+def add_missing_columns(conn, declarative_base_=SQLAlchemyBase):
+    """
+    Minimal schema migration: "ALTER TABLE ... ADD COLUMN" for the columns of the model missing in the database.
+    Sharing flags of databases created before they had their own columns are copied from the "info" JSON column
+
+    :param conn: Connection (in a transaction)
+    :return: list of "table.column" added
+    """
+    added = []
+    inspector = inspect(conn)
+    for table in declarative_base_.metadata.sorted_tables:
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for c in table.columns:
+            if c.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {c.name} {c.type.compile(dialect=conn.dialect)}"
+            if c.default is not None and c.default.is_scalar:
+                default = c.default.arg
+                ddl += f" NOT NULL DEFAULT {str(default).lower() if isinstance(default, bool) else repr(default)}"
+            conn.execute(text(ddl))
+            added.append(f"{table.name}.{c.name}")
+    if "sessions.shared" in added:
+        for uuid_, info in conn.execute(text("SELECT uuid, info FROM sessions")).fetchall():
+            info = json.loads(info) if isinstance(info, str) else info
+            if info and info.get("shared"):
+                conn.execute(text("UPDATE sessions SET shared = :s, shared_interactive = :i WHERE uuid = :u"),
+                             dict(s=True, i=bool(info.get("shared_interactive")), u=uuid_))
+    return added
 
 
 def get_ldap_address(mode, openldap_name, net_id):
@@ -0,0 +1,248 @@
+"""
+Activity of the 3DSlicer sessions, smoothed over time and combining several signals, to decide when a session is idle.
+
+A single CPU sample is a poor indicator: a user reading a rendered scene uses almost no CPU, while a forgotten
+background loop keeps it busy forever. For each session a fixed-size history of samples is kept, plus an EWMA
+(exponentially weighted moving average, time constant ACTIVITY_EWMA_TAU_SEC) of each signal:
+  cpu: CPU percentage of the container
+  rx: bytes/s received by the container (VNC input events: mouse, keyboard; uploads)
+  tx: bytes/s sent by the container (VNC frame updates)
+  proxy: bytes/s of HTTP traffic of the session through the reverse proxy (from its access log, PROXY_ACCESS_LOG)
+Thresholds of the signals in ACTIVITY_THRESHOLDS (default "cpu=10,rx=500,tx=20000,proxy=1000"). A signal which
+cannot be measured (e.g. no access log) is ignored.
+
+Policies (ACTIVITY_POLICY):
+  "cpu": active if the CPU EWMA is above its threshold (the original criterion, smoothed)
+  "any": active if any signal EWMA is above its threshold
+  "weighted": active if sum(weight * EWMA / threshold) >= 1, with the weights in ACTIVITY_WEIGHTS
+              (default "cpu=1,rx=2,tx=1,proxy=1")
+Regardless of the policy, a session with no user traffic (rx, proxy) for ACTIVITY_MAX_UNATTENDED_SEC is idle, even
+if its CPU is busy.
+
+Idle sessions step down their CPU allowance (CPU_THROTTLE_STEPS, default "300=1,600=0.5": 1 CPU after 5 minutes idle,
+0.5 after 10), so a node packs more active users without expiring anyone. The full allowance is given back as soon as
+the session is active again (or its user logs in). The lowest step should stay above the CPU threshold, or CPU alone
+cannot tell that the session is active again.
+"""
+import array
+import math
+import re
+import time
+
+SIGNALS = ("cpu", "rx", "tx", "proxy")
+USER_SIGNALS = ("rx", "proxy")  # Signals produced by a user in front of the session
+POLICIES = ("cpu", "any", "weighted")
+DEFAULT_THRESHOLDS = dict(cpu=10.0, rx=500.0, tx=20000.0, proxy=1000.0)
+DEFAULT_WEIGHTS = dict(cpu=1.0, rx=2.0, tx=1.0, proxy=1.0)
+
+
+def parse_signal_values(spec, defaults):
+    """
+    :param spec: "signal=value,..." e.g. "cpu=1,rx=2"
+    :param defaults: dictionary signal -> value, for the signals not in "spec"
+    :return: dictionary signal -> value, for all the signals
+    """
+    values = dict(defaults)
+    for item in (spec or "").split(","):
+        if "=" in item:
+            k, v = item.split("=", 1)
+            if k.strip() not in SIGNALS:
+                raise ValueError(f"Unknown activity signal '{k.strip()}', expected one of {SIGNALS}")
+            values[k.strip()] = float(v)
+    return values
+
+
+def parse_cpu_steps(spec):
+    """
+    :param spec: "idle seconds=CPUs,..." e.g. "300=1,600=0.5"
+    :return: list of (idle seconds, CPUs), by idle seconds
+    """
+    steps = []
+    for item in (spec or "").split(","):
+        if "=" in item:
+            k, v = item.split("=", 1)
+            steps.append((float(k), float(v)))
+    return sorted(steps)
+
+
+def cpu_allowance(idle_sec, steps):
+    """
+    :param idle_sec: time the session has been idle
+    :param steps: list of (idle seconds, CPUs), see "parse_cpu_steps"
+    :return: CPUs of the last step reached, None (full allowance) if none
+    """
+    cpus = None
+    for after, c in steps:
+        if idle_sec >= after:
+            cpus = c
+    return cpus
+
+
+class RingBuffer:
+    """ Fixed-size buffer of floats (the oldest value is overwritten), NaN for missing values """
+    def __init__(self, size):
+        self._values = array.array("d", [math.nan] * size)
+        self._next = 0
+        self._count = 0
+
+    def append(self, value):
+        self._values[self._next] = math.nan if value is None else value
+        self._next = (self._next + 1) % len(self._values)
+        self._count = min(self._count + 1, len(self._values))
+
+    def values(self):
+        """ Values from the oldest to the newest, None for missing values """
+        start = (self._next - self._count) % len(self._values)
+        _ = [self._values[(start + i) % len(self._values)] for i in range(self._count)]
+        return [None if math.isnan(v) else v for v in _]
+
+    def __len__(self):
+        return self._count
+
+
+class SessionActivity:
+    """ History and smoothed values of the activity signals of a session """
+    def __init__(self, history_size, tau_sec):
+        self.tau_sec = tau_sec
+        self.times = RingBuffer(history_size)
+        self.samples = {s: RingBuffer(history_size) for s in SIGNALS}
+        self.ewma = {s: None for s in SIGNALS}
+        self.last_sample = {s: None for s in SIGNALS}
+        self.last_user_activity = None  # Time of the last sample with user traffic
+        self.active = True
+        self._t = None
+        self._counters = dict()  # signal -> last cumulative counter (rx, tx, proxy), to compute rates
+
+    def _rate(self, signal, counter, dt):
+        """ Rate of a cumulative counter since the previous sample (counters restart with the container) """
+        previous = self._counters.get(signal)
+        self._counters[signal] = counter
+        if counter is None or previous is None or dt is None or dt <= 0 or counter < previous:
+            return None
+        return (counter - previous) / dt
+
+    def add(self, t, cpu=None, net=None, proxy_bytes=None):
+        """
+        Add a sample
+
+        :param t: time of the sample (seconds)
+        :param cpu: CPU percentage (None or < 0 if not available)
+        :param net: cumulative (rx_bytes, tx_bytes) of the container, or None
+        :param proxy_bytes: cumulative bytes of the session through the reverse proxy, or None
+        :return: the sample, dictionary signal -> value (None if not available)
+        """
+        dt = t - self._t if self._t is not None else None
+        rx, tx = net if net else (None, None)
+        sample = dict(cpu=cpu if cpu is not None and cpu >= 0 else None,
+                      rx=self._rate("rx", rx, dt),
+                      tx=self._rate("tx", tx, dt),
+                      proxy=self._rate("proxy", proxy_bytes, dt))
+        alpha = 1 - math.exp(-dt / self.tau_sec) if dt and self.tau_sec > 0 else 1.0
+        for s, v in sample.items():
+            self.samples[s].append(v)
+            if v is not None:
+                self.ewma[s] = v if self.ewma[s] is None else self.ewma[s] + alpha * (v - self.ewma[s])
+        self.times.append(t)
+        self._t = t
+        self.last_sample = sample
+        return sample
+
+    def history(self):
+        """ List of samples, from the oldest to the newest: dictionaries with "t" and each signal """
+        _ = dict(t=self.times.values())
+        _.update({s: b.values() for s, b in self.samples.items()})
+        return [{k: v[i] for k, v in _.items()} for i in range(len(self.times))]
+
+
+class ActivityTracker:
+    """ Activity of all the sessions, and the policy deciding whether a session is active """
+    def __init__(self, policy="weighted", thresholds=None, weights=None, history_size=60, tau_sec=180.0,
+                 max_unattended_sec=0):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown activity policy '{policy}', expected one of {POLICIES}")
+        self.policy = policy
+        self.thresholds = thresholds or dict(DEFAULT_THRESHOLDS)
+        self.weights = weights or dict(DEFAULT_WEIGHTS)
+        self.history_size = history_size
+        self.tau_sec = tau_sec
+        self.max_unattended_sec = max_unattended_sec
+        self._sessions = dict()  # session uuid (str) -> SessionActivity
+
+    def get(self, session_id):
+        return self._sessions.get(str(session_id))
+
+    def forget(self, session_id):
+        self._sessions.pop(str(session_id), None)
+
+    def clear(self):
+        self._sessions.clear()
+
+    def sample(self, session_id, cpu=None, net=None, proxy_bytes=None, t=None):
+        """
+        Add a sample to the history of a session and decide if it is active
+
+        :return: the SessionActivity of the session
+        """
+        t = time.time() if t is None else t
+        a = self._sessions.get(str(session_id))
+        if a is None:
+            a = self._sessions[str(session_id)] = SessionActivity(self.history_size, self.tau_sec)
+            a.last_user_activity = t
+        sample = a.add(t, cpu=cpu, net=net, proxy_bytes=proxy_bytes)
+        if any(sample[s] is not None and sample[s] > self.thresholds[s] for s in USER_SIGNALS):
+            a.last_user_activity = t
+        a.active = self.is_active(a, t)
+        return a
+
+    def score(self, a):
+        """ sum(weight * EWMA / threshold) over the available signals """
+        return sum(self.weights[s] * a.ewma[s] / self.thresholds[s] for s in SIGNALS if a.ewma[s] is not None)
+
+    def is_active(self, a, t):
+        measured_user_signals = any(a.ewma[s] is not None for s in USER_SIGNALS)
+        if self.max_unattended_sec > 0 and measured_user_signals and \
+                t - a.last_user_activity > self.max_unattended_sec:
+            return False
+        if self.policy == "cpu":
+            return a.ewma["cpu"] is not None and a.ewma["cpu"] > self.thresholds["cpu"]
+        elif self.policy == "any":
+            return any(a.ewma[s] is not None and a.ewma[s] > self.thresholds[s] for s in SIGNALS)
+        else:  # "weighted"
+            return self.score(a) >= 1
+
+
+_access_log_re = re.compile(r'"\S+ /([0-9a-fA-F-]{32,36})(?:-ws|/)\S* [^"]*" \d{3} (\d+)')
+
+
+class ProxyAccessLog:
+    """
+    Bytes sent to each session through the reverse proxy, read incrementally from its access log ("custom" format
+    in the generated nginx.conf). Websocket connections are logged when they close, so long VNC connections are
+    seen through the container network counters instead
+    """
+    def __init__(self, path):
+        self.path = path
+        self._offset = 0
+        self._bytes = dict()  # session uuid (hex, no dashes) -> cumulative bytes
+
+    def read(self):
+        """ Read the new lines of the log, return dictionary session uuid -> cumulative bytes """
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(0, 2)
+                if f.tell() < self._offset:  # Rotated
+                    self._offset = 0
+                f.seek(self._offset)
+                data = f.read()
+                self._offset = f.tell()
+        except OSError:
+            return self._bytes
+        for line in data.decode("utf-8", errors="replace").splitlines():
+            m = _access_log_re.search(line)
+            if m:
+                k = m.group(1).replace("-", "").lower()
+                self._bytes[k] = self._bytes.get(k, 0) + int(m.group(2))
+        return self._bytes
+
+    def session_bytes(self, session_id):
+        return self._bytes.get(str(session_id).replace("-", "").lower(), 0)
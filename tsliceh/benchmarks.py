@@ -0,0 +1,428 @@
+"""
+Synthetic load tests and benchmarks of the hub, to be run before each upgrade and compared with previous results.
+
+The FastAPI "app" of "tsliceh.main" is driven in-process (ASGI calls in a single event loop, like the single
+uvicorn worker in production) with the "Simulated" container orchestrator and a stand-in LDAP accepting every user.
+
+Scenarios:
+  - login_storm: N users log in within M seconds
+  - steady_state: sessions with idle churn (some go idle and expire, new users log in), several checker sweeps
+  - mass_expiry: all the sessions become idle at the same time and are expired in a single sweep
+  - scaling: for each number of sessions (e.g. 10 ... 2000), checker sweep time, NGINX configuration generation and
+             reload time, login latency and hub RSS
+
+Usage:
+  python -m tsliceh.benchmarks --users 200 --seconds 10 --sizes 10,100,500,1000,2000 --out benchmark_results.json
+
+Results are written as JSON, one entry per scenario (latencies in seconds, memory in bytes).
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+from sqlalchemy import delete, func, select
+
+
+def configure_environment(work_dir, max_sessions=1000, inactivity_sec=900, sim=None):
+    """
+    Environment for "tsliceh.main" (read when the module is imported): simulated orchestrator, scratch DB and
+    NGINX configuration in "work_dir"
+
+    :param sim: dictionary of SIM_* variables for the Simulated orchestrator
+    """
+    os.environ["CONTAINER_ORCHESTRATOR"] = "simulated"
+    os.environ["MODE"] = "local"
+    os.environ["MAX_SESSIONS"] = str(max_sessions)
+    os.environ["INACTIVITY_TIME_SEC"] = str(inactivity_sec)
+    os.environ["DB_CONNECTION_STRING"] = f"sqlite:///{work_dir}/sessions.sqlite"
+    os.environ["NGINX_CONFIG_FILE"] = f"{work_dir}/nginx.conf"
+    for k, v in (sim or {}).items():
+        os.environ[k] = str(v)
+
+
+def load_hub(ldap_latency=0.0):
+    """
+    Import the hub and replace the LDAP check by a stand-in accepting every user
+
+    :return: "tsliceh.main" module
+    """
+    from tsliceh import main
+    from tsliceh.orchestrators import Simulated
+    from tsliceh.tracing import traced
+    if not isinstance(main.container_orchestrator, Simulated):
+        raise RuntimeError("tsliceh.main was already imported with a non simulated container orchestrator")
+
+    @traced("check_credentials")
+    async def standin_check_credentials(user, password):
+        if ldap_latency > 0:
+            await asyncio.sleep(ldap_latency)
+        return True
+
+    main.check_credentials = standin_check_credentials
+    return main
+
+
+def run_sync(coro):
+    """ Run a coroutine in the event loop of the benchmark (helpers called between scenario steps) """
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def reset_hub(main):
+    """ Remove all the sessions, reservations, containers, launches and waiting users """
+    co = main.container_orchestrator
+    run_sync(main.launch_jobs.cancel_all())
+
+    async def delete_sessions():
+        async with main.orm_session_maker() as sess:
+            await sess.execute(delete(main.Session3DSlicer))
+            await sess.execute(delete(main.Reservation))
+            await sess.commit()
+
+    run_sync(delete_sessions())
+    for name in co.get_tdscontainers(main.CONTAINER_NAME_PREFIX):
+        co.remove_container(name, True)
+    for t in list(main.waiting_room._waiting.values()):
+        main.waiting_room.leave(t.id)
+    main.activity_tracker.clear()
+
+
+async def asgi_request(app, method, path, form=None):
+    """
+    Minimal in-process HTTP client for an ASGI application
+
+    :return: (status code, headers dictionary, body)
+    """
+    path, _, query = path.partition("?")
+    body = urlencode(form).encode("utf-8") if form else b""
+    headers = [(b"host", b"localhost")]
+    if form:
+        headers += [(b"content-type", b"application/x-www-form-urlencoded"),
+                    (b"content-length", str(len(body)).encode("ascii"))]
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method,
+             "scheme": "http", "path": path, "raw_path": path.encode("utf-8"),
+             "query_string": query.encode("utf-8"), "root_path": "", "headers": headers,
+             "client": ("127.0.0.1", 50000), "server": ("localhost", 80)}
+    request_sent = False
+    response = dict(status=None, headers={}, body=b"")
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {k.decode("latin-1"): v.decode("latin-1") for k, v in message.get("headers", [])}
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    await app(scope, receive, send)
+    return response["status"], response["headers"], response["body"]
+
+
+def percentiles(values, ps=(50, 95, 99)):
+    """ Nearest-rank percentiles """
+    if not values:
+        return {f"p{p}": None for p in ps}
+    v = sorted(values)
+    return {f"p{p}": v[min(len(v), max(1, math.ceil(p / 100 * len(v)))) - 1] for p in ps}
+
+
+def rss_bytes():
+    """ Current resident set size of this process """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Peak RSS (kilobytes in Linux, bytes in macOS)
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r if sys.platform == "darwin" else r * 1024
+
+
+async def login(main, user, wait_usable=True):
+    """
+    :param wait_usable: wait for the launch of the session (in background) to finish, as the user would
+    :return: (latency, outcome), outcome in "session", "queued", "error: ..."
+    """
+    t0 = time.perf_counter()
+    try:
+        status, headers, _ = await asgi_request(main.app, "POST", "/login", dict(username=user, password="test"))
+    except Exception as e:
+        return time.perf_counter() - t0, f"error: {e!r}"
+    latency = time.perf_counter() - t0
+    location = headers.get("location", "")
+    if status == 302 and location.startswith("/sessions/"):
+        if wait_usable:
+            job = await main.launch_jobs.wait(location.rsplit("/", 1)[1])
+            latency = time.perf_counter() - t0
+            if job and job.error:
+                return latency, f"error: launch {job.error}"
+        return latency, "session"
+    elif status == 302 and location.startswith("/queue/"):
+        return latency, "queued"
+    return latency, f"error: HTTP {status}"
+
+
+def summarize_logins(results):
+    latencies = [lat for lat, outcome in results if not outcome.startswith("error")]
+    errors = [outcome for _, outcome in results if outcome.startswith("error")]
+    return dict(logins=len(results),
+                launched=sum(1 for _, o in results if o == "session"),
+                queued=sum(1 for _, o in results if o == "queued"),
+                errors=len(errors),
+                error_samples=sorted(set(errors))[:5],
+                login_latency=percentiles(latencies),
+                login_latency_max=max(latencies) if latencies else None)
+
+
+def populate(main, n, prefix="free_user_bench"):
+    """ Create n sessions with running (simulated) containers directly, without going through the login """
+    co = main.container_orchestrator
+
+    async def create_sessions():
+        async with main.orm_session_maker() as sess:
+            for i in range(n):
+                user = f"{prefix}{i}"
+                s = main.Session3DSlicer()
+                s.user = user
+                s.last_activity = datetime.datetime.now()
+                sess.add(s)
+                await sess.flush()
+                s.url_path = f"/{s.uuid}/"
+                s.container_name = main.CONTAINER_NAME_PREFIX + co.get_valid_name(user)
+                c = await co.start_container(s.container_name, main.tdslicer_image_name, main.tdslicer_image_tag,
+                                             main.network_id, {}, s.uuid)
+                s.service_address = f"{c.ip}:6901"
+                s.cpu_pct = main.ACTIVITY_THRESHOLD + 1
+            await sess.commit()
+
+    run_sync(create_sessions())
+
+
+def make_idle(main, older_than_sec):
+    """ All the sessions become idle, with the last activity "older_than_sec" ago """
+    run_sync(make_sessions_idle(main, older_than_sec))
+
+
+async def make_sessions_idle(main, older_than_sec, limit=None):
+    """ Sessions (the first "limit" ones, or all) become idle, with the last activity "older_than_sec" ago """
+    co = main.container_orchestrator
+    async with main.orm_session_maker() as sess:
+        sessions = (await sess.execute(select(main.Session3DSlicer).limit(limit))).scalars().all()
+        for s in sessions:
+            s.last_activity = datetime.datetime.now() - datetime.timedelta(seconds=older_than_sec)
+            if co.get_container_status(s.container_name):
+                co.set_container_activity(s.container_name, 0)
+            main.activity_tracker.forget(s.uuid)  # No activity in the smoothed history either
+        await sess.commit()
+    return len(sessions)
+
+
+def count_sessions(main):
+    async def count():
+        async with main.orm_session_maker() as sess:
+            return (await sess.execute(select(func.count()).select_from(main.Session3DSlicer))).scalar()
+
+    return run_sync(count())
+
+
+async def timed_sweep(main):
+    t0 = time.perf_counter()
+    await main.runner.sweep(main.orm_session_maker)
+    return time.perf_counter() - t0
+
+
+async def timed_refresh_nginx(main):
+    """ :return: (total time, reload time) of a NGINX configuration refresh """
+    co = main.container_orchestrator
+    reload_time = 0
+    execute = co.execute_cmd_in_nginx_container
+
+    def timed_execute(*args, **kwargs):
+        nonlocal reload_time
+        t0 = time.perf_counter()
+        try:
+            return execute(*args, **kwargs)
+        finally:
+            reload_time += time.perf_counter() - t0
+
+    co.execute_cmd_in_nginx_container = timed_execute
+    try:
+        async with main.orm_session_maker() as sess:
+            t0 = time.perf_counter()
+            await main.refresh_nginx(co, sess, main.nginx_config_path, main.domain, main.tdslicerhub_adress)
+            total = time.perf_counter() - t0
+    finally:
+        co.execute_cmd_in_nginx_container = execute
+    return total, reload_time
+
+
+# SCENARIOS
+
+def scenario_login_storm(main, users, seconds):
+    """ "users" distinct users log in, evenly spread during "seconds" """
+    reset_hub(main)
+
+    async def storm():
+        async def delayed_login(i):
+            await asyncio.sleep(seconds * i / max(users, 1))
+            return await login(main, f"free_user_storm{i}")
+        return await asyncio.gather(*[delayed_login(i) for i in range(users)])
+
+    t0 = time.perf_counter()
+    results = asyncio.get_event_loop().run_until_complete(storm())
+    _ = summarize_logins(results)
+    _.update(users=users, seconds=seconds, wall_time=time.perf_counter() - t0, rss_bytes=rss_bytes())
+    return _
+
+
+def scenario_steady_state(main, sessions, rounds, churn):
+    """
+    "sessions" active sessions; in each round a fraction "churn" of them goes idle and expires, and the same number
+    of new users log in
+    """
+    reset_hub(main)
+    populate(main, sessions)
+    loop = asyncio.get_event_loop()
+    sweep_times = []
+    login_results = []
+    expired = 0
+    new_user = 0
+    for r in range(rounds):
+        victims = run_sync(make_sessions_idle(main, main.allowed_inactivity_time_in_seconds + 1,
+                                              limit=int(sessions * churn)))
+        before = count_sessions(main)
+        sweep_times.append(loop.run_until_complete(timed_sweep(main)))
+        expired += before - count_sessions(main)
+        for _ in range(victims):
+            login_results.append(loop.run_until_complete(login(main, f"free_user_churn{new_user}")))
+            new_user += 1
+    _ = summarize_logins(login_results)
+    _.update(sessions=sessions, rounds=rounds, churn=churn, expired=expired,
+             sweep_time=percentiles(sweep_times), sweep_time_max=max(sweep_times) if sweep_times else None,
+             rss_bytes=rss_bytes())
+    return _
+
+
+def scenario_mass_expiry(main, sessions):
+    """ All the sessions expire in the same sweep """
+    reset_hub(main)
+    populate(main, sessions)
+    make_idle(main, main.allowed_inactivity_time_in_seconds + 1)
+    t = asyncio.get_event_loop().run_until_complete(timed_sweep(main))
+    return dict(sessions=sessions, remaining=count_sessions(main), sweep_time=t,
+                nginx_reloads=main.container_orchestrator.nginx_reloads, rss_bytes=rss_bytes())
+
+
+def scenario_scaling(main, sizes, logins_per_size=5):
+    """ Costs of the periodic and per-login work as the number of sessions grows """
+    loop = asyncio.get_event_loop()
+    _ = []
+    for n in sizes:
+        reset_hub(main)
+        populate(main, n)
+        sweep_time = loop.run_until_complete(timed_sweep(main))
+        refresh_total, reload_time = loop.run_until_complete(timed_refresh_nginx(main))
+        results = [loop.run_until_complete(login(main, f"free_user_scale{n}_{i}")) for i in range(logins_per_size)]
+        entry = dict(sessions=n,
+                     sweep_time=sweep_time,
+                     nginx_generation_time=refresh_total - reload_time,
+                     nginx_reload_time=reload_time,
+                     rss_bytes=rss_bytes())
+        entry.update(summarize_logins(results))
+        _.append(entry)
+    return _
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    work_dir = tempfile.mkdtemp(prefix="tsliceh-bench-")
+    configure_environment(work_dir, max_sessions=args.max_sessions,
+                          sim=dict(SIM_START_LATENCY_SEC=args.start_latency, SIM_API_LATENCY_SEC=args.api_latency,
+                                   SIM_FAILURE_RATE=args.failure_rate, SIM_ACTIVITY="busy", SIM_SEED=args.seed))
+    results = dict(meta=dict(date=datetime.datetime.now().isoformat(), git_revision=git_revision(),
+                             python=platform.python_version(), platform=platform.platform(),
+                             parameters=vars(args)),
+                   scenarios=dict())
+    scenarios = args.scenarios.split(",")
+    sizes = [int(n) for n in args.sizes.split(",")]
+    # The hub prints every generated nginx.conf, which would flood the output
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if not args.verbose else sys.stdout):
+        main = load_hub(ldap_latency=args.ldap_latency)
+        # (importing the hub runs, and closes, its own event loop)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        results["meta"]["rss_bytes_start"] = rss_bytes()
+        for scenario in scenarios:
+            t0 = time.perf_counter()
+            if scenario == "login_storm":
+                r = scenario_login_storm(main, args.users, args.seconds)
+            elif scenario == "steady_state":
+                r = scenario_steady_state(main, args.sessions, args.rounds, args.churn)
+            elif scenario == "mass_expiry":
+                r = scenario_mass_expiry(main, args.sessions)
+            elif scenario == "scaling":
+                r = scenario_scaling(main, sizes)
+            else:
+                raise ValueError(f"Unknown scenario {scenario}")
+            results["scenarios"][scenario] = r
+            print(f"{scenario}: {time.perf_counter() - t0:.1f} s", file=sys.stderr)
+        reset_hub(main)
+    loop.close()
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load tests and benchmarks of 3DSlicer Hub (simulated containers)")
+    parser.add_argument("--scenarios", default="login_storm,steady_state,mass_expiry,scaling",
+                        help="Comma separated list of scenarios")
+    parser.add_argument("--users", type=int, default=200, help="login_storm: number of users")
+    parser.add_argument("--seconds", type=float, default=10, help="login_storm: users log in within this time")
+    parser.add_argument("--sessions", type=int, default=200, help="steady_state, mass_expiry: number of sessions")
+    parser.add_argument("--rounds", type=int, default=5, help="steady_state: number of checker sweeps")
+    parser.add_argument("--churn", type=float, default=0.1, help="steady_state: fraction of sessions expiring per round")
+    parser.add_argument("--sizes", default="10,100,500,1000,2000", help="scaling: numbers of sessions")
+    parser.add_argument("--max-sessions", type=int, default=100000, help="MAX_SESSIONS of the hub")
+    parser.add_argument("--start-latency", type=float, default=0, help="SIM_START_LATENCY_SEC")
+    parser.add_argument("--api-latency", type=float, default=0, help="SIM_API_LATENCY_SEC")
+    parser.add_argument("--failure-rate", type=float, default=0, help="SIM_FAILURE_RATE")
+    parser.add_argument("--ldap-latency", type=float, default=0, help="Latency of the stand-in LDAP check")
+    parser.add_argument("--seed", type=int, default=0, help="SIM_SEED")
+    parser.add_argument("--out", default="benchmark_results.json", help="JSON output file ('-' for stdout)")
+    parser.add_argument("--verbose", action="store_true", help="Do not hide the output of the hub")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run(args)
+    if args.out == "-":
+        json.dump(results, sys.stdout, indent=2, default=str)
+    else:
+        with open(args.out, "wt") as f:
+            json.dump(results, f, indent=2, default=str)
+        print(f"Results written to {args.out}", file=sys.stderr)
@@ -0,0 +1,161 @@
+"""
+Node-local read-through cache of the shared datasets (course CT and MR volumes), so sessions do not load them from NFS.
+
+A dataset is an entry (directory or file) of DATASET_SOURCE_DIR (NFS). Before a session starts, the datasets listed
+in DATASETS are brought into DATASET_CACHE_DIR, a directory in a local disk (SSD) of the node running the session:
+  - hit: the dataset is cached, its last use is updated (modification time of the entry)
+  - miss: it is copied from the source, into a temporary name renamed at the end (readers never see half a copy)
+Then the least recently used datasets are evicted until the cache is below DATASET_CACHE_MAX_GB (the datasets of the
+session being started are never evicted). The cache is mounted read-only in the sessions, at DATASET_MOUNT.
+
+In Kubernetes the cache is filled in the node of the session pod by an init container (the hub image running
+"python -m tsliceh.dataset_cache"). Its report (hits, misses, evictions, size) is written as the termination message
+of the init container, read by the hub and exported per node in /metrics. With Docker, the hub and the sessions
+share the host and the hub fills the cache itself (the directories must be mounted in the hub at the same paths).
+
+Usage:
+  python -m tsliceh.dataset_cache --source /mnt/opendx28/datasets --cache /mnt/ssd/datasets --max-gb 100 \
+    --datasets anatomy,neuro --report /dev/termination-log
+"""
+import argparse
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+import socket
+import sys
+
+from fastapi.logger import logger
+
+
+def valid_dataset_name(name):
+    return bool(name) and os.path.basename(name) == name and not name.startswith(".")
+
+
+def entry_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files
+               if not os.path.islink(os.path.join(d, f)))
+
+
+def remove_entry(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+class DatasetCache:
+    def __init__(self, source_dir, cache_dir, max_bytes, node=None):
+        """
+        :param node: name of the node of the cache, for the statistics (NODE_NAME, or the host name)
+        """
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.node = node or os.getenv("NODE_NAME") or socket.gethostname()
+
+    @contextlib.contextmanager
+    def _lock(self):
+        """ Sessions starting at the same time in a node fill the cache one after the other """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, ".lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def entries(self):
+        """ :return: cached datasets, as (name, size in bytes, last use), least recently used first """
+        _ = []
+        for name in os.listdir(self.cache_dir):
+            if valid_dataset_name(name):
+                path = os.path.join(self.cache_dir, name)
+                _.append((name, entry_size(path), os.path.getmtime(path)))
+        return sorted(_, key=lambda e: e[2])
+
+    def _fetch(self, name):
+        """ Copy a dataset from the source into the cache """
+        src = os.path.join(self.source_dir, name)
+        tmp = os.path.join(self.cache_dir, f".tmp-{name}-{os.getpid()}")
+        if os.path.lexists(tmp):
+            remove_entry(tmp)
+        if os.path.isdir(src):
+            shutil.copytree(src, tmp)
+        else:
+            shutil.copy2(src, tmp)
+        os.rename(tmp, os.path.join(self.cache_dir, name))
+
+    def evict(self, keep=()):
+        """
+        Remove the least recently used datasets until the cache is below its size cap
+
+        :param keep: names of datasets not to be evicted
+        :return: (names of the evicted datasets, bytes in the cache)
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for name, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if name in keep:
+                continue
+            remove_entry(os.path.join(self.cache_dir, name))
+            total -= size
+            evicted.append(name)
+        return evicted, total
+
+    def fill(self, datasets):
+        """
+        Bring datasets into the cache
+
+        :param datasets: names of entries of the source directory
+        :return: report, dict with "node", "hits", "misses", "missing" (not in the source), "evicted" (lists of
+                 names), "bytes" and "max_bytes"
+        """
+        hits, misses, missing = [], [], []
+        with self._lock():
+            for name in datasets:
+                if not valid_dataset_name(name) or not os.path.lexists(os.path.join(self.source_dir, name)):
+                    logger.warning(f"dataset cache - {name} not found in {self.source_dir}")
+                    missing.append(name)
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                if os.path.lexists(path):
+                    hits.append(name)
+                else:
+                    self._fetch(name)
+                    misses.append(name)
+                os.utime(path)  # Last use
+            evicted, total = self.evict(keep=set(datasets))
+        return dict(node=self.node, hits=hits, misses=misses, missing=missing, evicted=evicted, bytes=total,
+                    max_bytes=self.max_bytes)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fill the node-local cache of shared datasets")
+    parser.add_argument("--source", required=True, help="Directory with the datasets (NFS)")
+    parser.add_argument("--cache", required=True, help="Cache directory, in a local disk")
+    parser.add_argument("--max-gb", type=float, required=True, help="Size cap of the cache")
+    parser.add_argument("--datasets", default="", help="Comma separated names of the datasets to cache")
+    parser.add_argument("--report", help="Also write the report (JSON) to this file, e.g. /dev/termination-log")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    cache = DatasetCache(args.source, args.cache, int(args.max_gb * 1024 ** 3))
+    report = cache.fill([d.strip() for d in args.datasets.split(",") if d.strip()])
+    _ = json.dumps(report)
+    print(_)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(_)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
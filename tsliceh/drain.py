@@ -0,0 +1,51 @@
+"""
+Draining a node for maintenance: the sessions running in it are relaunched in other nodes, without waiting for them to
+expire and without losing the data of their users.
+
+Each session keeps its uuid, its volumes (in NFS, the same in every node) and its route. The replacement is started
+in another node (the node is excluded with node affinity, and cordoned so new sessions do not go there either), and
+the route switches to it only when it passes the readiness probe; until then the user keeps working in the old
+instance. In Kubernetes this is a rolling update of the Deployment of the session, whose Service moves to the new pod
+once it is Ready.
+
+Sessions are relaunched concurrently (at most DRAIN_PARALLELISM at a time). The job keeps the progress of each one:
+  "pending" -> "relaunching" -> "ready" (new instance usable) -> "routed" (route switched, old instance gone)
+or "error" (the old instance is left running).
+"""
+import time
+import uuid
+
+PHASES = ("pending", "relaunching", "ready", "routed")
+
+
+class DrainJob:
+    def __init__(self, node, sessions, admin=None):
+        """
+        :param sessions: list of (session uuid, user) of the sessions in the node
+        """
+        self.id = uuid.uuid4().hex[:12]
+        self.node = node
+        self.admin = admin
+        self.created_at = time.time()
+        self.finished_at = None
+        self.sessions = {str(session_id): dict(user=user, phase="pending", error=None, elapsed_sec=None)
+                         for session_id, user in sessions}
+        self.task = None
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    def progress(self, session_id, phase, error=None):
+        _ = self.sessions[str(session_id)]
+        _["phase"] = phase
+        _["error"] = error
+        _["elapsed_sec"] = round(time.time() - self.created_at, 1)
+
+    def status(self):
+        counts = dict()
+        for _ in self.sessions.values():
+            counts[_["phase"]] = counts.get(_["phase"], 0) + 1
+        return dict(job=self.id, node=self.node, admin=self.admin, done=self.done, created=self.created_at,
+                    elapsed_sec=round((self.finished_at or time.time()) - self.created_at, 1), counts=counts,
+                    sessions=[dict(session=k, **v) for k, v in self.sessions.items()])
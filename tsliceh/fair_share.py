@@ -0,0 +1,103 @@
+"""
+Fair-share of the CPU between the sessions of a node, so a few users running heavy jobs (segmentation, registration)
+do not make the interactive sessions of everybody else laggy.
+
+CPU shares (weights) only matter when the CPU is contended: then each container gets CPU in proportion to its weight.
+In each sweep of the sessions checker, every session is classified from its smoothed activity signals (see
+"tsliceh.activity"):
+  - "interactive": recent user input (rx or proxy above their thresholds), someone is working in front of it
+  - "batch": CPU above FAIR_SHARE_BATCH_CPU (percent of one CPU) without user input, e.g. a long computation
+  - "normal": the rest
+Its weight is the weight of its class (FAIR_SHARE_WEIGHTS, default "interactive=4,normal=1,batch=0.5") times the
+quota of its user (USER_CPU_QUOTAS, "user=quota,...", default 1), relative to a default container. The orchestrator
+maps it to its mechanism: Docker CPU shares (1024 * weight), or the CPU request of the Kubernetes pod (resized in
+place, CPU shares are proportional to the requests). Weights are only changed when the class of a session changes.
+"""
+CLASSES = ("interactive", "normal", "batch")
+DEFAULT_CLASS_WEIGHTS = dict(interactive=4.0, normal=1.0, batch=0.5)
+
+
+def parse_class_weights(spec, defaults=DEFAULT_CLASS_WEIGHTS):
+    """
+    :param spec: "class=weight,..." e.g. "interactive=4,batch=0.5"
+    :return: dictionary class -> weight, for all the classes
+    """
+    weights = dict(defaults)
+    for item in (spec or "").split(","):
+        if "=" in item:
+            k, v = item.split("=", 1)
+            if k.strip() not in CLASSES:
+                raise ValueError(f"Unknown session class '{k.strip()}', expected one of {CLASSES}")
+            weights[k.strip()] = float(v)
+    return weights
+
+
+def parse_user_quotas(spec):
+    """
+    :param spec: "user=quota,..." e.g. "teacher=2,guest=0.5"
+    :return: dictionary user -> quota
+    """
+    quotas = dict()
+    for item in (spec or "").split(","):
+        if "=" in item:
+            k, v = item.split("=", 1)
+            quotas[k.strip()] = float(v)
+    return quotas
+
+
+def session_class(ewma, thresholds, batch_cpu):
+    """
+    :param ewma: smoothed signals of a session (signal -> value, None if not measured)
+    :param thresholds: activity thresholds of the signals
+    :param batch_cpu: CPU (percent of one CPU) above which a session without user input is "batch"
+    :return: "interactive", "normal" or "batch"
+    """
+    if any((ewma.get(signal) or 0) > thresholds[signal] for signal in ("rx", "proxy")):
+        return "interactive"
+    if (ewma.get("cpu") or 0) > batch_cpu:
+        return "batch"
+    return "normal"
+
+
+class FairShare:
+    def __init__(self, thresholds, class_weights=None, quotas=None, batch_cpu=150.0):
+        self.thresholds = thresholds
+        self.class_weights = dict(class_weights or DEFAULT_CLASS_WEIGHTS)
+        self.quotas = dict(quotas or {})
+        self.batch_cpu = batch_cpu
+        self._classes = dict()  # session id -> class, at the last sweep
+        self._applied = dict()  # session id -> weight set in its container
+
+    def weight(self, user, cls):
+        return round(self.class_weights[cls] * self.quotas.get(user, 1.0), 3)
+
+    def decide(self, session_id, user, ewma):
+        """
+        Class and weight of a session, from its smoothed signals
+
+        :return: (class, weight, True if the weight of its container has to be changed)
+        """
+        cls = session_class(ewma, self.thresholds, self.batch_cpu)
+        self._classes[str(session_id)] = cls
+        w = self.weight(user, cls)
+        return cls, w, self._applied.get(str(session_id)) != w
+
+    def applied(self, session_id, weight):
+        self._applied[str(session_id)] = weight
+
+    def reset(self, session_id):
+        """ The weight of the container was changed by other means (e.g. CPU allowance of an idle session) """
+        self._applied.pop(str(session_id), None)
+
+    def forget(self, session_id):
+        self._classes.pop(str(session_id), None)
+        self._applied.pop(str(session_id), None)
+
+    def status(self, session_id):
+        """ :return: dict with the class and the weight of a session, None if not decided yet """
+        cls = self._classes.get(str(session_id))
+        return dict(cls=cls, weight=self._applied.get(str(session_id))) if cls else None
+
+    def counts(self):
+        """ :return: number of sessions of each class """
+        return {cls: sum(1 for _ in self._classes.values() if _ == cls) for cls in CLASSES}
@@ -1,6 +1,7 @@
 import os
 
 from tsliceh.orchestrators import IContainerOrchestrator
+from tsliceh.tracing import traced
 
 
 def container_exists(name_id):
@@ -29,13 +30,14 @@ def calculate_cpu_percent(d):
     return cpu_percent
 
 
+@traced()
 def get_container_internal_address(co: IContainerOrchestrator, name_id, network_id):
-    ip = co.get_container_ip(name_id, network_id)
+    ip = co.get_service_address(name_id) or co.get_container_ip(name_id, network_id)
     print(f"NAME: {name_id}")
     if name_id and name_id == os.getenv("TDSLICERHUB_NAME", ""):
         port = co.get_container_port(name_id)
     else:
-        port = 6901
+        port = co.get_session_port(name_id)
     return f"{ip}:{port}"
 
 
@@ -0,0 +1,314 @@
+"""
+Local cache ("informer") of the 3DSlicer containers, so the orchestrator read methods (status, IP, list) do not query
+Docker or the Kubernetes API server on every call.
+
+An Informer is fed by a source in a background thread: one "list" to fill the cache, then a continuous "watch"
+(Kubernetes watch API through kubectl, Docker event stream) applying the changes. When the watch ends (disconnection,
+error, or the periodic resync timeout) the source is listed again and the watch restarted.
+
+Read methods use the cache only when it is synced and holds the object; otherwise (not synced, a name outside the scope
+of the source, an object not seen yet, e.g. just created) they fall back to a live query. Orchestrator methods changing
+a container "forget" it, so it is queried live until the watch reports its new state.
+"""
+import json
+import subprocess
+import threading
+import time
+from urllib.parse import quote
+
+from fastapi.logger import logger
+
+
+class CachedContainer:
+    def __init__(self, name, status, ips=None, resource_name=None):
+        self.name = name  # Container name (Docker), "app-user" label (Kubernetes pods, Deployments)
+        self.status = status
+        self.ips = ips or dict()  # network (id and name) -> IP; key None for the pod IP
+        self.resource_name = resource_name  # Pod or Deployment name (Kubernetes)
+
+    def ip(self, network_id=None):
+        return self.ips.get(network_id, self.ips.get(None, ""))
+
+
+class Informer:
+    """
+    Cache of the objects of a source, kept up to date by a background thread
+
+    :param name: name of the informer (metrics, logs)
+    :param source: object with "list()" -> dict name -> CachedContainer, "watch()" -> iterator of (event type, name,
+                   CachedContainer or None for deletions) and "close()" to interrupt a watch
+    :param resync_period: seconds after which the watch is restarted with a new list, even without errors
+    """
+    def __init__(self, name, source, resync_period=300.0, retry_delay=2.0):
+        self.name = name
+        self.source = source
+        self.resync_period = resync_period
+        self.retry_delay = retry_delay
+        self.synced = False
+        self.last_sync = None  # time.time() of the last list
+        self.last_event = None  # time.time() of the last list or watch event
+        self.on_resync = []  # Callbacks (reason) -> None: "initial", "periodic", "disconnect", "error"
+        self.on_event = []  # Callbacks (event type) -> None
+        self._objects = dict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"informer-{self.name}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.source.close()
+
+    def wait_for_sync(self, timeout=None):
+        t0 = time.monotonic()
+        while not self.synced and (timeout is None or time.monotonic() - t0 < timeout):
+            time.sleep(0.05)
+        return self.synced
+
+    def staleness(self):
+        """ Seconds since the cache was last confirmed (list or event); inf if it never synced """
+        return time.time() - self.last_event if self.last_event else float("inf")
+
+    def lookup(self, name):
+        """
+        :return: CachedContainer, or None if the caller has to query the orchestrator
+        """
+        if not self.synced:
+            return None
+        with self._lock:
+            return self._objects.get(name)
+
+    def forget(self, name):
+        with self._lock:
+            self._objects.pop(name, None)
+
+    def names(self, prefix=""):
+        with self._lock:
+            return [n for n in self._objects if n.startswith(prefix)]
+
+    def __len__(self):
+        return len(self._objects)
+
+    def _notify(self, callbacks, arg):
+        for cb in callbacks:
+            try:
+                cb(arg)
+            except Exception as e:
+                logger.error(f"informer {self.name}: callback failed: {e}")
+
+    def _run(self):
+        reason = "initial"
+        while not self._stop.is_set():
+            try:
+                objects = self.source.list()
+                with self._lock:
+                    self._objects = objects
+                self.last_sync = self.last_event = time.time()
+                self.synced = True
+                self._notify(self.on_resync, reason)
+                timer = threading.Timer(self.resync_period, self.source.close)
+                timer.daemon = True
+                timer.start()
+                t0 = time.monotonic()
+                try:
+                    for type_, name, obj in self.source.watch():
+                        with self._lock:
+                            if obj is None:
+                                self._objects.pop(name, None)
+                            else:
+                                self._objects[name] = obj
+                        self.last_event = time.time()
+                        self._notify(self.on_event, type_)
+                finally:
+                    timer.cancel()
+                reason = "periodic" if time.monotonic() - t0 >= self.resync_period else "disconnect"
+            except Exception as e:
+                logger.error(f"informer {self.name}: {e!r}, listing again in {self.retry_delay} s")
+                reason = "error"
+                self.synced = False
+            if reason != "periodic":
+                self._stop.wait(self.retry_delay)
+
+
+class KubernetesSource:
+    """
+    Pods or Deployments with a label, through the Kubernetes API (kubectl get --raw), keyed by their "app-user" label.
+    During a rolling update (e.g. a drain) two pods have the same label: the Running one is kept (see "_apply")
+
+    :param kind: "pods" or "deployments"
+    """
+    def __init__(self, kind, label_selector, namespace=None, timeout_sec=300):
+        self.kind = kind
+        self.label_selector = label_selector
+        self.namespace = namespace or kubernetes_namespace()
+        self.timeout_sec = timeout_sec
+        self._resource_version = None
+        self._proc = None
+        self._cached = dict()  # "app-user" -> CachedContainer of the pod in the cache of the informer
+
+    def _path(self, watch=False):
+        api = "/api/v1" if self.kind == "pods" else "/apis/apps/v1"
+        _ = f"{api}/namespaces/{self.namespace}/{self.kind}?labelSelector={quote(self.label_selector)}"
+        if watch:
+            _ += f"&watch=1&allowWatchBookmarks=true&resourceVersion={self._resource_version}" \
+                 f"&timeoutSeconds={int(self.timeout_sec)}"
+        return _
+
+    def _parse(self, item):
+        if self.kind == "pods":
+            return pod_to_container(item)
+        else:
+            return deployment_to_container(item)
+
+    def list(self):
+        proc = subprocess.run(["kubectl", "get", "--raw", self._path()], capture_output=True, text=True,
+                              timeout=self.timeout_sec)
+        if proc.returncode != 0:
+            raise RuntimeError(f"kubectl list {self.kind}: {proc.stderr.strip()}")
+        _ = json.loads(proc.stdout)
+        self._resource_version = _["metadata"]["resourceVersion"]
+        objects = dict()
+        for item in _.get("items", []):
+            c = self._parse(item)
+            if c and (c.name not in objects or c.status == "Running"):
+                objects[c.name] = c
+        self._cached = dict(objects)
+        return objects
+
+    def watch(self):
+        self._proc = subprocess.Popen(["kubectl", "get", "--raw", self._path(watch=True)],
+                                      stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        try:
+            for line in self._proc.stdout:
+                if not line.strip():
+                    continue
+                ev = json.loads(line)
+                obj = ev["object"]
+                if ev["type"] == "ERROR":  # E.g. 410 Gone: resource version too old
+                    raise RuntimeError(f"watch {self.kind}: {obj.get('message')}")
+                self._resource_version = obj["metadata"].get("resourceVersion", self._resource_version)
+                if ev["type"] == "BOOKMARK":
+                    continue
+                c = self._parse(obj)
+                _ = self._apply(ev["type"], c) if c is not None else None
+                if _ is not None:
+                    yield _
+        finally:
+            self.close()
+
+    def _apply(self, type_, c):
+        """
+        Event for the informer, or None to ignore it: the events of the old pod of a rolling update (Terminating, then
+        DELETED) must not replace or remove the new pod, Running, with the same "app-user"
+        """
+        if self.kind == "pods":
+            cached = self._cached.get(c.name)
+            if cached is not None and cached.resource_name != c.resource_name and \
+                    (type_ == "DELETED" or (cached.status == "Running" and c.status != "Running")):
+                return None
+            if type_ == "DELETED":
+                self._cached.pop(c.name, None)
+            else:
+                self._cached[c.name] = c
+        return type_, c.name, None if type_ == "DELETED" else c
+
+    def close(self):
+        if self._proc and self._proc.poll() is None:
+            self._proc.terminate()
+
+
+def kubernetes_namespace():
+    try:
+        with open("/var/run/secrets/kubernetes.io/serviceaccount/namespace") as f:
+            return f.read().strip()
+    except OSError:
+        proc = subprocess.run(["kubectl", "config", "view", "--minify", "-o", "jsonpath={..namespace}"],
+                              capture_output=True, text=True)
+        return proc.stdout.strip() or "default"
+
+
+def pod_to_container(pod):
+    """ Pod JSON -> CachedContainer, with the STATUS shown by "kubectl get pods" """
+    name = pod["metadata"].get("labels", {}).get("app-user")
+    if not name:
+        return None
+    status = pod.get("status", {})
+    phase = status.get("phase", "Unknown")
+    if pod["metadata"].get("deletionTimestamp"):
+        phase = "Terminating"
+    else:
+        for cs in status.get("containerStatuses", []):
+            state = cs.get("state", {})
+            reason = state.get("waiting", {}).get("reason") or state.get("terminated", {}).get("reason")
+            if reason:
+                phase = reason
+                break
+    ips = {None: status["podIP"]} if phase == "Running" and status.get("podIP") else {}
+    return CachedContainer(name, phase, ips, resource_name=pod["metadata"]["name"])
+
+
+def deployment_to_container(deployment):
+    name = deployment["spec"].get("selector", {}).get("matchLabels", {}).get("app-user")
+    if not name:
+        return None
+    ready = deployment.get("status", {}).get("readyReplicas", 0)
+    return CachedContainer(name, "Ready" if ready else "NotReady", resource_name=deployment["metadata"]["name"])
+
+
+class DockerSource:
+    """ Containers whose name starts with a prefix (plus some other names), through the Docker events stream """
+    def __init__(self, prefix, names=()):
+        self.prefix = prefix
+        self.names = set(names)
+        self._events = None
+        self._since = None
+
+    def in_scope(self, name):
+        return name.startswith(self.prefix) or name in self.names
+
+    @staticmethod
+    def _client():
+        import docker
+        from tsliceh.orchestrators import docker_timeout_sec  # Not at the top: "orchestrators" imports this module
+        return docker.from_env(timeout=docker_timeout_sec())  # The events stream has no timeout (see "watch")
+
+    @staticmethod
+    def to_container(c):
+        ips = dict()
+        for net_name, net in c.attrs.get("NetworkSettings", {}).get("Networks", {}).items():
+            ips[net_name] = ips[net.get("NetworkID")] = net.get("IPAddress", "")
+        return CachedContainer(c.name, c.status, ips, resource_name=c.id)
+
+    def list(self):
+        dc = self._client()
+        self._since = int(time.time())
+        return {c.name: self.to_container(c) for c in dc.containers.list(all=True) if self.in_scope(c.name)}
+
+    def watch(self):
+        import docker
+        dc = self._client()
+        self._events = dc.events(decode=True, filters={"type": "container"}, since=self._since)
+        try:
+            for ev in self._events:
+                self._since = ev.get("time", self._since)
+                name = ev.get("Actor", {}).get("Attributes", {}).get("name", "")
+                if not self.in_scope(name):
+                    continue
+                if ev.get("Action") == "destroy":
+                    yield "DELETED", name, None
+                    continue
+                try:
+                    yield "MODIFIED", name, self.to_container(dc.containers.get(name))
+                except docker.errors.NotFound:
+                    yield "DELETED", name, None
+        finally:
+            self.close()
+
+    def close(self):
+        if self._events is not None:
+            self._events.close()
+            self._events = None
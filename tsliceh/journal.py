@@ -0,0 +1,73 @@
+"""
+Journal of session lifecycle events, to replay real traffic offline (see "tsliceh.replay").
+
+Enabled with JOURNAL_FILE. One compact JSON object per line, rotated like the log files (JOURNAL_MAX_BYTES,
+JOURNAL_BACKUP_COUNT). Common keys:
+  t: UNIX time of the event (seconds)
+  e: event ("login", "phase", "queued", "admit", "activity", "share", "unshare", "close", "expire", "relaunch")
+  u: user
+  s: session uuid
+  d: duration of the operation (seconds)
+Event specific keys:
+  login: o (outcome: "launch", "reconnect", "queued", "failed")
+  phase: p (phase of the launch, as in the "tsliceh_login_phase_seconds" metric)
+  activity: cpu (CPU percentage)
+  share: i (interactive)
+"""
+import glob
+import json
+import logging
+import logging.handlers
+import os
+import time
+
+
+class Journal:
+    def __init__(self):
+        self._logger = None
+
+    @property
+    def enabled(self):
+        return self._logger is not None
+
+    def configure(self, path, max_bytes=50 * 1024 * 1024, backup_count=10):
+        if not path:
+            return
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._logger = logging.getLogger("tsliceh.journal")
+        self._logger.setLevel(logging.INFO)
+        self._logger.propagate = False
+        self._logger.addHandler(handler)
+
+    def record(self, event, **fields):
+        if self._logger is None:
+            return
+        _ = dict(t=round(time.time(), 3), e=event)
+        for k, v in fields.items():
+            if v is None:
+                continue
+            if isinstance(v, float):
+                v = round(v, 3)
+            elif not isinstance(v, (int, str, bool)):
+                v = str(v)
+            _[k] = v
+        self._logger.info(json.dumps(_, separators=(",", ":")))
+
+
+journal = Journal()
+
+
+def read_journal(path):
+    """
+    Read a journal, including its rotated files ("path.N" ... "path.1", "path"), in chronological order
+
+    :return: generator of event dictionaries
+    """
+    rotated = sorted(glob.glob(f"{glob.escape(path)}.[0-9]*"), key=lambda p: int(p.rsplit(".", 1)[1]), reverse=True)
+    for p in rotated + ([path] if os.path.exists(path) else []):
+        with open(p) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
@@ -0,0 +1,126 @@
+"""
+Session launches as tracked background jobs.
+
+The login creates the session record and returns at once; the launch (image check, volumes, container start,
+readiness, proxy reload) runs as an asyncio task. Its progress goes through the phases:
+  queued -> pulling -> starting -> ready -> routed
+("failed" if it raised), which the session page streams (Server-Sent Events) until the session is usable.
+"""
+import asyncio
+import time
+
+from fastapi.logger import logger
+
+from tsliceh.metrics import LAUNCHES_IN_PROGRESS
+
+PHASES = ("queued", "pulling", "starting", "ready", "routed")
+FAILED = "failed"
+
+
+def _key(session_id):
+    """ Session uuid, with or without dashes -> hex """
+    return str(session_id).replace("-", "").lower()
+
+
+class LaunchJob:
+    def __init__(self, session_id, user):
+        self.session_id = session_id
+        self.user = user
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.phase = "queued"
+        self.phases = [("queued", 0.0)]  # (phase, seconds since the start)
+        self.error = None
+        self.task = None
+
+    @property
+    def done(self):
+        return self.phase in ("routed", FAILED)
+
+    def status(self):
+        return dict(session=str(self.session_id), phase=self.phase, error=self.error, done=self.done,
+                    elapsed_sec=round((self.finished_at or time.monotonic()) - self.started_at, 1),
+                    phases=[dict(phase=p, t=round(t, 1)) for p, t in self.phases])
+
+
+class LaunchJobs:
+    def __init__(self, keep_finished_sec=600):
+        """
+        :param keep_finished_sec: finished jobs are kept this time, so their outcome can still be shown
+        """
+        self.keep_finished_sec = keep_finished_sec
+        self._jobs = dict()  # session uuid (hex) -> LaunchJob
+
+    def __len__(self):
+        """ Launches in progress """
+        return sum(1 for j in self._jobs.values() if not j.done)
+
+    def get(self, session_id):
+        return self._jobs.get(_key(session_id))
+
+    def start(self, session_id, user, coro):
+        """
+        Run a launch in background
+
+        :param coro: coroutine doing the launch, reporting its progress with "progress"
+        :return: the LaunchJob
+        """
+        job = LaunchJob(session_id, user)
+        self._jobs[_key(session_id)] = job
+        job.task = asyncio.get_running_loop().create_task(coro)
+        job.task.add_done_callback(lambda task: self._finished(job, task))
+        LAUNCHES_IN_PROGRESS.set(len(self))
+        return job
+
+    def progress(self, session_id, phase):
+        """ A launch reached a phase. Ignored for sessions without a job (e.g. relaunch at startup) """
+        job = self.get(session_id)
+        if job and not job.done:
+            job.phase = phase
+            job.phases.append((phase, time.monotonic() - job.started_at))
+            if job.done:
+                job.finished_at = time.monotonic()
+                LAUNCHES_IN_PROGRESS.set(len(self))
+
+    def fail(self, session_id, error):
+        job = self.get(session_id)
+        if job and not job.done:
+            job.error = error
+            self.progress(session_id, FAILED)
+
+    def _finished(self, job, task):
+        if not job.done:  # Cancelled, or ended without reaching "routed"
+            job.error = job.error or ("cancelled" if task.cancelled() else repr(task.exception()) if
+                                      task.exception() else "launch ended before the session was routed")
+            self.progress(job.session_id, FAILED)
+            logger.info(f"launch of {job.user}: {job.error}")
+        LAUNCHES_IN_PROGRESS.set(len(self))
+
+    async def wait(self, session_id):
+        """ Wait until the launch of a session finishes; return its job (None if there is no job) """
+        job = self.get(session_id)
+        if job and job.task:
+            await asyncio.wait({job.task})
+        return job
+
+    async def cancel(self, session_id):
+        """ Cancel the launch of a session (closed before it finished) and wait for it to stop """
+        job = self.get(session_id)
+        if job and job.task and not job.task.done():
+            job.task.cancel()
+            await asyncio.wait({job.task})
+
+    async def join(self):
+        """ Wait for all the launches in progress """
+        await asyncio.gather(*[self.wait(j.session_id) for j in list(self._jobs.values())])
+
+    async def cancel_all(self):
+        await asyncio.gather(*[self.cancel(j.session_id) for j in list(self._jobs.values())])
+        self._jobs.clear()
+        LAUNCHES_IN_PROGRESS.set(0)
+
+    def expire_finished(self):
+        now = time.monotonic()
+        for k, j in list(self._jobs.items()):
+            if j.done and now - j.finished_at > self.keep_finished_sec:
+                del self._jobs[k]
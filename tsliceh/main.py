@@ -11,28 +11,54 @@
 - https://docker-py.readthedocs.io/en/stable/
 """
 import asyncio
+import contextlib
 import datetime
+import json
 import os
 import re
 import sys
+import time
 
 from dotenv import load_dotenv
 
-from fastapi import FastAPI, Request, Depends
+from fastapi import FastAPI, Request, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.security import OAuth2PasswordRequestForm
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.security import OAuth2PasswordRequestForm, HTTPBasic, HTTPBasicCredentials
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy.orm.attributes import flag_modified
-from starlette.responses import RedirectResponse, HTMLResponse
+from starlette.responses import RedirectResponse, HTMLResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 import ldap3
-from ldap3.core.exceptions import LDAPException
-from tsliceh import create_session_factory, create_local_orm, Session3DSlicer, create_tables, get_ldap_address, \
-    get_domain_name
-from tsliceh.orchestrators import create_docker_network, IContainerOrchestrator, container_orchestrator_factory
-from tsliceh.volumes import create_all_volumes, volume_dict
+from ldap3.core.exceptions import LDAPException, LDAPCommunicationError, LDAPResponseTimeoutError
+from sqlalchemy import select, delete, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from tsliceh import create_session_factory, create_async_orm, Session3DSlicer, ActivitySample, Reservation, \
+    create_tables, get_ldap_address, get_domain_name
+from tsliceh.orchestrators import create_docker_network, IContainerOrchestrator, container_orchestrator_factory, \
+    guard_orchestrator
+from tsliceh.volumes import create_all_volumes, volume_dict, shared_cache_version, shared_cache_populate_script, \
+    shared_cache_environment, SHARED_CACHE_MOUNT
+from tsliceh.dataset_cache import DatasetCache
 from tsliceh.helpers import get_container_internal_address
+from tsliceh.waiting_room import WaitingRoom
+from tsliceh.launch_jobs import LaunchJobs, PHASES
+from tsliceh.drain import DrainJob
+from tsliceh.provisioning import ProvisionBatch, ProvisionRequest, ldap_group_members
+from tsliceh.reservations import ReservationRequest, PROFILES, OPEN_STATES, local_naive, holds_room, reserved_room, \
+    reservation_status, session_profile, parse_profile_values
+from tsliceh.metrics import instrument_orchestrator, instrument_engine, instrument_informer, LOGIN_SECONDS, \
+    LOGIN_PHASE_SECONDS, CHECKER_SWEEP_SECONDS, SESSIONS, SESSIONS_EXPIRED, TIME_TO_RUNNING, TIME_TO_USABLE, \
+    READINESS_TIMEOUTS, SHARED_CACHE_POPULATE_SECONDS, SHARED_CACHE_POPULATIONS, SESSIONS_CPU_THROTTLED, \
+    FAIR_SHARE_SESSIONS, record_dataset_cache, instrument_breaker
+from tsliceh.fair_share import FairShare, parse_class_weights, parse_user_quotas
+from tsliceh.readiness import wait_until_usable
+from tsliceh.resilience import CircuitBreaker, ServiceUnavailable, DeadlineExceeded, backoff_delays
+from tsliceh.tracing import tracer, traced, trace_orchestrator, span_tree
+from tsliceh.journal import journal
+from tsliceh.activity import ActivityTracker, ProxyAccessLog, parse_signal_values, DEFAULT_THRESHOLDS, \
+    DEFAULT_WEIGHTS, SIGNALS, parse_cpu_steps, cpu_allowance
 from fastapi.logger import logger
 import logging.config
 import logging
@@ -55,7 +81,12 @@ templates = Jinja2Templates(directory=os.path.join(os.path.dirname(__file__), "t
 app.mount("/static", StaticFiles(directory=os.path.join(os.path.dirname(__file__), "static")), name="static")
 
 # CONFIGURATION
-db_conn_str = os.getenv("DB_CONNECTION_STRING")
+db_conn_str = os.getenv("DB_CONNECTION_STRING")  # "sqlite:///..." or "postgresql://..." (async driver added)
+db_options = dict(echo=os.getenv("DB_ECHO", default="false").lower() == "true",  # Log every SQL statement
+                  pool_size=int(os.getenv("DB_POOL_SIZE", default=10)),  # PostgreSQL
+                  max_overflow=int(os.getenv("DB_MAX_OVERFLOW", default=20)),  # PostgreSQL
+                  pool_recycle=int(os.getenv("DB_POOL_RECYCLE_SEC", default=1800)),  # PostgreSQL
+                  sqlite_busy_timeout_ms=int(os.getenv("DB_BUSY_TIMEOUT_MS", default=30000)))  # SQLite
 ACTIVITY_THRESHOLD = 10  # Percentage of CPU usage to consider a container active
 nginx_container_name = os.getenv('NGINX_NAME')  # Read from environment variable the name of the nginx container relative to this container
 nginx_config_path = os.getenv('NGINX_CONFIG_FILE')  # Read from environment the location of nginx.conf for this container
@@ -72,15 +103,105 @@ tdslicer_image_url = os.getenv("SLICER_IMAGE_DOCKERFILE", "https://github.com/Op
 base_vnc_image_name = "localhost:5000/vnc-base"
 base_vnc_image_tag = "latest"
 base_vnc_image_url = os.getenv("VNC_BASE_IMAGE_DOCKERFILE", "https://github.com/OpenDx28/docker-vnc-base.git#:src")
+admin_users = [u.strip() for u in os.getenv("ADMIN_USERS", default="").split(",") if u.strip()]
+trace_file = os.getenv("TRACE_FILE")  # Append finished traces (JSON lines) to this file
+otlp_endpoint = os.getenv("OTLP_ENDPOINT")  # OTLP/HTTP collector receiving the traces, e.g. "http://collector:4318"
+journal_file = os.getenv("JOURNAL_FILE")  # Record session lifecycle events here, for "tsliceh.replay"
+journal_max_bytes = int(os.getenv("JOURNAL_MAX_BYTES", default=50 * 1024 * 1024))
+journal_backup_count = int(os.getenv("JOURNAL_BACKUP_COUNT", default=10))
+activity_policy = os.getenv("ACTIVITY_POLICY", default="weighted")  # "cpu", "any", "weighted" (see "tsliceh.activity")
+activity_thresholds = parse_signal_values(os.getenv("ACTIVITY_THRESHOLDS"),
+                                          dict(DEFAULT_THRESHOLDS, cpu=ACTIVITY_THRESHOLD))
+activity_weights = parse_signal_values(os.getenv("ACTIVITY_WEIGHTS"), DEFAULT_WEIGHTS)
+activity_history_size = int(os.getenv("ACTIVITY_HISTORY_SIZE", default=60))  # Samples kept per session
+activity_ewma_tau_sec = float(os.getenv("ACTIVITY_EWMA_TAU_SEC", default=180))
+activity_max_unattended_sec = int(os.getenv("ACTIVITY_MAX_UNATTENDED_SEC", default=4 * 3600))  # 0 -> no limit
+proxy_access_log_path = os.getenv("PROXY_ACCESS_LOG")  # nginx access log (shared volume), for the "proxy" signal
+cpu_throttle_steps = parse_cpu_steps(os.getenv("CPU_THROTTLE_STEPS", default="300=1,600=0.5"))  # "" -> no throttling
+fair_share_enabled = os.getenv("FAIR_SHARE", default="true").lower() in ("1", "true", "yes")  # See "tsliceh.fair_share"
+fair_share_weights = parse_class_weights(os.getenv("FAIR_SHARE_WEIGHTS"))
+fair_share_batch_cpu = float(os.getenv("FAIR_SHARE_BATCH_CPU", default=150))  # Percent of one CPU
+user_cpu_quotas = parse_user_quotas(os.getenv("USER_CPU_QUOTAS"))
+activity_retention_sec = int(os.getenv("ACTIVITY_RETENTION_SEC", default=7 * 24 * 3600))  # Samples older are pruned
+reconcile_parallelism = int(os.getenv("RECONCILE_PARALLELISM", default=20))  # Orchestrator calls at startup
+informer_enabled = os.getenv("INFORMER_ENABLED", default="true").lower() in ("true", "1", "yes")  # Containers cache
+informer_resync_sec = float(os.getenv("INFORMER_RESYNC_SEC", default=300))  # Relist period of the containers cache
+readiness_probe = os.getenv("READINESS_PROBE", default="true").lower() in ("true", "1", "yes")  # Wait for KasmVNC
+readiness_deadline_sec = float(os.getenv("READINESS_DEADLINE_SEC", default=120))  # Then redirect the user anyway
+readiness_initial_delay_sec = float(os.getenv("READINESS_INITIAL_DELAY_SEC", default=0.5))  # Doubled each probe...
+readiness_max_delay_sec = float(os.getenv("READINESS_MAX_DELAY_SEC", default=5))  # ...up to this
+provision_parallelism = int(os.getenv("PROVISION_PARALLELISM", default=10))  # Launches at a time in bulk provisioning
+drain_parallelism = int(os.getenv("DRAIN_PARALLELISM", default=4))  # Relaunches at a time draining a node
+ldap_bind_dn = os.getenv("LDAP_BIND_DN")  # To read the members of LDAP groups (anonymous bind if not set)
+ldap_bind_password = os.getenv("LDAP_BIND_PASSWORD")
+reservation_lead_sec = int(os.getenv("RESERVATION_LEAD_SEC", default=600))  # Sessions launched before a reservation
+dataset_cache_dir = os.getenv("DATASET_CACHE_DIR")  # Node-local (SSD) cache of the shared datasets, not set -> no cache
+dataset_source_dir = os.getenv("DATASET_SOURCE_DIR", default="/mnt/opendx28/datasets")  # Shared datasets (NFS)
+dataset_cache_max_gb = float(os.getenv("DATASET_CACHE_MAX_GB", default=100))  # Size cap, least recently used evicted
+datasets = [d.strip() for d in os.getenv("DATASETS", default="").split(",") if d.strip()]  # Cached for every session
+dataset_mount = os.getenv("DATASET_MOUNT", default="/home/kasm-user/Datasets")  # Where the sessions see the cache
+hub_image = os.getenv("TDSLICERHUB_IMAGE", default="localhost:5000/opendx28/tslicerh:latest")  # Fills the cache (k8s)
+shared_cache_enabled = os.getenv("SHARED_CACHE", default="true").lower() in ("true", "1", "yes")  # Extensions, packages
+shared_cache_retry_sec = float(os.getenv("SHARED_CACHE_RETRY_SEC", default=300))  # After a failed population (doubled)
+shared_cache_version_ = os.getenv("SHARED_CACHE_VERSION")  # Version of the Slicer image (e.g. digest), default its tag
+slicer_extensions = [e.strip() for e in os.getenv("SLICER_EXTENSIONS", default="").split(",") if e.strip()]
+shared_apt_packages = [p.strip() for p in os.getenv("SHARED_APT_PACKAGES", default="").split(",") if p.strip()]
+slicer_executable = os.getenv("SLICER_EXECUTABLE", default="Slicer")  # In the Slicer image, to install extensions
+scratch_path = os.getenv("SCRATCH_PATH", default="/tmp")  # Memory-backed (tmpfs) scratch space of the sessions...
+scratch_size_mb = parse_profile_values(os.getenv("SCRATCH_SIZE_MB"), dict(default=2048, gpu=8192))  # ...0 -> none
+proxy_asset_cache = os.getenv("PROXY_ASSET_CACHE", default="true").lower() in ("true", "1", "yes")  # KasmVNC client
+proxy_asset_cache_path = os.getenv("PROXY_ASSET_CACHE_PATH", default="/var/cache/nginx/kasmvnc")  # In the proxy
+proxy_asset_cache_max_mb = int(os.getenv("PROXY_ASSET_CACHE_MAX_MB", default=512))
+breaker_failures = int(os.getenv("BREAKER_FAILURES", default=5))  # Consecutive failures of a service opening its breaker
+breaker_reset_sec = float(os.getenv("BREAKER_RESET_SEC", default=30))  # Then calls fail at once, for this time
+orchestrator_start_timeout_sec = float(os.getenv("ORCHESTRATOR_START_TIMEOUT_SEC", default=900))  # Start, relaunch
+ldap_timeout_sec = float(os.getenv("LDAP_TIMEOUT_SEC", default=5))  # Connect, and each LDAP operation
 # END CONFIGURATION
 
 domain = get_domain_name(os.getenv("MODE"), os.getenv('DOMAIN'), os.getenv('PORT', default=None))
 url_base = f"{proto}://{domain}"
-engine = create_local_orm(db_conn_str)
-create_tables(engine)
+tracer.configure(file_path=trace_file, otlp_endpoint=otlp_endpoint)
+journal.configure(journal_file, max_bytes=journal_max_bytes, backup_count=journal_backup_count)
+engine = instrument_engine(create_async_orm(db_conn_str, **db_options))
 orm_session_maker = create_session_factory(engine)
 
-if co_str == "docker_compose":
+
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(create_tables)
+    # Do not keep connections opened in this event loop, the server runs its own
+    await engine.dispose()
+
+
+asyncio.run(init_db())
+
+
+async def get_db():
+    """ ORM session of a request (FastAPI dependency), closed when the request finishes """
+    async with orm_session_maker() as session:
+        yield session
+
+
+async def all_sessions(sess):
+    """ :return: list of all the Session3DSlicer """
+    return (await sess.execute(select(Session3DSlicer))).scalars().all()
+
+
+async def get_session_by_user(sess, user):
+    return (await sess.execute(select(Session3DSlicer).where(Session3DSlicer.user == user))).scalars().first()
+
+
+activity_tracker = ActivityTracker(policy=activity_policy, thresholds=activity_thresholds, weights=activity_weights,
+                                   history_size=activity_history_size, tau_sec=activity_ewma_tau_sec,
+                                   max_unattended_sec=activity_max_unattended_sec)
+proxy_access_log = ProxyAccessLog(proxy_access_log_path) if proxy_access_log_path else None
+fair_share = FairShare(activity_thresholds, fair_share_weights, user_cpu_quotas, fair_share_batch_cpu) \
+    if fair_share_enabled else None
+if cpu_throttle_steps and min(c for _, c in cpu_throttle_steps) * 100 < activity_thresholds["cpu"]:
+    logger.warning(f"CPU_THROTTLE_STEPS below the CPU activity threshold ({activity_thresholds['cpu']} %): "
+                   f"throttled sessions cannot be found active by their CPU")
+
+if co_str in ("docker_compose", "docker_hosts"):  # "docker_hosts": sessions also in the hosts of DOCKER_HOSTS
     network_id = create_docker_network(network_name)
     ldap_address = get_ldap_address(os.getenv("MODE"), os.getenv("OPENLDAP_NAME"), network_id)
     CONTAINER_NAME_PREFIX = "h__tds__"
@@ -109,17 +230,54 @@ elif co_str == "kubernetes":
     handler.setFormatter(formatter)
     logger.addHandler(handler)
     logger.debug(f"===================\nLOGGER: {logger}\n=========================")
-
-container_orchestrator = container_orchestrator_factory(co_str)
+elif co_str == "simulated":
+    # In-memory containers (load tests). LDAP may be a real server or absent (see "check_credentials")
+    network_id = network_name
+    ldap_address = get_ldap_address("local", os.getenv("OPENLDAP_NAME"), network_id)
+    CONTAINER_NAME_PREFIX = "h--tds--"
+
+orchestrator_breaker = instrument_breaker(CircuitBreaker("orchestrator", breaker_failures, breaker_reset_sec))
+ldap_breaker = instrument_breaker(CircuitBreaker("ldap", breaker_failures, breaker_reset_sec))
+container_orchestrator = trace_orchestrator(instrument_orchestrator(guard_orchestrator(
+    container_orchestrator_factory(co_str), orchestrator_breaker, orchestrator_start_timeout_sec)))
+if dataset_cache_dir:
+    container_orchestrator.configure_dataset_cache(
+        DatasetCache(dataset_source_dir, dataset_cache_dir, int(dataset_cache_max_gb * 1024 ** 3)), datasets, hub_image)
 tdslicerhub_adress = get_container_internal_address(container_orchestrator, os.getenv("TDSLICERHUB_NAME"), network_id) \
     if os.getenv("MODE") != "local" else domain
 
 
-async def refresh_nginx(co: IContainerOrchestrator, sess, nginx_cfg_path, domainn, tds_address):
-    def generate_nginx_conf():
-        """ For each session, generate a section, plus the first part """
-        # "nginx.conf" prefix
-        _ = f"""
+# Static files of the KasmVNC web client (path from the root of a session): the same in every session of an image
+KASMVNC_ASSET_PATTERN = r"(?:app|core|dist|vendor)/[^?]*\.(?:js|mjs|css|map|json|woff2?|ttf|eot|png|svg|ico|gif|" \
+                        r"jpe?g|webp|oga|mp3|wasm)"
+
+
+def nginx_conf(sessions, domainn, tds_address, asset_cache_path=None, asset_cache_max_mb=512, asset_version=""):
+    """
+    Configuration of the reverse proxy: the hub at "/" and, for each session, its pages at "/{uuid}/" and its
+    websocket at "/{uuid}-ws".
+    With "asset_cache_path", the static files of the KasmVNC web client (KASMVNC_ASSET_PATTERN: bundle, fonts,
+    images) are cached by the proxy for all the sessions, and sent compressed with long-lived cache headers: only the
+    first request for each file reaches a container. Pages, the websocket and any other path go to the container
+
+    :param asset_version: version of the Slicer image (e.g. its digest), in the cache key, so sessions of a new image
+                          do not get the files of the previous one
+    :return: text of "nginx.conf"
+    """
+    asset_cache = ""
+    if asset_cache_path:
+        asset_cache = f"""
+  proxy_cache_path {asset_cache_path} levels=1:2 keys_zone=kasmvnc_assets:10m max_size={asset_cache_max_mb}m
+                   inactive=30d use_temp_path=off;
+  gzip on;
+  gzip_vary on;
+  gzip_proxied any;
+  gzip_min_length 1024;
+  gzip_types text/css text/javascript application/javascript application/json image/svg+xml font/ttf
+             application/wasm;
+"""
+    # "nginx.conf" prefix
+    _ = f"""
 user www-data;
 
 events {{
@@ -129,6 +287,7 @@ http {{
   log_format custom '$remote_addr - $remote_user [$time_local] "$request" '
                     '$status $body_bytes_sent "$http_referer" '
                     '"$http_user_agent" "$uri" "$http_x_forwarded_for" "$request_filename"';
+{asset_cache}
   server {{
     listen     80;
     server_name  {domainn};
@@ -139,11 +298,30 @@ http {{
       proxy_pass http://{tds_address};
     }}
     """
-        # Variable length section, for each location
-        if sess:
-            for s in sess.query(Session3DSlicer).all():
-                # Section doing reverse proxy magic
-                _ += f"""
+    # Variable length section, for each location (sessions still launching have no address yet)
+    for s in [s for s in sessions if s.service_address]:
+        if asset_cache_path:
+            # Same key for every session: the first one requesting a file fills the cache for all
+            _ += f"""
+    location ~ ^/{s.uuid}/(?P<kasm_asset>{KASMVNC_ASSET_PATTERN})$ {{
+        proxy_pass http://{s.service_address}/$kasm_asset$is_args$args;
+        proxy_set_header Host $host;
+        proxy_set_header Accept-Encoding "";
+        proxy_cache kasmvnc_assets;
+        proxy_cache_key "{asset_version}/$kasm_asset";
+        proxy_cache_valid 200 30d;
+        proxy_cache_lock on;
+        proxy_cache_use_stale error timeout updating;
+        proxy_ignore_headers Cache-Control Expires Set-Cookie Vary;
+        proxy_hide_header Cache-Control;
+        proxy_hide_header Expires;
+        proxy_hide_header Set-Cookie;
+        add_header Cache-Control "public, max-age=31536000, immutable";
+        add_header X-Cache-Status $upstream_cache_status;
+    }}
+"""
+        # Section doing reverse proxy magic
+        _ += f"""
   
     location /{s.uuid}/ {{
         proxy_pass http://{s.service_address}/;          
@@ -165,10 +343,19 @@ http {{
 
 
 """
-        _ += f"""
+    _ += f"""
   }}
 }}
 """
+    return _
+
+
+@traced()
+async def refresh_nginx(co: IContainerOrchestrator, sess, nginx_cfg_path, domainn, tds_address):
+    def generate_nginx_conf(sessions):
+        """ For each session, generate a section, plus the first part """
+        _ = nginx_conf(sessions, domainn, tds_address, proxy_asset_cache_path if proxy_asset_cache else None,
+                       proxy_asset_cache_max_mb, shared_cache_version(tdslicer_image_tag, shared_cache_version_))
         print(":::::::::::::::::::::::::::: CREATING NEW NGINX FILE :::::::::::::::::::::::::::::::::::::::::")
         print(_)
         if nginx_cfg_path:
@@ -178,49 +365,95 @@ http {{
     async def command_nginx_to_read_configuration(nginx_cont_name):
         """
         Given the name of the NGINX container used as reverse proxy for 3DSlicer sessions,
-        command it to reread the configuration.
+        command it to reread the configuration. Retried with backoff while the container is not running, the reload
+        fails or the orchestrator does not answer (the base containers are not restarted from here: with the
+        orchestrator degraded that makes it worse)
+
+        :return: output of the reload, None if it could not be done
         """
-        tries = 0
-        while tries < 10:
-            status = co.get_container_status(nginx_cont_name)
-            logger.debug(f"NGINX status: {status}\n----------------")
-            # TODO Needs better handling of statuses
-            if status.lower() == "running":
-                r = co.execute_cmd_in_nginx_container(nginx_cont_name, "/etc/init.d/nginx reload")
-                if r is None:
-                    co.start_base_containers()
+        delays = backoff_delays(6, initial_delay=1.0, max_delay=15.0)
+        while True:
+            try:
+                status = await asyncio.to_thread(co.get_container_status, nginx_cont_name)
+                logger.debug(f"NGINX status: {status}\n----------------")
+                if (status or "").lower() == "running":
+                    r = await asyncio.to_thread(co.execute_cmd_in_nginx_container, nginx_cont_name,
+                                                "/etc/init.d/nginx reload")
+                    if r is not None:
+                        return r
+                    reason = "reload command failed"
                 else:
-                    return r
-            else:
-                await asyncio.sleep(2)
-            tries += 1
+                    reason = f"container {status}"
+            except ServiceUnavailable as e:
+                reason = str(e)
+            delay = next(delays, None)
+            if delay is None:
+                logger.error(f"NGINX {nginx_cont_name} could not reread its configuration ({reason}), new and "
+                             f"moved sessions are not reachable until the next refresh")
+                return None
+            await asyncio.sleep(delay)
 
     # -----------------------------------------------
 
-    generate_nginx_conf()
+    generate_nginx_conf(await all_sessions(sess) if sess else [])
     await command_nginx_to_read_configuration(nginx_container_name)
 
 
 asyncio.run(refresh_nginx(container_orchestrator, None, nginx_config_path, domain, tdslicerhub_adress))
 max_sessions = int(os.getenv("MAX_SESSIONS", default=1000))  # >= 1000 -> ignore
 slicer_ini = os.getenv("SLICER_INI")
+waiting_room = WaitingRoom(ticket_timeout_sec=int(os.getenv("WAITING_ROOM_TICKET_TIMEOUT_SEC", default=120)))
+admission_lock = asyncio.Lock()
+launch_jobs = LaunchJobs()
+LAUNCHED_STATES = ("ready", "routed")  # Session3DSlicer.state of sessions with a container; the others are launching
+
+
+@contextlib.contextmanager
+def login_phase(phase, user=None):
+    """ Time a phase of a login (or session launch): metric and journal """
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        d = time.perf_counter() - t0
+        LOGIN_PHASE_SECONDS.labels(phase).observe(d)
+        journal.record("phase", u=user, p=phase, d=d)
+
+
+@traced()
+async def count_active_session_containers(sess):
+    """
+    Number of active sessions: being launched, or with a running container. From the state of the sessions and the
+    status of their containers (cached by the informers), without sampling their activity (stats, top), so it is
+    cheap enough for the capacity check of the logins, done under "admission_lock"
+    """
+    sessions = await all_sessions(sess)
+    launched = [s for s in sessions if s.state in LAUNCHED_STATES]
+    statuses = await asyncio.gather(*[asyncio.to_thread(container_orchestrator.get_container_status, s.container_name)
+                                      for s in launched])
+    return len(sessions) - len(launched) + sum(1 for status in statuses if (status or "").lower() == "running")
 
 
-def count_active_session_containers(sess):
-    # Obtain number of active sessions (with started container)
-    cont = 0
-    for s in sess.query(Session3DSlicer).all():
-        pct = container_orchestrator.get_container_activity(s.container_name)
-        if pct != -1:
-            cont += 1
-    return cont
+async def used_capacity(sess, user=None, reservation_id=None):
+    """
+    Sessions counting against MAX_SESSIONS: the active ones plus the room held by the reservations about to start or
+    in progress (see "tsliceh.reservations")
+
+    :param user: user logging in, the room held by their reservations is theirs
+    :param reservation_id: reservation launching its sessions, its room is not counted
+    """
+    n = await count_active_session_containers(sess)
+    reservations = (await sess.execute(select(Reservation).where(Reservation.state.in_(OPEN_STATES)))).scalars().all()
+    if reservations:
+        users = {s.user for s in await all_sessions(sess)}
+        n += reserved_room(reservations, users, datetime.datetime.now(), reservation_lead_sec, user, reservation_id)
+    return n
 
 
 # Welcome & login page
 @app.get("/index.html")
-async def index_page():
-    session = orm_session_maker()
-    return HTMLResponse(content=refresh_index_html(session, proto=proto, admin=False, write_to_file=False),
+async def index_page(session: AsyncSession = Depends(get_db)):
+    return HTMLResponse(content=await refresh_index_html(session, proto=proto, admin=False, write_to_file=False),
                         status_code=200)
 
 
@@ -236,113 +469,780 @@ async def welcome_and_login_page(request: Request):
     return templates.TemplateResponse("login.html", _)
 
 
+def ldap_call(operation, fn, *args, **kwargs):
+    """
+    LDAP operation (blocking, call it in a thread) through the LDAP circuit breaker
+
+    :return: result of fn. DeadlineExceeded if LDAP does not answer in LDAP_TIMEOUT_SEC, CircuitOpenError if the
+             breaker is open
+    """
+    def timed():
+        try:
+            return fn(*args, **kwargs)
+        except LDAPCommunicationError as e:
+            if "timed out" in str(e):
+                raise DeadlineExceeded(f"LDAP {operation}", ldap_timeout_sec) from e
+            raise
+        except LDAPResponseTimeoutError as e:
+            raise DeadlineExceeded(f"LDAP {operation}", ldap_timeout_sec) from e
+
+    return ldap_breaker.call(timed, failures=(ServiceUnavailable, LDAPCommunicationError))
+
+
+def ldap_bind(user, password):
+    server = ldap3.Server(ldap_address, connect_timeout=ldap_timeout_sec)
+    with ldap3.Connection(server, user=f"uid={user},{ldap_base}", password=password, read_only=True,
+                          receive_timeout=ldap_timeout_sec) as conn:
+        logger.info(conn.result["description"])  # "success" if bind is ok
+        return True
+
+
+@traced()
 async def check_credentials(user, password):
+    """ :return: True if the credentials are valid. ServiceUnavailable if LDAP is not working """
     try:
-        with ldap3.Connection(ldap_address, user=f"uid={user},{ldap_base}", password=password,
-                              read_only=True) as conn:
-            logger.info(conn.result["description"])  # "success" if bind is ok
-            return True
-    except LDAPException as e:
+        return await asyncio.to_thread(ldap_call, "bind", ldap_bind, user, password)
+    except (LDAPException, ServiceUnavailable) as e:
         print(e)
         logger.error(e.args)
         if user.startswith("free_user") and password == "test":
             return True
+        elif isinstance(e, ServiceUnavailable):
+            raise
         else:
             return False
 
 
+@app.exception_handler(ServiceUnavailable)
+async def service_unavailable(request: Request, e: ServiceUnavailable):
+    """ A service the hub depends on (orchestrator, LDAP) is not working: fail at once, with a clear error """
+    logger.error(f"{request.method} {request.url.path} - {e}")
+    headers = {"Retry-After": str(int(breaker_reset_sec))}
+    if "text/html" in request.headers.get("accept", ""):
+        return HTMLResponse(content=f"""<!DOCTYPE html>
+                                        <html>
+                                          <head>
+                                            <title>Service unavailable</title>
+                                          </head>
+                                          <body>
+                                          <p>3D Slicer Hub is not available right now ({e}). Please try again in a
+                                          minute</p>
+                                          </body>
+                                        </html>""", status_code=503, headers=headers)
+    return JSONResponse(content=dict(error=str(e)), status_code=503, headers=headers)
+
+
 async def can_open_session(user):
     return True  # TODO LDAP
 
 
+async def open_session(session, username, gpu, launch=True):
+    """
+    Create a new session for a user. Its 3DSlicer container is launched in background ("launch_session"), the
+    session page shows the progress
+
+    :param session: ORM session
+    :param launch: start the launch job (bulk provisioning starts its own, see "provision_sessions")
+    :return: the new Session3DSlicer, in state "queued"
+    """
+    s = Session3DSlicer()
+    s.user = username
+    s.last_activity = datetime.datetime.now()
+    s.gpu = gpu
+    s.state = "queued"
+    s.container_name = CONTAINER_NAME_PREFIX + container_orchestrator.get_valid_name(username)
+    session.add(s)
+    await session.flush()
+    s.url_path = f"/{s.uuid}/"
+    await session.commit()
+    if launch:
+        launch_jobs.start(s.uuid, username, launch_session(s.uuid, username))
+    return s
+
+
+async def launch_session(session_id, username, route=True):
+    """
+    Background job of a new session: launch its 3DSlicer container and register it in the reverse proxy. If the
+    launch fails the session is removed (the error stays in its job, shown by the session page)
+
+    :param route: reload the reverse proxy. If False the session is left "ready", for a caller routing several
+                  sessions with a single reload
+    :return: True if the container was launched
+    """
+    with tracer.new_trace("launch", user=username):
+        async with orm_session_maker() as sess:
+            s = await sess.get(Session3DSlicer, session_id)
+            if s is None:  # Closed before its launch started: nothing to launch nor to clean up
+                logger.error(f"launch of {username} failed: session {session_id} does not exist")
+                launch_jobs.fail(session_id, "session closed before its launch")
+                return False
+            container_name = s.container_name
+            try:
+                # Launch new 3d slicer container
+                c = await launch_3dslicer_web_container(s)
+                if c.status.lower() != "running":
+                    raise RuntimeError(f"container {c.name} is {c.status}")
+                s.cpu_pct = await asyncio.to_thread(container_orchestrator.get_container_activity, s.container_name)
+                s.state = "ready"
+                await sess.commit()
+                if route:
+                    # Update nginx.conf and reread Nginx configuration
+                    with login_phase("proxy_reload", username):
+                        await refresh_nginx(container_orchestrator, sess, nginx_config_path, domain,
+                                            tdslicerhub_adress)
+                    s.state = "routed"
+                    await sess.commit()
+                    launch_jobs.progress(session_id, "routed")
+                return True
+            except Exception as e:
+                logger.error(f"launch of {username} failed: {e!r}")
+                launch_jobs.fail(session_id, str(e))
+                await sess.rollback()
+                await stop_remove_container(container_name, True)
+                await sess.execute(delete(Session3DSlicer).where(Session3DSlicer.uuid == session_id))
+                await sess.commit()
+                journal.record("close", u=username, s=session_id)
+                capacity_freed()
+                return False
+
+
+async def provision_sessions(batch: ProvisionBatch, gpu=False, parallelism=None, reservation_id=None):
+    """
+    Bulk pre-provisioning: create the sessions of the users of a batch who do not have one, launch their containers
+    concurrently (at most "parallelism" at a time) and route all of them with a single reload of the reverse proxy.
+    The users without room (MAX_SESSIONS) are not queued, they are reported as "no_capacity"
+
+    :param batch: users, the outcome of each one is recorded in it
+    :param parallelism: launches at a time, PROVISION_PARALLELISM if None
+    :param reservation_id: the sessions are held for this reservation, until their users claim them
+    """
+    with tracer.new_trace("provision", batch=batch.id, users=len(batch.users)):
+        new = []
+        async with orm_session_maker() as sess:
+            room = max_sessions - await used_capacity(sess, reservation_id=reservation_id)
+            for user in batch.users:
+                try:
+                    s = await get_session_by_user(sess, user)
+                    if s:
+                        batch.record(user, "existing", s.uuid)
+                    elif room <= 0:
+                        batch.record(user, "no_capacity")
+                    else:
+                        s = await open_session(sess, user, gpu or bool(re.match(r".*_gpu$", user)), launch=False)
+                        if reservation_id:
+                            s.reservation_id = reservation_id
+                            s.held = True
+                            await sess.commit()
+                        batch.record(user, "launch", s.uuid)
+                        journal.record("login", u=user, s=s.uuid, o="provision")
+                        new.append((s.uuid, user))
+                        room -= 1
+                except Exception as e:
+                    logger.error(f"provisioning {batch.id} - could not create the session of {user}: {e!r}")
+                    await sess.rollback()
+                    batch.record(user, "error", error=str(e))
+        logger.info(f"provisioning {batch.id} - launching {len(new)} sessions of {len(batch.users)} users")
+
+        semaphore = asyncio.Semaphore(parallelism or provision_parallelism)
+        launched = {session_id: asyncio.get_running_loop().create_future() for session_id, _ in new}
+        routed = asyncio.Event()
+
+        async def launch(session_id, user):
+            try:
+                async with semaphore:
+                    await launch_session(session_id, user, route=False)
+            finally:
+                if not launched[session_id].done():
+                    launched[session_id].set_result(None)
+            await routed.wait()  # The job ends when the session is routed, like the launch after a login
+
+        tasks = []
+        try:
+            if new:
+                # Pull the image once, instead of every launch checking it at the same time
+                with tracer.span("image_check"):
+                    await asyncio.to_thread(container_orchestrator.create_image, tdslicer_image_name,
+                                            tdslicer_image_tag)
+            tasks = [launch_jobs.start(session_id, user, launch(session_id, user)).task for session_id, user in new]
+            await asyncio.gather(*launched.values())
+            async with orm_session_maker() as sess:
+                ids = [session_id for session_id, _ in new]
+                if ids:
+                    with tracer.span("proxy_reload"):
+                        await refresh_nginx(container_orchestrator, sess, nginx_config_path, domain,
+                                            tdslicerhub_adress)
+                    await sess.execute(update(Session3DSlicer).where(Session3DSlicer.uuid.in_(ids),
+                                                                     Session3DSlicer.state == "ready")
+                                       .values(state="routed"))
+                    await sess.commit()
+            for session_id, _ in new:
+                launch_jobs.progress(session_id, "routed")  # Ignored for the failed ones
+        finally:
+            routed.set()
+            batch.finished_at = time.time()
+        if tasks:
+            await asyncio.wait(tasks)
+        logger.info(f"provisioning {batch.id} - finished in {batch.finished_at - batch.created_at:.1f} s")
+
+
+async def release_reservation(sess, r):
+    """
+    Release a reservation (its window passed, or it was cancelled): its room, and the sessions launched for it and not
+    claimed by their users
+
+    :return: number of sessions removed
+    """
+    held = (await sess.execute(select(Session3DSlicer).where(Session3DSlicer.reservation_id == r.id,
+                                                             Session3DSlicer.held.is_(True)))).scalars().all()
+    for s in held:
+        await launch_jobs.cancel(s.uuid)
+        logger.info(f"reservations - releasing unclaimed session of {s.user}")
+        await stop_remove_container(s.container_name, True)
+        await sess.delete(s)
+        activity_tracker.forget(s.uuid)
+        if fair_share:
+            fair_share.forget(s.uuid)
+        journal.record("close", u=s.user, s=s.uuid)
+    r.state = "released"
+    await sess.commit()
+    if held:
+        await refresh_nginx(container_orchestrator, sess, nginx_config_path, domain, tdslicerhub_adress)
+    capacity_freed()
+    return len(held)
+
+
+async def admit_waiting_users():
+    """
+    Launch sessions for the users in the waiting room, in arrival order, while there is room for them.
+    Called whenever capacity is freed (session closed or expired)
+    """
+    async with admission_lock:
+        while len(waiting_room) > 0:
+            ticket = waiting_room.head()
+            session = orm_session_maker()
+            try:
+                if await used_capacity(session, ticket.user) >= max_sessions:
+                    break
+                s = await get_session_by_user(session, ticket.user)
+                if not s:
+                    logger.info(f"waiting room - launching session for {ticket.user}")
+                    with tracer.span("waiting_room.admit", user=ticket.user):
+                        s = await open_session(session, ticket.user, ticket.gpu)
+                waiting_room.admit(ticket, session_uuid=s.uuid)
+                journal.record("admit", u=ticket.user, s=s.uuid)
+            except Exception as e:
+                logger.error(f"waiting room - could not launch session for {ticket.user}: {e}")
+                await session.rollback()
+                waiting_room.admit(ticket, error=str(e))
+            finally:
+                await session.close()
+
+
+def capacity_freed():
+    """ A session was closed or expired: admit the next users in the waiting room (in background) """
+    waiting_room.record_release()
+    if len(waiting_room) > 0:
+        asyncio.create_task(admit_waiting_users())
+
+
 # Start (or resume) 3DSlicer session
 @app.post("/login")
-async def login(login_form: OAuth2PasswordRequestForm = Depends()):
-    username = login_form.username
-    password = login_form.password
-    if re.match(r".*_gpu$", login_form.username):
-        gpu = True
-    else:
-        gpu= False
-    if await check_credentials(username, password):
-        if await can_open_session(username):
-            session = orm_session_maker()
-            s = session.query(Session3DSlicer).filter(Session3DSlicer.user == username).first()
-            if not s:
-                # Create new session (IF there is room)
-                cont = count_active_session_containers(session)
-                if cont < max_sessions:
-                    s = Session3DSlicer()
-                    s.user = username
-                    s.last_activity = datetime.datetime.now()
-                    s.gpu = gpu
-                    session.add(s)
-                    session.flush()
-                    s.url_path = f"/{s.uuid}/"
-                    # Launch new 3d slicer container
-                    await launch_3dslicer_web_container(s)
-                    pct = container_orchestrator.get_container_activity(s.container_name)
-                    s.info = {'CPU_pct': pct, 'shared': False}
-                    # Commit new
-                    session.add(s)
-                    session.commit()
-                    # Update nginx.conf and reread Nginx configuration
-                    await refresh_nginx(container_orchestrator, session, nginx_config_path, domain, tdslicerhub_adress)
+async def login(login_form: OAuth2PasswordRequestForm = Depends(), session: AsyncSession = Depends(get_db)):
+    with tracer.span("login", user=login_form.username) as sp:
+        t0 = time.perf_counter()
+        username = login_form.username
+        password = login_form.password
+        if re.match(r".*_gpu$", login_form.username):
+            gpu = True
+        else:
+            gpu= False
+        with login_phase("ldap_auth", username):
+            authenticated = await check_credentials(username, password)
+        if authenticated:
+            if await can_open_session(username):
+                s = await get_session_by_user(session, username)
+                if s:
+                    outcome = "reconnect"
+                    if s.held:  # Launched for a reservation, now claimed
+                        s.held = False
+                        await session.commit()
+                    if s.cpu_limit is not None and await asyncio.to_thread(container_orchestrator.set_cpu_limit,
+                                                                           s.container_name, None):
+                        # Throttled while idle: full CPU for the user coming back, and idle time counted from now
+                        s.cpu_limit = None
+                        s.last_activity = datetime.datetime.now()
+                        await session.commit()
                 else:
-                    return HTMLResponse(content=f"""<!DOCTYPE html>
-                                                    <html>
-                                                      <head>
-                                                        <title>Max number of sessions reached</title>
-                                                      </head>
-                                                      <body>
-                                                      <p>Cannot open a new session, {max_sessions} reached. Please close other sessions</p>
-                                                      </body>
-                                                    </html>""", status_code=401)
-
-            session.close()
-
-            # Redirect to a session management page:
-            return RedirectResponse(url=f"/sessions/{s.uuid}", status_code=302)
-    else:
-        return HTMLResponse(content="""<!DOCTYPE html>
-                                        <html>
-                                          <head>
-                                            <title>Login Failed</title>
-                                          </head>
-                                          <body>
-                                          <p>Login Failed: Your user ID or password is incorrect</p>
-                                          </body>
-                                        </html>""", status_code=401)
+                    # Create new session (IF there is room and nobody is waiting before). Checked and taken under
+                    # the lock of "admit_waiting_users", so concurrent logins do not take the same room
+                    async with admission_lock:
+                        with login_phase("capacity_check", username):
+                            has_room = len(waiting_room) == 0 and \
+                                await used_capacity(session, username) < max_sessions
+                        if has_room:
+                            s = await open_session(session, username, gpu)
+                        else:
+                            ticket = waiting_room.enqueue(username, gpu)
+                    if has_room:
+                        outcome = "launch"
+                    else:
+                        logger.info(f"waiting room - {username} waiting, position {waiting_room.position(ticket)}")
+                        LOGIN_SECONDS.labels("queued").observe(time.perf_counter() - t0)
+                        journal.record("login", u=username, o="queued", d=time.perf_counter() - t0)
+                        return RedirectResponse(url=f"/queue/{ticket.id}", status_code=302)
+
+                LOGIN_SECONDS.labels(outcome).observe(time.perf_counter() - t0)
+                journal.record("login", u=username, s=s.uuid, o=outcome, d=time.perf_counter() - t0)
+                sp.set_attribute("outcome", outcome)
+
+                # Redirect to a session management page:
+                return RedirectResponse(url=f"/sessions/{s.uuid}", status_code=302)
+        else:
+            LOGIN_SECONDS.labels("failed").observe(time.perf_counter() - t0)
+            journal.record("login", u=username, o="failed", d=time.perf_counter() - t0)
+            return HTMLResponse(content="""<!DOCTYPE html>
+                                            <html>
+                                              <head>
+                                                <title>Login Failed</title>
+                                              </head>
+                                              <body>
+                                              <p>Login Failed: Your user ID or password is incorrect</p>
+                                              </body>
+                                            </html>""", status_code=401)
+
+
+def ticket_not_found(ticket_id):
+    return HTMLResponse(content=f"""<!DOCTYPE html>
+                                    <html>
+                                      <head>
+                                        <title>Ticket not found</title>
+                                      </head>
+                                      <body>
+                                      <p>Ticket {ticket_id} does not exist or expired. Please <a href="/login">login</a> again</p>
+                                      </body>
+                                    </html>""", status_code=404)
+
+
+@app.get("/queue/{ticket_id}")
+async def waiting_room_page(request: Request, ticket_id: str):
+    ticket = waiting_room.get(ticket_id)
+    if not ticket:
+        return ticket_not_found(ticket_id)
+    _ = dict(request=request, **waiting_room.status(ticket))
+    return templates.TemplateResponse("waiting_room.html", _)
+
+
+@app.get("/queue/{ticket_id}/status")
+async def waiting_room_status(ticket_id: str):
+    ticket = waiting_room.get(ticket_id)
+    if not ticket:
+        return JSONResponse(content=dict(ticket=ticket_id, error="Ticket not found"), status_code=404)
+    return waiting_room.status(ticket)
+
+
+@app.get("/queue/{ticket_id}/events")
+async def waiting_room_events(ticket_id: str):
+    """ Server-Sent Events stream with the position and estimated waiting time of a ticket """
+    async def event_stream():
+        while True:
+            ticket = waiting_room.get(ticket_id)
+            if not ticket:
+                yield f"event: gone\ndata: {json.dumps(dict(ticket=ticket_id))}\n\n"
+                return
+            st = waiting_room.status(ticket)
+            yield f"data: {json.dumps(st)}\n\n"
+            if st["session"] or st["error"]:
+                return
+            await asyncio.sleep(2)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/queue/{ticket_id}/leave")
+async def leave_waiting_room(ticket_id: str):
+    waiting_room.leave(ticket_id)
+    return RedirectResponse(url="/", status_code=302)
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+security = HTTPBasic()
+
+
+async def require_admin(credentials: HTTPBasicCredentials = Depends(security)):
+    """ Administration endpoints: HTTP Basic authentication of an LDAP user listed in ADMIN_USERS """
+    if credentials.username in admin_users and await check_credentials(credentials.username, credentials.password):
+        return credentials.username
+    raise HTTPException(status_code=401, detail="Administrator credentials required",
+                        headers={"WWW-Authenticate": "Basic"})
+
+
+@app.get("/admin/launches")
+async def slowest_launches_page(request: Request, limit: int = 20, admin: str = Depends(require_admin)):
+    """ Slowest recent session launches, with the breakdown of their spans """
+    traces = tracer.recent_traces(contains="launch_3dslicer_web_container")
+    traces = sorted(traces, key=lambda spans: spans[-1].duration, reverse=True)[:limit]
+    launches = []
+    for spans in traces:
+        root = spans[-1]
+        launches.append(dict(root=root,
+                             started=datetime.datetime.fromtimestamp(root.start),
+                             spans=[(depth, sp, sp.start - root.start) for depth, sp in span_tree(spans)]))
+    _ = dict(request=request, launches=launches)
+    return templates.TemplateResponse("admin_launches.html", _)
+
+
+provision_batches = dict()  # batch id -> ProvisionBatch, the most recent ones
+
+
+def start_provisioning(batch, gpu=False, parallelism=None, reservation_id=None):
+    """ Run a bulk provisioning batch in background, its status is kept in "provision_batches" """
+    provision_batches[batch.id] = batch
+    for batch_id in list(provision_batches)[:-50]:
+        del provision_batches[batch_id]
+    batch.task = asyncio.create_task(provision_sessions(batch, gpu, parallelism, reservation_id))
+    return batch
+
+
+async def resolve_group(group):
+    """ Users of an LDAP group (LookupError if it does not exist) """
+    return await asyncio.to_thread(ldap_call, "search", ldap_group_members, ldap_address, ldap_base, group,
+                                   ldap_bind_dn, ldap_bind_password, timeout=ldap_timeout_sec)
+
+
+@app.post("/admin/provision")
+async def provision(request: ProvisionRequest, wait: bool = False, admin: str = Depends(require_admin)):
+    """
+    Pre-provision the sessions of a class or workshop: the users listed and/or the members of an LDAP group.
+    Returns at once (202) with the batch, whose progress is at "/admin/provision/{batch}", unless "wait"
+    """
+    users = list(request.users)
+    if request.group:
+        try:
+            users += await resolve_group(request.group)
+        except LookupError as e:
+            return JSONResponse(content=dict(group=request.group, error=str(e)), status_code=404)
+        except (LDAPException, ServiceUnavailable) as e:
+            logger.error(f"provisioning - could not read LDAP group {request.group}: {e!r}")
+            return JSONResponse(content=dict(group=request.group, error=f"LDAP: {e}"), status_code=502)
+    if not users:
+        return JSONResponse(content=dict(error="No users to provision"), status_code=400)
+    batch = ProvisionBatch(users, admin, request.group)
+    logger.info(f"provisioning {batch.id} - {admin} provisions {len(batch.users)} users")
+    start_provisioning(batch, request.gpu, request.parallelism)
+    if wait:
+        await asyncio.wait({batch.task})
+    return JSONResponse(content=batch.status(lambda session_id: launch_status(session_id, None)),
+                        status_code=200 if batch.done else 202)
+
+
+@app.get("/admin/provision/{batch_id}")
+async def provision_status(batch_id: str, admin: str = Depends(require_admin)):
+    batch = provision_batches.get(batch_id)
+    if not batch:
+        return JSONResponse(content=dict(batch=batch_id, error="Batch not found"), status_code=404)
+    return batch.status(lambda session_id: launch_status(session_id, None))
+
+
+async def reservations_status(sess, reservations):
+    sessions = [s for s in await all_sessions(sess) if s.reservation_id]
+    return [reservation_status(r, [s for s in sessions if s.reservation_id == r.id]) for r in reservations]
+
+
+@app.post("/admin/reservations")
+async def create_reservation(request: ReservationRequest, admin: str = Depends(require_admin),
+                             session: AsyncSession = Depends(get_db)):
+    """
+    Book sessions for a time window: the users listed and/or the members of an LDAP group. Their sessions are
+    launched RESERVATION_LEAD_SEC before the start
+    """
+    starts_at, ends_at = local_naive(request.starts_at), local_naive(request.ends_at)
+    if ends_at <= starts_at or ends_at <= datetime.datetime.now():
+        return JSONResponse(content=dict(error="The window must end after it starts, in the future"), status_code=400)
+    if request.profile not in PROFILES:
+        return JSONResponse(content=dict(error=f"Unknown profile {request.profile}, one of {list(PROFILES)}"),
+                            status_code=400)
+    users = list(request.users)
+    if request.group:
+        try:
+            users += await resolve_group(request.group)
+        except LookupError as e:
+            return JSONResponse(content=dict(group=request.group, error=str(e)), status_code=404)
+        except (LDAPException, ServiceUnavailable) as e:
+            logger.error(f"reservations - could not read LDAP group {request.group}: {e!r}")
+            return JSONResponse(content=dict(group=request.group, error=f"LDAP: {e}"), status_code=502)
+    if not users:
+        return JSONResponse(content=dict(error="No users to reserve sessions for"), status_code=400)
+    r = Reservation(name=request.name, created_by=admin, starts_at=starts_at, ends_at=ends_at,
+                    users=list(dict.fromkeys(users)), group=request.group, profile=request.profile, state="scheduled")
+    session.add(r)
+    await session.commit()
+    logger.info(f"reservations - {admin} reserved {len(r.users)} sessions from {starts_at} to {ends_at}")
+    return JSONResponse(content=(await reservations_status(session, [r]))[0], status_code=201)
+
+
+@app.get("/admin/reservations")
+async def list_reservations(admin: str = Depends(require_admin), session: AsyncSession = Depends(get_db)):
+    reservations = (await session.execute(select(Reservation).where(Reservation.state.in_(OPEN_STATES))
+                                          .order_by(Reservation.starts_at))).scalars().all()
+    return await reservations_status(session, reservations)
+
+
+@app.delete("/admin/reservations/{reservation_id}")
+async def cancel_reservation(reservation_id: str, admin: str = Depends(require_admin),
+                             session: AsyncSession = Depends(get_db)):
+    """ Release a reservation now: its room and the sessions not claimed yet """
+    r = await session.get(Reservation, reservation_id)
+    if not r:
+        return JSONResponse(content=dict(reservation=reservation_id, error="Reservation not found"), status_code=404)
+    await release_reservation(session, r)
+    return (await reservations_status(session, [r]))[0]
+
+
+draining = set()  # Uuids of the sessions being relaunched by a drain (the sessions checker leaves them alone)
+drain_jobs = dict()  # job id -> DrainJob, the most recent ones
+
+
+async def relaunch_session(job: DrainJob, session_id):
+    """
+    Relaunch a session of a node being drained in another node: same uuid, volumes and route. The route switches to
+    the new instance when it passes the readiness probe
+
+    :return: True if relaunched
+    """
+    with tracer.new_trace("relaunch", session=str(session_id), node=job.node):
+        async with orm_session_maker() as sess:
+            s = await sess.get(Session3DSlicer, session_id)
+            if s is None:
+                job.progress(session_id, "error", "Session closed")
+                return False
+            draining.add(s.uuid)
+            try:
+                job.progress(s.uuid, "relaunching")
+                shared_cache = await ensure_shared_cache() if shared_cache_enabled else None
+                await container_orchestrator.relaunch_container(
+                    s.container_name, tdslicer_image_name, tdslicer_image_tag, network_id,
+                    session_volume_dict(s, shared_cache), s.uuid, use_gpu=s.gpu, scratch=session_scratch(s),
+                    avoid_nodes=[job.node], env=session_env(shared_cache))
+                address = await asyncio.to_thread(current_address, s.container_name)
+                if not address:
+                    raise RuntimeError("the relaunched container has no address")
+                usable, waited, attempts = await wait_until_usable(
+                    lambda: container_orchestrator.probe_readiness(address), readiness_deadline_sec,
+                    readiness_initial_delay_sec, readiness_max_delay_sec)
+                if not usable:
+                    raise RuntimeError(f"the relaunched container was not usable after {waited:.1f} s")
+                job.progress(s.uuid, "ready")
+                # New instance, with the full CPU allowance and share
+                s.host = container_orchestrator.get_container_host(s.container_name)
+                s.cpu_limit = None
+                s.last_activity = datetime.datetime.now()
+                if fair_share:
+                    fair_share.reset(s.uuid)
+                moved = address != s.service_address
+                s.service_address = address
+                await sess.commit()
+                if moved:
+                    await refresh_nginx(container_orchestrator, sess, nginx_config_path, domain, tdslicerhub_adress)
+                job.progress(s.uuid, "routed")
+                journal.record("relaunch", u=s.user, s=s.uuid)
+                logger.info(f"drain {job.id} - session of {s.user} relaunched out of {job.node} in {address}")
+                return True
+            except Exception as e:
+                logger.error(f"drain {job.id} - could not relaunch the session of {s.user}: {e!r}")
+                job.progress(s.uuid, "error", str(e))
+                await sess.rollback()
+                return False
+            finally:
+                draining.discard(s.uuid)
+
+
+async def drain_node(job: DrainJob, parallelism=None):
+    """ Relaunch the sessions of a drain job in other nodes, at most "parallelism" (DRAIN_PARALLELISM) at a time """
+    semaphore = asyncio.Semaphore(parallelism or drain_parallelism)
+
+    async def relaunch(session_id):
+        async with semaphore:
+            return await relaunch_session(job, session_id)
+
+    try:
+        await asyncio.gather(*[relaunch(session_id) for session_id in job.sessions])
+    finally:
+        job.finished_at = time.time()
+        logger.info(f"drain {job.id} - {job.node} done: {job.status()['counts']}")
+
+
+async def sessions_on_node(sess, node):
+    """ :return: sessions whose container runs in a node, None if the orchestrator has no nodes """
+    names = await asyncio.to_thread(container_orchestrator.containers_on_node, node)
+    if names is None:
+        return None
+    names = set(names)
+    return [s for s in await all_sessions(sess) if s.container_name in names and s.state in LAUNCHED_STATES]
+
+
+@app.get("/admin/nodes/{node}/sessions")
+async def node_sessions(node: str, admin: str = Depends(require_admin), session: AsyncSession = Depends(get_db)):
+    sessions = await sessions_on_node(session, node)
+    if sessions is None:
+        return JSONResponse(content=dict(node=node, error=f"{co_str} has no nodes"), status_code=400)
+    return dict(node=node, sessions=[dict(session=str(s.uuid), user=s.user, container=s.container_name,
+                                          address=s.service_address) for s in sessions])
+
+
+@app.post("/admin/nodes/{node}/drain")
+async def drain(node: str, parallelism: int = None, cordon: bool = True, wait: bool = False,
+                admin: str = Depends(require_admin), session: AsyncSession = Depends(get_db)):
+    """
+    Relaunch the sessions of a node in other nodes (see "tsliceh.drain"), cordoning it first unless "cordon" is
+    false. Returns at once (202) with the job, whose progress is at "/admin/drains/{job}", unless "wait"
+    """
+    sessions = await sessions_on_node(session, node)
+    if sessions is None:
+        return JSONResponse(content=dict(node=node, error=f"{co_str} has no nodes"), status_code=400)
+    if not container_orchestrator.relaunches_containers:  # Checked before cordoning, nothing could be moved
+        return JSONResponse(content=dict(node=node, error=f"{co_str} cannot relaunch sessions in another node"),
+                            status_code=400)
+    if cordon and not await asyncio.to_thread(container_orchestrator.cordon_node, node):
+        return JSONResponse(content=dict(node=node, error="Could not cordon the node"), status_code=502)
+    job = DrainJob(node, [(s.uuid, s.user) for s in sessions], admin)
+    logger.info(f"drain {job.id} - {admin} drains {node}: {len(sessions)} sessions")
+    drain_jobs[job.id] = job
+    for job_id in list(drain_jobs)[:-50]:
+        del drain_jobs[job_id]
+    job.task = asyncio.create_task(drain_node(job, parallelism))
+    if wait:
+        await asyncio.wait({job.task})
+    return JSONResponse(content=job.status(), status_code=200 if job.done else 202)
+
+
+@app.get("/admin/drains/{job_id}")
+async def drain_status(job_id: str, admin: str = Depends(require_admin)):
+    job = drain_jobs.get(job_id)
+    if not job:
+        return JSONResponse(content=dict(job=job_id, error="Drain job not found"), status_code=404)
+    return job.status()
+
+
+@app.post("/admin/nodes/{node}/uncordon")
+async def uncordon(node: str, admin: str = Depends(require_admin)):
+    """ Place new sessions in a node again, after its maintenance """
+    if not await asyncio.to_thread(container_orchestrator.cordon_node, node, False):
+        return JSONResponse(content=dict(node=node, error="Could not uncordon the node"), status_code=502)
+    return dict(node=node, cordoned=False)
+
+
+def launch_status(session_id, s):
+    """ Progress of the launch of a session: from its job, or from its row if the job is gone (hub restarted) """
+    job = launch_jobs.get(session_id)
+    if job:
+        return job.status()
+    if s is None:
+        return None
+    return dict(session=str(s.uuid), phase=s.state, error=None, done=s.state == "routed", elapsed_sec=None,
+                phases=[])
+
+
+@app.get("/sessions/{session_id}/launch")
+async def session_launch_status(session_id: str, session: AsyncSession = Depends(get_db)):
+    st = launch_status(session_id, await session.get(Session3DSlicer, session_id))
+    if st is None:
+        return JSONResponse(content=dict(session=session_id, error="Session not found"), status_code=404)
+    return st
+
+
+@app.get("/sessions/{session_id}/launch/events")
+async def session_launch_events(session_id: str):
+    """ Server-Sent Events stream with the launch phases of a session, until it is routed or failed """
+    async def event_stream():
+        while True:
+            async with orm_session_maker() as sess:
+                st = launch_status(session_id, await sess.get(Session3DSlicer, session_id))
+            if st is None:
+                yield f"event: gone\ndata: {json.dumps(dict(session=session_id))}\n\n"
+                return
+            yield f"data: {json.dumps(st)}\n\n"
+            if st["done"]:
+                return
+            await asyncio.sleep(1)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.get("/sessions/{session_id}")
-async def get_session_management_page(request: Request, session_id: str):
-    session = orm_session_maker()
-    s = session.query(Session3DSlicer).get(session_id)
+async def get_session_management_page(request: Request, session_id: str, session: AsyncSession = Depends(get_db)):
+    s = await session.get(Session3DSlicer, session_id)
+    if s is None or s.state != "routed":
+        st = launch_status(session_id, s)
+        if st is None:
+            return HTMLResponse(content=f"""<!DOCTYPE html>
+                                            <html>
+                                              <head>
+                                                <title>Session not found</title>
+                                              </head>
+                                              <body>
+                                              <p>Session {session_id} does not exist. Please <a href="/login">login</a> again</p>
+                                              </body>
+                                            </html>""", status_code=404)
+        _ = dict(request=request, sess_uuid=session_id, user=s.user if s else launch_jobs.get(session_id).user,
+                 all_phases=PHASES, **st)
+        return templates.TemplateResponse("launch_progress.html", _)
     _ = dict(request=request,
              url_base="",
              sess_uuid=session_id,
              sess_link=s.url_path,
              sess_user=s.user,
-             sess_shared=s.info['shared'])
-    session.close()
+             sess_shared=s.shared,
+             activity=session_activity(session_id, s))
     return templates.TemplateResponse("manage_session.html", _)
 
 
+def session_activity(session_id, s=None):
+    """
+    Activity history of a session, its smoothed signals and the decision of the policy. With the session, also its
+    last CPU sample, its CPU allowance and the use of its scratch space
+    """
+    a = activity_tracker.get(session_id)
+    _ = dict()
+    if s is not None:
+        scratch = session_scratch(s)
+        _ = dict(cpu_pct=s.cpu_pct, cpu_limit=s.cpu_limit, fair_share=fair_share.status(s.uuid) if fair_share else None,
+                 scratch=dict(path=scratch[0], size_bytes=scratch[1] * 1024 ** 2, used_bytes=s.scratch_bytes)
+                 if scratch else None)
+    return dict(_, policy=activity_tracker.policy,
+                signals=SIGNALS,
+                thresholds=activity_tracker.thresholds,
+                active=a.active if a else None,
+                score=activity_tracker.score(a) if a else None,
+                ewma=a.ewma if a else {},
+                history=a.history() if a else [])
+
+
+@app.get("/sessions/{session_id}/activity")
+async def get_session_activity(session_id: str, session: AsyncSession = Depends(get_db)):
+    s = await session.get(Session3DSlicer, session_id)
+    if s is None:
+        return JSONResponse(dict(detail="Session does not exist"), status_code=404)
+    return JSONResponse(session_activity(s.uuid, s))
+
+
 @app.post("/sessions/{session_id}/share")
-async def share_session(request: Request, session_id: str, interactive: int = 0):
-    session = orm_session_maker()
-    s = session.query(Session3DSlicer).get(session_id)
+async def share_session(request: Request, session_id: str, interactive: int = 0,
+                        session: AsyncSession = Depends(get_db)):
+    s = await session.get(Session3DSlicer, session_id)
     if s:
-        s.info["shared"] = True
-        s.info["shared_interactive"] = interactive
-        flag_modified(s, "info")
+        s.shared = True
+        s.shared_interactive = bool(interactive)
         session.add(s)
-        session.commit()
-        session.close()
+        await session.commit()
+        journal.record("share", u=s.user, s=s.uuid, i=bool(interactive))
         return RedirectResponse(url=f"/sessions/{session_id}", status_code=302)
     else:
-        session.close()
         return HTMLResponse(content="""<!DOCTYPE html>
                                         <html>
                                           <head>
@@ -355,18 +1255,16 @@ async def share_session(request: Request, session_id: str, interactive: int = 0)
 
 
 @app.post("/sessions/{session_id}/unshare")
-async def unshare_session(request: Request, session_id: str):
-    session = orm_session_maker()
-    s = session.query(Session3DSlicer).get(session_id)
+async def unshare_session(request: Request, session_id: str, session: AsyncSession = Depends(get_db)):
+    s = await session.get(Session3DSlicer, session_id)
     if s:
-        s.info["shared"] = False
-        flag_modified(s, "info")
+        s.shared = False
+        s.shared_interactive = False
         session.add(s)
-        session.commit()
-        session.close()
+        await session.commit()
+        journal.record("unshare", u=s.user, s=s.uuid)
         return RedirectResponse(url=f"/sessions/{session_id}", status_code=302)
     else:
-        session.close()
         return HTMLResponse(content="""<!DOCTYPE html>
                                         <html>
                                           <head>
@@ -379,31 +1277,34 @@ async def unshare_session(request: Request, session_id: str):
 
 
 @app.post("/sessions/{session_id}/close")
-async def close_session_and_container(session_id):
-    session = orm_session_maker()
-    s = session.query(Session3DSlicer).get(session_id)
+async def close_session_and_container(session_id, session: AsyncSession = Depends(get_db)):
+    s = await session.get(Session3DSlicer, session_id)
     if s:
+        await launch_jobs.cancel(s.uuid)  # Closed while launching
         container_name = CONTAINER_NAME_PREFIX + container_orchestrator.get_valid_name(s.user)
-        status = container_orchestrator.get_container_status(container_name)
+        status = await asyncio.to_thread(container_orchestrator.get_container_status, container_name)
         if status:
-            stop_remove_container(container_name, True)
+            await stop_remove_container(container_name, True)
             logger.info(f"container {container_name} deleted")
         logger.info(f"deleting session {s.uuid}")
-        session.delete(s)
-        session.commit()
+        await session.delete(s)
+        await session.commit()
+        activity_tracker.forget(s.uuid)
+        if fair_share:
+            fair_share.forget(s.uuid)
+        journal.record("close", u=s.user, s=s.uuid)
         # Update nginx.conf and reread Nginx configuration
         await refresh_nginx(container_orchestrator, session, nginx_config_path, domain, tdslicerhub_adress)
-        session.close()
+        capacity_freed()
         return RedirectResponse(url="/", status_code=302)
     else:
-        session.close()
         raise Exception(f"cant remove container user expired")
 
 
-def refresh_index_html(sess, proto="http", admin=True, write_to_file=True):
+async def refresh_index_html(sess, proto="http", admin=True, write_to_file=True):
 
     if max_sessions < 1000:
-        cont = count_active_session_containers(sess)
+        cont = await count_active_session_containers(sess)
         sessions_cont = f"({cont}/{max_sessions})"
     else:
         sessions_cont = ""
@@ -441,8 +1342,8 @@ def refresh_index_html(sess, proto="http", admin=True, write_to_file=True):
 
     </body>
         """
-    for s in sess.query(Session3DSlicer).all():
-        if admin or s.info["shared"]:
+    for s in await all_sessions(sess):
+        if admin or s.shared:
             # Section doing reverse proxy magic
             _ += f"""
 <div class="w3-quarter">
@@ -450,7 +1351,7 @@ def refresh_index_html(sess, proto="http", admin=True, write_to_file=True):
 <img src="/static/images/3dslicer.png" alt="3dslicerImagesNotFound" style="width:23%" class="w3-circle w3-hover-opacity">
 </a>
 <h3>{s.user}</h3>
-<p>CPU [%]: {s.info["CPU_pct"]}</p>
+<p>CPU [%]: {s.cpu_pct}</p>
 <p>(last checked: {s.last_activity})</p>
 </div>
     """
@@ -462,6 +1363,64 @@ def refresh_index_html(sess, proto="http", admin=True, write_to_file=True):
     return _
 
 
+def session_volume_dict(s, shared_cache=None):
+    return volume_dict(s.user, (dataset_cache_dir, dataset_mount) if dataset_cache_dir else None, shared_cache)
+
+
+def session_env(shared_cache=None):
+    """ Environment variables of the container of a session """
+    return shared_cache_environment() if shared_cache else None
+
+
+def session_scratch(s):
+    """ (path, size in MiB) of the scratch space of a session, by its resource profile. None if it has none """
+    size = scratch_size_mb.get(session_profile(s.gpu), 0)
+    return (scratch_path, size) if size > 0 else None
+
+
+shared_caches_ready = set()  # Shared caches populated (or found populated) in this run of the hub
+shared_cache_failures = dict()  # Shared cache -> (consecutive failed populations, monotonic time of the next attempt)
+shared_cache_lock = asyncio.Lock()
+
+
+async def ensure_shared_cache():
+    """
+    Populate the shared extensions and packages cache of the Slicer image version, once: the launches arriving
+    meanwhile wait for it. If it cannot be populated the sessions are launched without it, and it is not attempted
+    again for SHARED_CACHE_RETRY_SEC (doubled after each consecutive failure, up to 16 times)
+
+    :return: its volume (or directory of the nodes), None if not available
+    """
+    source = container_orchestrator.shared_cache_source(shared_cache_version(tdslicer_image_tag,
+                                                                             shared_cache_version_))
+    if source in shared_caches_ready:
+        return source
+    if time.monotonic() < shared_cache_failures.get(source, (0, 0.0))[1]:
+        return None  # Failed recently, do not make the launches wait for another attempt
+    async with shared_cache_lock:
+        if source not in shared_caches_ready:
+            failures, retry_at = shared_cache_failures.get(source, (0, 0.0))
+            if time.monotonic() < retry_at:  # Failed while waiting for the lock
+                return None
+            script = shared_cache_populate_script(slicer_extensions, shared_apt_packages, slicer_executable)
+            try:
+                with SHARED_CACHE_POPULATE_SECONDS.time():
+                    await asyncio.to_thread(container_orchestrator.populate_shared_cache, source, tdslicer_image_name,
+                                            tdslicer_image_tag, SHARED_CACHE_MOUNT, script)
+            except Exception as e:
+                retry_in = shared_cache_retry_sec * 2 ** min(failures, 4)
+                shared_cache_failures[source] = (failures + 1, time.monotonic() + retry_in)
+                logger.error(f"shared cache - could not populate {source}, retrying in {retry_in:.0f} s: {e!r}")
+                SHARED_CACHE_POPULATIONS.labels("error").inc()
+                return None
+            SHARED_CACHE_POPULATIONS.labels("ok").inc()
+            logger.info(f"shared cache - {source} ready")
+            shared_caches_ready.add(source)
+            shared_cache_failures.pop(source, None)
+    return source
+
+
+@traced()
 async def launch_3dslicer_web_container(s: Session3DSlicer):
     """
     Launch a 3DSlicer web container
@@ -470,19 +1429,57 @@ async def launch_3dslicer_web_container(s: Session3DSlicer):
     container_name = CONTAINER_NAME_PREFIX + container_orchestrator.get_valid_name(s.user)
 
     logger.info("CREATING NEW CONTAINER")
-    container_orchestrator.create_image(tdslicer_image_name, tdslicer_image_tag)
-    create_all_volumes(container_orchestrator, s.user)
-    vol_dict = volume_dict(s.user)
-    c = await container_orchestrator.start_container(container_name, tdslicer_image_name, tdslicer_image_tag,
-                                                     network_id, vol_dict, s.uuid, use_gpu = s.gpu)
+    launch_jobs.progress(s.uuid, "pulling")
+    # Blocking orchestrator calls run in threads, so concurrent launches (e.g. bulk provisioning) overlap
+    with login_phase("image_check", s.user):
+        await asyncio.to_thread(container_orchestrator.create_image, tdslicer_image_name, tdslicer_image_tag)
+    with login_phase("shared_cache", s.user):
+        shared_cache = await ensure_shared_cache() if shared_cache_enabled else None
+    with login_phase("volume_provisioning", s.user):
+        await asyncio.to_thread(create_all_volumes, container_orchestrator, s.user, shared_cache is not None)
+    vol_dict = session_volume_dict(s, shared_cache)
+    cache_report = None
+    if dataset_cache_dir and datasets:
+        with login_phase("dataset_cache", s.user):
+            cache_report = await asyncio.to_thread(container_orchestrator.fill_dataset_cache, container_name)
+    t0 = time.perf_counter()
+    launch_jobs.progress(s.uuid, "starting")
+    with login_phase("container_start", s.user):
+        c = await container_orchestrator.start_container(container_name, tdslicer_image_name, tdslicer_image_tag,
+                                                         network_id, vol_dict, s.uuid, use_gpu = s.gpu,
+                                                         scratch=session_scratch(s), env=session_env(shared_cache))
+    s.host = container_orchestrator.get_container_host(container_name)
+    TIME_TO_RUNNING.observe(time.perf_counter() - t0)
+    if dataset_cache_dir and datasets and c.status.lower() == "running":
+        cache_report = cache_report or await asyncio.to_thread(container_orchestrator.dataset_cache_report,
+                                                               container_name)
+        if cache_report:
+            record_dataset_cache(cache_report)
+            logger.info(f"dataset cache - {s.user} in {cache_report['node']}: hits {cache_report['hits']}, "
+                        f"misses {cache_report['misses']}, evicted {cache_report['evicted']}")
     logs = c.logs
     # todo error control
-    s.service_address = get_container_internal_address(container_orchestrator, c.id, network_id)
+    with login_phase("readiness", s.user):
+        s.service_address = await asyncio.to_thread(get_container_internal_address, container_orchestrator, c.id,
+                                                    network_id)
+        if readiness_probe and c.status.lower() == "running":
+            # Do not redirect the user to a session whose KasmVNC is not answering yet
+            address = s.service_address
+            usable, waited, attempts = await wait_until_usable(
+                lambda: container_orchestrator.probe_readiness(address), readiness_deadline_sec,
+                readiness_initial_delay_sec, readiness_max_delay_sec)
+            if usable:
+                TIME_TO_USABLE.observe(time.perf_counter() - t0)
+            else:
+                READINESS_TIMEOUTS.inc()
+            logger.info(f"container {c.name} : usable={usable} after {waited:.1f} s, {attempts} probes")
     s.container_name = container_name
+    launch_jobs.progress(s.uuid, "ready")
     logger.info(f"container {c.name} : {c.status} in {s.service_address}")
+    return c
 
 
-def stop_remove_container(name, force_remove=False):
+async def stop_remove_container(name, force_remove=False):
     """
     in certain session, stop container when:
     - session expires
@@ -492,9 +1489,9 @@ def stop_remove_container(name, force_remove=False):
     :return:
     """
     # TODO MANAGE THOSE PRINTS
-    stopped = container_orchestrator.stop_container(name)
+    stopped = await asyncio.to_thread(container_orchestrator.stop_container, name)
     if stopped is True:
-        removed = container_orchestrator.remove_container(name, force_remove)
+        removed = await asyncio.to_thread(container_orchestrator.remove_container, name, force_remove)
         if removed:
             logger.info(f"container {name} : removed")
         elif removed is False:
@@ -518,88 +1515,297 @@ def catch_all(path_name: str, request: Request):
                                     </html>""", status_code=200)
 
 
+def current_address(container_name):
+    """ :return: "ip:port" of a container as seen now by the orchestrator, None if it has no IP (not running) """
+    address = get_container_internal_address(container_orchestrator, container_name, network_id)
+    ip = address.rsplit(":", 1)[0]
+    return address if ip and ip != "None" else None
+
+
 class BackgroundRunner:
     def __init__(self):
         self.session_maker = None
 
-    async def sessions_checker(self, sm):
-        async def check_session_activity(s):
-            print(":::::::::::::::::::::::Checking Session Activity:::::::::::::::::::::::::::::::::::")
-            pct = container_orchestrator.get_container_activity(s.container_name)
-            logger.info(f"pct container: {s.container_name}: {pct} ")
-            s.info['CPU_pct'] = pct
-            flag_modified(s, "info")
-            ahora = datetime.datetime.now()
-            if pct > ACTIVITY_THRESHOLD:
-                s.last_activity = ahora
-                stop = False
-            else:
-                stop = (ahora - s.last_activity).total_seconds() > allowed_inactivity_time_in_seconds
-            return stop
+    @staticmethod
+    async def check_session_activity(s, held_until=None):
+        """
+        Sample the activity of a session
 
-        # ---- sessions_checker ----------------------------------------------------------------------------------------
-        logger.info("::::::::::::::::::::::: Session Checker :::::::::::::::::::::::::::::::::::")
+        :param held_until: start of the reservation of a held session, not expired before it (and its inactivity
+                           counted from it)
+        :return: (stop, update, sample): whether the session has been inactive for too long, the new values of its
+                 row in "sessions" (with "service_address" if the container has moved, e.g. a rescheduled pod) and the
+                 row for "session_activity"
+        """
+        print(":::::::::::::::::::::::Checking Session Activity:::::::::::::::::::::::::::::::::::")
+        pct = await asyncio.to_thread(container_orchestrator.get_container_activity, s.container_name)
+        net = await asyncio.to_thread(container_orchestrator.get_container_network_io, s.container_name) \
+            if pct >= 0 else None
+        proxy_bytes = proxy_access_log.session_bytes(s.uuid) if proxy_access_log else None
+        a = activity_tracker.sample(s.uuid, cpu=pct, net=net, proxy_bytes=proxy_bytes)
+        logger.info(f"pct container: {s.container_name}: {pct}; smoothed: {a.ewma}; active: {a.active}")
+        journal.record("activity", u=s.user, s=s.uuid, cpu=pct)
+        ahora = datetime.datetime.now()
+        if pct >= 0 and a.active:
+            last_activity = ahora
+            stop = False
+        else:
+            last_activity = s.last_activity
+            idle_since = max(last_activity, held_until) if held_until else last_activity
+            stop = (ahora - idle_since).total_seconds() > allowed_inactivity_time_in_seconds
+        update = dict(uuid=s.uuid, cpu_pct=pct, last_activity=last_activity)
+        if pct >= 0 and not stop and cpu_throttle_steps:
+            # Idle sessions step down their CPU allowance, given back as soon as they are active again
+            cpus = None if a.active else cpu_allowance((ahora - idle_since).total_seconds(), cpu_throttle_steps)
+            if cpus != s.cpu_limit and await asyncio.to_thread(container_orchestrator.set_cpu_limit, s.container_name,
+                                                               cpus):
+                logger.info(f"container {s.container_name}: CPU allowance {cpus or 'full'}")
+                update["cpu_limit"] = cpus
+                if fair_share:
+                    fair_share.reset(s.uuid)
+        if pct >= 0 and not stop and fair_share and update.get("cpu_limit", s.cpu_limit) is None:
+            # Interactive sessions get a larger CPU share than the ones computing without a user
+            cls, weight, change = fair_share.decide(s.uuid, s.user, a.ewma)
+            if change and await asyncio.to_thread(container_orchestrator.set_cpu_weight, s.container_name, weight):
+                logger.info(f"container {s.container_name}: {cls}, CPU weight {weight}")
+                fair_share.applied(s.uuid, weight)
+        if pct >= 0 and session_scratch(s):
+            update["scratch_bytes"] = await asyncio.to_thread(container_orchestrator.get_scratch_usage, s.container_name,
+                                                              scratch_path)
+        if pct >= 0 and not stop:
+            address = await asyncio.to_thread(current_address, s.container_name)
+            if address and address != s.service_address:
+                logger.info(f"::::::::::::::::: sessions_checker - container {s.container_name} moved from {s.service_address} to {address}")
+                update["service_address"] = address
+        sample = dict(session_uuid=s.uuid, user=s.user, t=ahora, active=a.active, **a.last_sample)
+        return stop, update, sample
+
+    async def sweep(self, sm):
+        """
+        One pass of the sessions checker: stop the sessions inactive for too long. The activity of all the sessions
+        is written at once (one bulk update and one bulk insert), and samples older than ACTIVITY_RETENTION_SEC are
+        pruned. The reverse proxy is reconfigured once if sessions were stopped or their container moved
 
-        tdslicer_containers = container_orchestrator.get_tdscontainers(CONTAINER_NAME_PREFIX)
-
-        # Reassociate, restart or delete 3D Slicer sessions if we are back from a restart of the container
-        sess = sm()
-        for s in sess.query(Session3DSlicer).all():
-            pct = container_orchestrator.get_container_activity(s.container_name)
-            logger.info(f"pct container: {s.container_name}: {pct} ")
-            s.last_activity = datetime.datetime.now()
-            s.info['CPU_pct'] = pct
-            if pct < 0:  # <0 -> "Container does not exist"
-                if s.restart:
-                    # TODO right now "restart" is always False so this is never executed
+        :return: number of sessions by state ("active", "idle", "expired")
+        """
+        with CHECKER_SWEEP_SECONDS.time():
+            states = dict(active=0, idle=0, expired=0)
+            throttled = 0
+            if proxy_access_log:
+                proxy_access_log.read()
+            updates = []
+            samples = []
+            expired = []
+            moved = []
+            async with sm() as sess:
+                sessions = await all_sessions(sess)
+                reservation_starts = dict()
+                if any(s.held for s in sessions):
+                    reservation_starts = {r.id: r.starts_at for r in (await sess.execute(
+                        select(Reservation).where(Reservation.state.in_(OPEN_STATES)))).scalars().all()}
+                # Loop all sessions, remove those that are not in use
+                for s in sessions:
+                    if s.state not in LAUNCHED_STATES or s.uuid in draining:  # Its launch (or drain) job is in charge
+                        continue
+                    print(f"Session - Name: {s.container_name};\n UUID: {s.uuid};\n User: {s.user}\n")
+                    held_until = reservation_starts.get(s.reservation_id) if s.held else None
+                    stop, update, sample = await self.check_session_activity(s, held_until)
+                    samples.append(sample)
+                    if stop:
+                        states["expired"] += 1
+                        logger.info(f"::::::::::::::::: sessions_checker - inactivity cleanup - stopping container {s.container_name}")
+                        await stop_remove_container(s.container_name)
+                        await sess.delete(s)
+                        expired.append(s)
+                    else:
+                        throttled += update.get("cpu_limit", s.cpu_limit) is not None
+                        if "service_address" in update:  # Also in the loaded object, used to generate nginx.conf
+                            s.service_address = update.pop("service_address")
+                            moved.append(s)
+                        updates.append(update)
+                        states["active" if sample["active"] else "idle"] += 1
+
+                await sess.run_sync(lambda ss: ss.bulk_update_mappings(Session3DSlicer, updates))
+                await sess.run_sync(lambda ss: ss.bulk_insert_mappings(ActivitySample, samples))
+                cutoff = datetime.datetime.now() - datetime.timedelta(seconds=activity_retention_sec)
+                await sess.execute(delete(ActivitySample).where(ActivitySample.t < cutoff))
+                await sess.commit()
+                for s in expired:
+                    activity_tracker.forget(s.uuid)
+                    if fair_share:
+                        fair_share.forget(s.uuid)
+                    journal.record("expire", u=s.user, s=s.uuid)
+                    waiting_room.record_release()
+                if expired or moved:
+                    # Update nginx.conf and reread Nginx configuration
+                    await refresh_nginx(container_orchestrator, sess, nginx_config_path, domain, tdslicerhub_adress)
+        for state, n in states.items():
+            SESSIONS.labels(state).set(n)
+        SESSIONS_EXPIRED.inc(states["expired"])
+        SESSIONS_CPU_THROTTLED.set(throttled)
+        if fair_share:
+            for cls, n in fair_share.counts().items():
+                FAIR_SHARE_SESSIONS.labels(cls).set(n)
+        return states
+
+    async def reconcile(self, sm):
+        """
+        Startup reconciliation, after a restart of the hub:
+          - sessions whose container is running are reattached, with their address refreshed from the orchestrator
+          - sessions without a running container are relaunched (if "restart") or deleted
+          - containers with CONTAINER_NAME_PREFIX not belonging to a remaining session (orphans) are removed
+        Orchestrator calls run in parallel threads (at most RECONCILE_PARALLELISM at a time) and the reverse proxy is
+        reconfigured once, at the end
+
+        :return: number of sessions by outcome ("reattached", "relaunched", "deleted") and of orphans removed
+        """
+        t0 = time.perf_counter()
+        semaphore = asyncio.Semaphore(reconcile_parallelism)
+
+        async def call(f, *args):
+            async with semaphore:
+                if asyncio.iscoroutinefunction(f):
+                    return await f(*args)
+                return await asyncio.to_thread(f, *args)
+
+        async def reattach_address(s):
+            """ :return: current address of the container of the session, None if it is not running """
+            if s.host:
+                container_orchestrator.assign_container_host(s.container_name, s.host)
+            status = await call(container_orchestrator.get_container_status, s.container_name)
+            if (status or "").lower() != "running":
+                return None
+            return await call(current_address, s.container_name)
+
+        counts = dict(reattached=0, relaunched=0, deleted=0, orphans=0)
+        async with sm() as sess:
+            containers, sessions = await asyncio.gather(
+                call(container_orchestrator.get_tdscontainers, CONTAINER_NAME_PREFIX), all_sessions(sess))
+            addresses = await asyncio.gather(*[reattach_address(s) for s in sessions], return_exceptions=True)
+            unavailable = next((a for a in addresses if isinstance(a, ServiceUnavailable)), None)
+            if unavailable:  # Not a missing container: do not delete any session, reconcile later
+                raise unavailable
+            relaunch = []
+            for s, address in zip(sessions, addresses):
+                if isinstance(address, Exception):
+                    logger.error(f"sessions_checker - could not reattach session {s.user}, left as it is: "
+                                 f"{address!r}")
+                elif address:
+                    logger.info(f"::::::::::::::::: sessions_checker - reattaching session {s.user} to container {s.container_name} in {address}")
+                    s.service_address = address
+                    s.state = "routed"  # Also if the hub stopped while launching it
+                    s.last_activity = datetime.datetime.now()  # Give the user time to come back
+                    counts["reattached"] += 1
+                elif s.restart:
                     logger.info(f"::::::::::::::::: sessions_checker - restarting container for user {s.user}")
-                    await launch_3dslicer_web_container(s)
-                    s.info['CPU_pct'] = ACTIVITY_THRESHOLD + 1
-                    sess.add(s)
+                    relaunch.append(s)
+                    counts["relaunched"] += 1
                 else:
-                    logger.info(f"::::::::::::::::: sessions_checker - deleting session {s.user} because associated container does not exist")
-                    sess.delete(s)
-            else:
-                if s.restart:
-                    logger.info(f"::::::::::::::::: sessions_checker - reassociating session {s.user} with container {s.container_name}")
-                    s.info['CPU_pct'] = ACTIVITY_THRESHOLD + 1
-                    tdslicer_containers.remove(s.container_name)  # Do not delete this container
-                    sess.add(s)
+                    logger.info(f"::::::::::::::::: sessions_checker - deleting session {s.user} because associated container is not running")
+                    await sess.delete(s)
+                    counts["deleted"] += 1
+            for s in relaunch:
+                # Remove what is left of the previous container
+                await call(stop_remove_container, s.container_name, True)
+            results = await asyncio.gather(*[launch_3dslicer_web_container(s) for s in relaunch],
+                                           return_exceptions=True)
+            failed = set()
+            for s, r in zip(relaunch, results):
+                if isinstance(r, Exception):
+                    logger.error(f"sessions_checker - could not restart container for user {s.user}, deleting "
+                                 f"session: {r!r}")
+                    await sess.delete(s)
+                    failed.add(s.uuid)
+                    counts["relaunched"] -= 1
+                    counts["deleted"] += 1
                 else:
-                    logger.info(f"::::::::::::::::: sessions_checker - removing container and session for {s.user}, with container {s.container_name}")
-                    stop_remove_container(s.container_name)
-                    tdslicer_containers.remove(s.container_name)
-                    sess.delete(s)
-            flag_modified(s, "info")
-
-        sess.commit()
-        sess.close()
-        # Update nginx.conf and reread Nginx configuration
-        await refresh_nginx(container_orchestrator, sess, nginx_config_path, domain, tdslicerhub_adress)
+                    s.state = "routed"
+            await sess.commit()
+            # Update nginx.conf and reread Nginx configuration
+            await refresh_nginx(container_orchestrator, sess, nginx_config_path, domain, tdslicerhub_adress)
+            kept = {s.container_name for s, address in zip(sessions, addresses)
+                    if (address or s.restart) and s.uuid not in failed}
 
         # Remove dangling 3dslicer containers managed by 3dslicer-hub
-        for name in tdslicer_containers:
-            if name.startswith(CONTAINER_NAME_PREFIX):
-                logger.info(f"::::::::::::::::: sessions_checker - removing container {name} with no associated session")
-                stop_remove_container(name)
+        orphans = [name for name in containers if name.startswith(CONTAINER_NAME_PREFIX) and name not in kept]
+        for name in orphans:
+            logger.info(f"::::::::::::::::: sessions_checker - removing container {name} with no associated session")
+        results = await asyncio.gather(*[call(stop_remove_container, name, True) for name in orphans],
+                                       return_exceptions=True)
+        for name, r in zip(orphans, results):
+            if isinstance(r, Exception):
+                logger.error(f"sessions_checker - could not remove container {name}: {r!r}")
+        counts["orphans"] = len(orphans)
+        logger.info(f"sessions_checker - reconciliation in {time.perf_counter() - t0:.1f} s: {counts}")
+        return counts
+
+    async def schedule_reservations(self, sm):
+        """
+        Launch the sessions of the reservations starting within RESERVATION_LEAD_SEC (as a bulk provisioning batch)
+        and release the reservations whose window passed
 
-        # After initialization, infinite loop
-        while True:
-            sess = sm()
-            # Loop all sessions, remove those that are not in use
-            for s in sess.query(Session3DSlicer).all():
-                print(f"Session - Name: {s.container_name};\n UUID: {s.uuid};\n User: {s.user}\n")
-                stop = await check_session_activity(s)  # Implicit parameter: "s" (3dslicer session)
-                sess.add(s)
-                if stop:
-                    logger.info(f"::::::::::::::::: sessions_checker - inactivity cleanup - stopping container {s.container_name}")
-                    stop_remove_container(s.container_name)
-                    sess.delete(s)
-                    # Update nginx.conf and reread Nginx configuration
-                    await refresh_nginx(container_orchestrator, sess, nginx_config_path, domain, tdslicerhub_adress)
+        :return: provisioning batches started
+        """
+        now = datetime.datetime.now()
+        batches = []
+        async with sm() as sess:
+            reservations = (await sess.execute(select(Reservation).where(Reservation.state.in_(OPEN_STATES))
+                                               .order_by(Reservation.starts_at))).scalars().all()
+            for r in reservations:
+                if r.ends_at <= now:
+                    logger.info(f"reservations - {r.name or r.id} ended")
+                    await release_reservation(sess, r)
+                elif r.state == "scheduled" and holds_room(r, now, reservation_lead_sec):
+                    users = list(r.users or [])
+                    if r.group:  # Members may have changed since the reservation was created
+                        try:
+                            users = list(dict.fromkeys(users + await resolve_group(r.group)))
+                        except (LookupError, LDAPException, ServiceUnavailable) as e:
+                            logger.error(f"reservations - could not read LDAP group {r.group}: {e!r}")
+                    r.users = users
+                    r.state = "launched"
+                    await sess.commit()
+                    logger.info(f"reservations - {r.name or r.id} starts at {r.starts_at}, "
+                                f"launching {len(users)} sessions")
+                    batch = ProvisionBatch(users, admin=f"reservation {r.name or r.id}", group=r.group)
+                    batches.append(start_provisioning(batch, PROFILES[r.profile]["gpu"], reservation_id=r.id))
+        return batches
 
-            sess.commit()
-            sess.close()
+    async def sessions_checker(self, sm):
+        # ---- sessions_checker ----------------------------------------------------------------------------------------
+        logger.info("::::::::::::::::::::::: Session Checker :::::::::::::::::::::::::::::::::::")
+
+        # Reattach the sessions alive after a restart of the hub, remove the rest
+        while True:
+            try:
+                await self.reconcile(sm)
+                break
+            except ServiceUnavailable as e:
+                logger.error(f"sessions_checker - reconciliation postponed: {e}")
+                await asyncio.sleep(60)
+            except Exception:
+                # Not retried (it would fail again), the loop below must run anyway
+                logger.exception("sessions_checker - reconciliation failed")
+                break
+
+        # After initialization, infinite loop. An error in an iteration must not stop the checker
+        while True:
+            try:
+                await self.schedule_reservations(sm)
+                await self.sweep(sm)  # Nothing is expired when the orchestrator does not answer
+            except ServiceUnavailable as e:
+                logger.error(f"sessions_checker - sweep skipped: {e}")
+            except Exception:
+                logger.exception("sessions_checker - sweep failed")
+
+            # Forget users who left the waiting room page, then admit waiting users if there is room
+            try:
+                for t in waiting_room.expire_abandoned():
+                    logger.info(f"waiting room - ticket of {t.user} abandoned")
+                await admit_waiting_users()
+                launch_jobs.expire_finished()
+            except Exception:
+                logger.exception("sessions_checker - waiting room admission failed")
             await asyncio.sleep(60)
 
 
@@ -608,6 +1814,13 @@ runner = BackgroundRunner()
 
 @app.on_event("startup")
 async def startup():
+    if informer_enabled:
+        base_names = [nginx_container_name] if nginx_container_name else []
+        for informer in container_orchestrator.create_informers(CONTAINER_NAME_PREFIX, base_names,
+                                                                resync_period=informer_resync_sec):
+            instrument_informer(informer).start()
+    if shared_cache_enabled:
+        asyncio.create_task(ensure_shared_cache())  # Before the first launch, if possible
     asyncio.create_task(runner.sessions_checker(orm_session_maker))
 
 
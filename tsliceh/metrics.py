@@ -0,0 +1,207 @@
+"""
+Prometheus metrics of the hub, exposed in "/metrics"
+"""
+import functools
+import inspect
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+
+from tsliceh.orchestrators import decorate_orchestrator
+from tsliceh.resilience import STATES
+
+# Buckets (seconds) for operations going from milliseconds (DB, kubectl) to minutes (image pulls, container start)
+_OPERATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Login
+LOGIN_SECONDS = Histogram("tsliceh_login_seconds",
+                          "Total time of a login, from the POST to the redirection to the session page",
+                          ["outcome"], buckets=_OPERATION_BUCKETS)
+LOGIN_PHASE_SECONDS = Histogram("tsliceh_login_phase_seconds",
+                                "Time spent in each phase of a login (ldap_auth, capacity_check, image_check, "
+                                "volume_provisioning, shared_cache, dataset_cache, container_start, readiness, "
+                                "proxy_reload)",
+                                ["phase"], buckets=_OPERATION_BUCKETS)
+
+# Session containers
+TIME_TO_RUNNING = Histogram("tsliceh_container_time_to_running_seconds",
+                            "Time from the launch of a session container until the orchestrator reports it running",
+                            buckets=_OPERATION_BUCKETS)
+TIME_TO_USABLE = Histogram("tsliceh_container_time_to_usable_seconds",
+                           "Time from the launch of a session container until its KasmVNC HTTP and websocket "
+                           "endpoints answer (readiness probe)", buckets=_OPERATION_BUCKETS)
+LAUNCHES_IN_PROGRESS = Gauge("tsliceh_launches_in_progress",
+                             "Session launches running in background (see tsliceh.launch_jobs)")
+READINESS_TIMEOUTS = Counter("tsliceh_readiness_timeouts",
+                             "Session containers not usable before READINESS_DEADLINE_SEC (users redirected anyway)")
+
+# Shared extensions and packages cache (see tsliceh.volumes)
+SHARED_CACHE_POPULATE_SECONDS = Histogram("tsliceh_shared_cache_populate_seconds",
+                                          "Time to populate (or check) the shared cache of an image version, once "
+                                          "per run of the hub", buckets=_OPERATION_BUCKETS)
+SHARED_CACHE_POPULATIONS = Counter("tsliceh_shared_cache_populations",
+                                   "Populations of the shared cache of an image version, by outcome", ["outcome"])
+
+# Node-local datasets cache (see tsliceh.dataset_cache)
+DATASET_CACHE_REQUESTS = Counter("tsliceh_dataset_cache_requests",
+                                 "Datasets requested to the cache of a node when a session starts, by result "
+                                 "(hit, miss, missing)", ["node", "result"])
+DATASET_CACHE_EVICTIONS = Counter("tsliceh_dataset_cache_evictions",
+                                  "Datasets evicted from the cache of a node (least recently used)", ["node"])
+DATASET_CACHE_BYTES = Gauge("tsliceh_dataset_cache_bytes",
+                            "Size of the datasets cache of a node, as of its last fill", ["node"])
+
+# Waiting room
+QUEUE_DEPTH = Gauge("tsliceh_waiting_room_depth",
+                    "Number of users in the waiting room")
+QUEUE_WAIT_SECONDS = Histogram("tsliceh_waiting_room_wait_seconds",
+                               "Time spent in the waiting room until a session is assigned",
+                               buckets=(5, 15, 30, 60, 120, 300, 600, 900, 1800, 3600))
+
+# Sessions checker
+CHECKER_SWEEP_SECONDS = Histogram("tsliceh_checker_sweep_seconds",
+                                  "Duration of a sessions checker sweep over all the sessions",
+                                  buckets=_OPERATION_BUCKETS)
+SESSIONS = Gauge("tsliceh_sessions",
+                 "Sessions by state, as seen in the last sessions checker sweep", ["state"])
+SESSIONS_CPU_THROTTLED = Gauge("tsliceh_sessions_cpu_throttled",
+                               "Idle sessions running with a reduced CPU allowance, at the last sweep")
+FAIR_SHARE_SESSIONS = Gauge("tsliceh_fair_share_sessions",
+                            "Sessions by fair-share class (interactive, normal, batch), at the last sweep", ["cls"])
+SESSIONS_EXPIRED = Counter("tsliceh_sessions_expired",
+                           "Sessions stopped by the sessions checker because of inactivity")
+
+# Container orchestrator
+ORCHESTRATOR_CALLS = Counter("tsliceh_orchestrator_calls",
+                             "Calls to the container orchestrator", ["orchestrator", "method", "outcome"])
+ORCHESTRATOR_CALL_SECONDS = Histogram("tsliceh_orchestrator_call_seconds",
+                                      "Latency of the calls to the container orchestrator",
+                                      ["orchestrator", "method"], buckets=_OPERATION_BUCKETS)
+
+# Informers (local caches of the containers)
+INFORMER_OBJECTS = Gauge("tsliceh_informer_objects",
+                         "Objects in the cache of an informer", ["informer"])
+INFORMER_STALENESS_SECONDS = Gauge("tsliceh_informer_staleness_seconds",
+                                   "Seconds since the cache of an informer was last confirmed by a list or an event",
+                                   ["informer"])
+INFORMER_RESYNCS = Counter("tsliceh_informer_resyncs",
+                           "Lists of an informer (initial, periodic, after a watch disconnection or an error)",
+                           ["informer", "reason"])
+INFORMER_EVENTS = Counter("tsliceh_informer_events",
+                          "Watch events applied to the cache of an informer", ["informer", "type"])
+
+# Circuit breakers and deadlines (see "tsliceh.resilience")
+CIRCUIT_BREAKER_STATE = Gauge("tsliceh_circuit_breaker_state",
+                              "State of the circuit breaker of a service: 0 closed, 1 half open, 2 open", ["breaker"])
+DEADLINES_EXCEEDED = Counter("tsliceh_deadlines_exceeded",
+                             "Calls to a service which did not finish in time", ["breaker", "operation"])
+
+# Database
+DB_QUERY_SECONDS = Histogram("tsliceh_db_query_seconds",
+                             "Latency of the SQL statements, by statement type", ["statement"],
+                             buckets=_OPERATION_BUCKETS)
+DB_CONNECTIONS_IN_USE = Gauge("tsliceh_db_connections_in_use",
+                              "Database connections checked out of the pool (held by an ORM session)")
+
+
+def instrument_orchestrator(co):
+    """
+    Count and time every call to the public methods of a container orchestrator
+
+    :param co: IContainerOrchestrator instance, modified in place
+    :return: the same orchestrator
+    """
+    orchestrator = type(co).__name__
+
+    def decorator(method, fn):
+        def observe(t0, outcome):
+            ORCHESTRATOR_CALLS.labels(orchestrator, method, outcome).inc()
+            ORCHESTRATOR_CALL_SECONDS.labels(orchestrator, method).observe(time.perf_counter() - t0)
+
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                t0 = time.perf_counter()
+                try:
+                    r = await fn(*args, **kwargs)
+                except Exception:
+                    observe(t0, "error")
+                    raise
+                observe(t0, "ok")
+                return r
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                t0 = time.perf_counter()
+                try:
+                    r = fn(*args, **kwargs)
+                except Exception:
+                    observe(t0, "error")
+                    raise
+                observe(t0, "ok")
+                return r
+        return wrapper
+
+    return decorate_orchestrator(co, decorator)
+
+
+def instrument_informer(informer):
+    """
+    Export the size, staleness, resyncs and events of an informer (before starting it, to count the initial list)
+    """
+    INFORMER_OBJECTS.labels(informer.name).set_function(lambda: len(informer))
+    INFORMER_STALENESS_SECONDS.labels(informer.name).set_function(informer.staleness)
+    informer.on_resync.append(lambda reason: INFORMER_RESYNCS.labels(informer.name, reason).inc())
+    informer.on_event.append(lambda type_: INFORMER_EVENTS.labels(informer.name, type_).inc())
+    return informer
+
+
+def instrument_breaker(breaker):
+    """ Export the state of a circuit breaker and the deadlines missed by the calls through it """
+    CIRCUIT_BREAKER_STATE.labels(breaker.name).set_function(lambda: STATES.index(breaker.state))
+    breaker.on_timeout.append(lambda operation: DEADLINES_EXCEEDED.labels(breaker.name, operation).inc())
+    return breaker
+
+
+def record_dataset_cache(report):
+    """ Statistics of a fill of the datasets cache of a node (see "DatasetCache.fill") """
+    node = report.get("node", "")
+    for result, key in (("hit", "hits"), ("miss", "misses"), ("missing", "missing")):
+        DATASET_CACHE_REQUESTS.labels(node, result).inc(len(report.get(key, [])))
+    DATASET_CACHE_EVICTIONS.labels(node).inc(len(report.get("evicted", [])))
+    DATASET_CACHE_BYTES.labels(node).set(report.get("bytes", 0))
+
+
+def instrument_engine(engine_):
+    """
+    Time every SQL statement executed through a SQLAlchemy engine (synchronous or asynchronous), and count the
+    connections in use
+    """
+    target = getattr(engine_, "sync_engine", engine_)
+
+    @event.listens_for(target, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_CONNECTIONS_IN_USE.inc()
+
+    @event.listens_for(target, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        DB_CONNECTIONS_IN_USE.dec()
+
+    @event.listens_for(target, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("tsliceh_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(target, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        t0 = conn.info["tsliceh_query_start"].pop()
+        stmt = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "UNKNOWN"
+        DB_QUERY_SECONDS.labels(stmt).observe(time.perf_counter() - t0)
+
+    @event.listens_for(target, "handle_error")
+    def handle_error(context):
+        # "after_cursor_execute" is not called for failed statements
+        if context.connection is not None and context.connection.info.get("tsliceh_query_start"):
+            context.connection.info["tsliceh_query_start"].pop()
+
+    return engine_
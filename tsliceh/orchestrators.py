@@ -1,27 +1,87 @@
 import abc
 import asyncio
+import contextvars
 import json
 import os
+import random
 import re
 import subprocess
 import tempfile
 import textwrap
+import threading
+import time
+import urllib.parse
 from time import sleep
 from io import StringIO
 
 import docker
+import requests
 import yaml
 from docker.errors import APIError
 from python_on_whales import docker as docker_ow
 import pandas as pd
 from fastapi.logger import logger
 
+from tsliceh.informer import Informer, DockerSource, KubernetesSource
+from tsliceh.readiness import probe_session
+from tsliceh.resilience import ServiceUnavailable, DeadlineExceeded, retry_call
+from tsliceh.tracing import tracer
+
 
 # import kubernetes
 # from kubernetes import client, config
 
 
+def docker_timeout_sec():
+    """ Deadline of a request to a Docker daemon (DOCKER_TIMEOUT_SEC) """
+    return int(os.getenv("DOCKER_TIMEOUT_SEC", default=60))
+
+
+# Errors of the Docker API client meaning the daemon did not answer
+DOCKER_UNREACHABLE = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+def docker_client():
+    """ Client of the local Docker daemon. ServiceUnavailable if it does not answer """
+    try:
+        return docker.from_env(timeout=docker_timeout_sec())
+    except docker.errors.DockerException as e:
+        if isinstance(e.__context__, DOCKER_UNREACHABLE):
+            raise ServiceUnavailable(f"Docker daemon unreachable: {e}") from e
+        raise
+
+
+def kubectl_timeout_sec():
+    """ Deadline of a kubectl command (KUBECTL_TIMEOUT_SEC) """
+    return float(os.getenv("KUBECTL_TIMEOUT_SEC", default=30))
+
+
+# Statuses of a pod (lowercase) which will not become running by waiting
+POD_FAILED_STATUSES = ("crashloopbackoff", "errimagepull", "imagepullbackoff", "invalidimagename",
+                       "createcontainerconfigerror", "createcontainererror", "runcontainererror", "error", "failed")
+
+# Errors of kubectl (stderr, lowercase) meaning the API server did not answer
+KUBECTL_UNREACHABLE = ("unable to connect to the server", "connection refused", "i/o timeout",
+                       "tls handshake timeout", "the server is currently unable to handle the request",
+                       "context deadline exceeded", "no route to host")
+
+
 class IContainerOrchestrator(abc.ABC):
+    relaunches_containers = False  # "relaunch_container" is implemented (a node can be drained)
+
+    def create_informers(self, prefix, names=(), resync_period=300.0):
+        """
+        Informers (not started) caching the containers whose name starts with "prefix" (and the containers in
+        "names"), used by the read methods (status, IP, list) instead of querying the orchestrator each time
+
+        :return: list of tsliceh.informer.Informer; empty if the orchestrator does not use a cache
+        """
+        return []
+
+    @staticmethod
+    def _lookup(informer, name):
+        return informer.lookup(name) if informer is not None else None
+
     @abc.abstractmethod
     def get_valid_name(self, name):
         pass
@@ -46,10 +106,24 @@ class IContainerOrchestrator(abc.ABC):
     def get_container_activity(self, container_name):
         pass
 
+    @abc.abstractmethod
+    def get_container_network_io(self, container_name):
+        """ Cumulative (rx_bytes, tx_bytes) of the container network interfaces, None if not available """
+        pass
+
     @abc.abstractmethod
     def get_container_ip(self, name_id, network_id):
         pass
 
+    def get_service_address(self, container_name):
+        """
+        Stable address of a container, which does not change if the container is moved or recreated by the
+        orchestrator (e.g. a Kubernetes Service in front of the pod)
+
+        :return: IP, or None if the orchestrator has no such address (use "get_container_ip")
+        """
+        return None
+
     @abc.abstractmethod
     def get_container_port(self, name_id):
         pass
@@ -60,15 +134,128 @@ class IContainerOrchestrator(abc.ABC):
 
     @abc.abstractmethod
     async def start_container(self, container_name, image_name, image_tag,
-                              network_id, vol_dict, uid, wait_until_running=None, use_gpu = False):  # "run" also
+                              network_id, vol_dict, uid, wait_until_running=None, use_gpu = False,
+                              scratch=None, env=None):  # "run" also
+        """
+        :param scratch: (path, size in MiB) of a memory-backed scratch filesystem (tmpfs) for the session, or None
+        :param env: environment variables of the session (e.g. to use the shared cache), besides those of the image
+        """
         pass
 
+    def get_scratch_usage(self, container_name, path):
+        """ Bytes used in the scratch filesystem of a container, None if not available """
+        return None
+
+    def get_session_port(self, name_id):
+        """ Port where the reverse proxy reaches the KasmVNC of a session container """
+        return 6901
+
+    def set_cpu_limit(self, container_name, cpus):
+        """
+        Change the CPU allowance of a running container, without restarting it (idle sessions, see
+        "tsliceh.activity.cpu_allowance")
+
+        :param cpus: CPUs, None for the full allowance of a session
+        :return: True if it was changed, False if the orchestrator does not support it or it failed
+        """
+        return False
+
+    def set_cpu_weight(self, container_name, weight):
+        """
+        Change the CPU share of a running container, relative to a default one (see "tsliceh.fair_share")
+
+        :return: True if it was changed, False if the orchestrator does not support it or it failed
+        """
+        return False
+
+    def get_container_host(self, container_name):
+        """ Host (of several, see "DockerHosts") running a container. None if the orchestrator does not place them """
+        return None
+
+    def containers_on_node(self, node):
+        """ Names of the session containers running in a node. None if the orchestrator has no nodes """
+        return None
+
+    def cordon_node(self, node, cordon=True):
+        """
+        Stop (or resume, if not "cordon") placing new containers in a node
+
+        :return: True if done, False if the orchestrator has no nodes or it failed
+        """
+        return False
+
+    async def relaunch_container(self, container_name, image_name, image_tag, network_id, vol_dict, uid,
+                                 use_gpu=False, scratch=None, avoid_nodes=(), env=None):
+        """
+        Replace the container of a session by a new one, with the same name and volumes, in a node not in
+        "avoid_nodes" (see "tsliceh.drain"). Returns when the new container is running; raises if it could not be
+        relaunched (the old container is left running). Orchestrators with "relaunches_containers" False refuse it
+        """
+        raise RuntimeError(f"cannot relaunch {container_name}: {type(self).__name__} cannot relaunch containers in "
+                           f"another node (drain refused)")
+
+    def assign_container_host(self, container_name, host):
+        """ Host of a container known by the hub (e.g. recorded with its session), so it is not searched for """
+        pass
+
+    async def probe_readiness(self, address):
+        """
+        Whether the session served by a container is usable (KasmVNC HTTP and websocket endpoints answer), see
+        "tsliceh.readiness"
+
+        :param address: "ip:port" of the container, as used by the reverse proxy
+        """
+        return await probe_session(address)
+
+    def shared_cache_source(self, version):
+        """
+        Volume (or directory of the nodes, starting with "/") with the shared extensions and packages cache of an
+        image version (see "tsliceh.volumes.shared_cache_populate_script")
+        """
+        return f"slicer-shared-{version}"
+
+    def populate_shared_cache(self, source, image_name, image_tag, mount, script):
+        """
+        Run a container of the image once, with the shared cache mounted read-write at "mount", executing "script"
+        (which does nothing if the cache is already populated). Blocking until it finishes; raises if it fails
+        """
+        pass
+
+    dataset_cache = None  # Node-local cache of the shared datasets, see "configure_dataset_cache"
+    datasets = ()
+    dataset_cache_image = None
+
+    def configure_dataset_cache(self, cache, datasets, image=None):
+        """
+        Cache the shared datasets in a local disk of the nodes running the sessions (see "tsliceh.dataset_cache")
+
+        :param cache: DatasetCache, with host paths
+        :param datasets: names of the datasets brought into the cache for every session
+        :param image: image with "tsliceh", to fill the cache from the node of a session (Kubernetes)
+        """
+        self.dataset_cache = cache
+        self.datasets = list(datasets)
+        self.dataset_cache_image = image
+
+    def fill_dataset_cache(self, container_name):
+        """
+        Bring the datasets into the cache, before starting the container of a session. By default the hub and the
+        containers share the host (and its directories), so the hub fills it
+
+        :return: report (see "DatasetCache.fill"), None if the cache is not filled by the hub
+        """
+        return self.dataset_cache.fill(self.datasets) if self.dataset_cache else None
+
+    def dataset_cache_report(self, container_name):
+        """ Report of the cache filled in the node of a (running) container. None if not available """
+        return None
+
     @abc.abstractmethod
     def stop_container(self, container_name):
         pass
 
     @abc.abstractmethod
-    def remove_container(self, container_name):
+    def remove_container(self, container_name, force=False):
         pass
 
     @abc.abstractmethod
@@ -91,15 +278,26 @@ class IContainerOrchestrator(abc.ABC):
 class DockerCompose(IContainerOrchestrator):
     def __init__(self, compose_file=None):
         self.compose_file = compose_file
+        self._informer = None
+
+    def create_informers(self, prefix, names=(), resync_period=300.0):
+        self._informer = Informer("docker", DockerSource(prefix, names), resync_period)
+        return [self._informer]
+
+    def _forget(self, name):
+        if self._informer is not None:
+            self._informer.forget(name)
 
     def get_valid_name(self, name):
         return name
 
     def get_tdscontainers(self, prefix=""):
-        dc = docker.from_env()
+        if self._informer is not None and self._informer.synced and prefix.startswith(self._informer.source.prefix):
+            return self._informer.names(prefix)
+        dc = docker_client()
         try:
             return [c.name for c in dc.containers.list(all) if c.name.startswith(prefix)]
-        except Exception as e:
+        except docker.errors.APIError as e:
             logger.info(f"::::::::::::::::: sessions_checker - EXCEPTION no containers. {e}")
             return None
 
@@ -113,57 +311,121 @@ class DockerCompose(IContainerOrchestrator):
         remove_volume(volume_name)
 
     def get_container_activity(self, container_name):
-        return docker_container_pct_activity(container_name)
+        c = self._lookup(self._informer, container_name)
+        return docker_container_pct_activity(container_name, c.resource_name if c else None)
+
+    def get_container_network_io(self, container_name):
+        return docker_container_network_io(container_name)
 
     def get_container_ip(self, name_id, network_id):
+        c = self._lookup(self._informer, name_id)
+        if c is not None and c.status == "running" and c.ips.get(network_id):
+            return c.ips[network_id]
         return get_container_ip(name_id, network_id)
 
     def get_container_port(self, name_id):
         return get_container_port(name_id)
 
     def get_container_status(self, name_id):
-        return containers_status(name_id)
+        c = self._lookup(self._informer, name_id)
+        return c.status if c is not None else containers_status(name_id)
 
     def get_container_stats(self, container_name):
         return container_stats(container_name)
 
     async def start_container(self, container_name, image_name, image_tag,
                               network_id, vol_dict,
-                              uid=None, wait_until_running=True, use_gpu = False):  # "run" also
-        dc = docker.from_env()
-        active = False
-        c = dc.containers.run(image=f"{image_name}:{image_tag}",
-                              environment={"VNC_DISABLE_AUTH":"true"},
-                              # ports={"6901/tcp": None},
-                              name=container_name,
-                              network=network_id,
-                              volumes=vol_dict,
-                              detach=True,
-                              user="root",
-                              shm_size="512m")
-        container_id = c.id
+                              uid=None, wait_until_running=True, use_gpu = False, scratch=None, env=None):  # "run" also
+        dc = docker_client()
+        c = await asyncio.to_thread(self._run_session_container, dc, container_name, image_name, image_tag,
+                                    network_id, vol_dict, scratch, env=env)
+        self._forget(container_name)
         if wait_until_running:
-            while not active:
-                # TODO mejorar: crear funcion check_state
-                await asyncio.sleep(3)
-                c = dc.containers.get(container_id)
-                if c.status == "running":
-                    active = True
-                if c.status == "exited":
-                    logger.info("container exited")
-                    break
+            c = await self._wait_until_running(dc, c.id)
         return c
 
+    @staticmethod
+    def _run_session_container(dc, container_name, image_name, image_tag, network_id, vol_dict, scratch,
+                               ports=None, labels=None, command_prefix="docker", env=None):
+        tmpfs = {scratch[0]: f"size={scratch[1]}m,mode=1777"} if scratch else None
+        with tracer.child_span("docker", command=f"{command_prefix} run --name {container_name} {image_name}:{image_tag}"):
+            return dc.containers.run(image=f"{image_name}:{image_tag}",
+                                     environment={"VNC_DISABLE_AUTH":"true", **(env or {})},
+                                     ports=ports,
+                                     labels=labels,
+                                     name=container_name,
+                                     network=network_id,
+                                     volumes=vol_dict,
+                                     detach=True,
+                                     user="root",
+                                     tmpfs=tmpfs,
+                                     shm_size="512m")
+
+    @staticmethod
+    async def _wait_until_running(dc, container_id):
+        """ :return: the container once it is running (or it exited) """
+        iteration = 0
+        while True:
+            # TODO mejorar: crear funcion check_state
+            await asyncio.sleep(3)
+            iteration += 1
+            with tracer.child_span("start_container.poll", iteration=iteration,
+                                   command=f"docker inspect {container_id}") as sp:
+                c = await asyncio.to_thread(dc.containers.get, container_id)
+                sp.set_attribute("status", c.status)
+            if c.status == "running":
+                return c
+            if c.status == "exited":
+                logger.info("container exited")
+                return c
+
+    def get_scratch_usage(self, container_name, path):
+        dc = docker_client()
+        try:
+            with tracer.child_span("docker", command=f"docker exec {container_name} df -Pk {path}"):
+                code, output = dc.containers.get(container_name).exec_run(["df", "-Pk", path])
+        except docker.errors.APIError:
+            return None
+        return df_used_bytes(output.decode(errors="replace")) if code == 0 else None
+
+    def set_cpu_limit(self, container_name, cpus):
+        dc = docker_client()
+        try:
+            c = dc.containers.get(container_name)
+        except docker.errors.APIError:
+            return False
+        return docker_set_cpu_limit(c, cpus)
+
+    def set_cpu_weight(self, container_name, weight):
+        dc = docker_client()
+        try:
+            c = dc.containers.get(container_name)
+        except docker.errors.APIError:
+            return False
+        return docker_set_cpu_weight(c, weight)
+
+    def populate_shared_cache(self, source, image_name, image_tag, mount, script):
+        dc = docker_client()
+        with tracer.child_span("docker", command=f"docker run --rm -v {source}:{mount} {image_name}:{image_tag}"):
+            dc.containers.run(image=f"{image_name}:{image_tag}",
+                              entrypoint=["/bin/sh", "-c"],
+                              command=[script],
+                              volumes={source: {"bind": mount, "mode": "rw"}},
+                              user="root",
+                              remove=True)
+
     def stop_container(self, name):
         """
 
         :param name:
         :return: True if the container exists and it is stopped. False if the container exists but it could not be stopped. None if the container does not exist
         """
-        dc = docker.from_env()
+        dc = docker_client()
         try:
             c = dc.containers.get(name)
+            stopped = None
             can_remove = False
+            self._forget(name)
             status = self.get_container_status(name)
             if status:
                 if status == "running":
@@ -171,23 +433,24 @@ class DockerCompose(IContainerOrchestrator):
                         c.stop()
                         c.reload()
                         can_remove = True
-                    except:
+                    except docker.errors.APIError:
                         stopped = False
                         can_remove = False
                         print(f"can't stop container {name}")
             if c.status == "exited" or can_remove:
                 stopped = True
-        except:
+        except docker.errors.NotFound:
             logger.info(f"{name} container already removed")
             stopped = None
 
         return stopped
 
     def remove_container(self, name, force=False):
-        dc = docker.from_env()
+        dc = docker_client()
         try:
             c = dc.containers.get(name)
             c.remove(force=force)
+            self._forget(name)
             status = self.get_container_status(name)
             if not status:
                 logger.info(f"container {name} : removed")
@@ -195,19 +458,23 @@ class DockerCompose(IContainerOrchestrator):
             else:
                 logger.info(f"can't remove {name}")
                 removed = False
-        except:
+        except docker.errors.NotFound:
             logger.info(f"{name} container already removed")
             removed = None
+        except docker.errors.APIError as e:
+            logger.info(f"can't remove {name}: {e}")
+            removed = False
         return removed
 
     def create_image(self, image_name, image_tag):
         create_image(image_name, image_tag)
 
     def execute_cmd_in_nginx_container(self, container_name, cmd):
-        dc = docker.from_env()
+        dc = docker_client()
         nginx = dc.containers.get(container_name)
         try:
-            r = nginx.exec_run(cmd)
+            with tracer.child_span("docker", command=f"docker exec {container_name} {cmd}"):
+                r = nginx.exec_run(cmd)
             return r
         except docker.errors.APIError as e:
             return None
@@ -216,6 +483,337 @@ class DockerCompose(IContainerOrchestrator):
         docker_compose_up()
 
 
+class DockerHosts(DockerCompose):
+    """
+    Sessions spread over several Docker hosts (daemons reached by socket, TCP or SSH, see "parse_docker_hosts").
+    Each new session is placed on the least loaded host (see "choose_docker_host"), among the hosts which already have
+    its volumes if any (the data of a user stays in a host). The host of each container is remembered, and recorded
+    with its session, so the calls about the container go to its daemon.
+
+    The containers of the local host (socket) join the network of the hub and are reached by their IP. The ones of
+    remote hosts publish the KasmVNC port, reached at the address of their host. The hub, the reverse proxy and the
+    other base containers stay in the local Docker (DockerCompose), and so does the node-local dataset cache, filled by
+    the hub.
+    """
+    session_label = "tsliceh.session"
+
+    def __init__(self, hosts, max_pool_size=10):
+        """
+        :param hosts: dictionary host name -> Docker daemon URL
+        :param max_pool_size: connections kept open to each daemon
+        """
+        super().__init__()
+        self.hosts = dict(hosts)
+        self.max_pool_size = max_pool_size
+        self._clients = dict()  # Host -> DockerClient, see "client"
+        self._clients_lock = threading.Lock()
+        self._place_lock = threading.Lock()  # See "_place_and_run"
+        self._placement = dict()  # Container name -> host
+        self._names = dict()  # Container id -> name
+        self._cpus = dict()  # Host -> number of CPUs
+        self._cpu_used = dict()  # Container name -> last CPU sample (percent), see "get_container_activity"
+        self.cordoned = set()  # Hosts not receiving new sessions, see "cordon_node"
+
+    def create_informers(self, prefix, names=(), resync_period=300.0):
+        return []
+
+    def client(self, host):
+        """ Client of the daemon of a host (with its pool of connections), created on first use """
+        with self._clients_lock:
+            dc = self._clients.get(host)
+            if dc is None:
+                dc = docker.DockerClient(base_url=self.hosts[host], max_pool_size=self.max_pool_size,
+                                         timeout=docker_timeout_sec())
+                self._clients[host] = dc
+        return dc
+
+    def is_remote(self, host):
+        return docker_host_address(self.hosts[host]) is not None
+
+    def _remember(self, c, host):
+        self._placement[c.name] = host
+        self._names[c.id] = c.name
+
+    def _forget_container(self, name):
+        self._placement.pop(name, None)
+        self._cpu_used.pop(name, None)
+        for id_ in [id_ for id_, n in self._names.items() if n == name]:
+            del self._names[id_]
+
+    def get_container_host(self, container_name):
+        return self._placement.get(self._names.get(container_name, container_name))
+
+    def assign_container_host(self, container_name, host):
+        if host in self.hosts:
+            self._placement[container_name] = host
+
+    def _container(self, name_id):
+        """
+        Container (name or id) and its host, searched in all the hosts if not known
+
+        :return: (container, host); (None, None) if it is in none of the hosts
+        """
+        name = self._names.get(name_id, name_id)
+        host = self._placement.get(name)
+        unreachable = None
+        for h in [host] if host else self.hosts:
+            try:
+                c = self.client(h).containers.get(name_id)
+            except docker.errors.NotFound:
+                if host:
+                    self._forget_container(name)
+                continue
+            except DOCKER_UNREACHABLE as e:
+                unreachable = e
+                continue
+            except Exception as e:
+                logger.warning(f"docker host {h} - could not get container {name_id}: {e!r}")
+                continue
+            self._remember(c, h)
+            return c, h
+        if unreachable is not None:  # It may be in a host not answering, it is not known to be gone
+            raise ServiceUnavailable(f"Docker host unreachable: {unreachable}") from unreachable
+        return None, None
+
+    def host_loads(self):
+        """
+        Load of the reachable hosts. The CPU used by the sessions is the sum of their last samples (taken by the
+        sessions checker), so placing a session does not wait for "docker stats"
+
+        :return: dictionary host -> (running sessions, CPUs, CPU used by the sessions in percent of one CPU)
+        """
+        loads = dict()
+        for h in self.hosts:
+            if h in self.cordoned:
+                continue
+            try:
+                dc = self.client(h)
+                running = dc.containers.list(filters={"label": self.session_label, "status": "running"})
+                if h not in self._cpus:
+                    self._cpus[h] = dc.info()["NCPU"]
+            except Exception as e:
+                logger.warning(f"docker host {h} not available: {e!r}")
+                continue
+            for c in running:
+                self._remember(c, h)
+            loads[h] = (len(running), self._cpus[h], sum(self._cpu_used.get(c.name, 0) for c in running))
+        return loads
+
+    def _hosts_with_volumes(self, hosts, vol_dict):
+        """ Hosts, of "hosts", having all the named volumes of a session """
+        names = [v for v in (vol_dict or {}) if not v.startswith("/")]
+        if not names:
+            return []
+        _ = []
+        for h in hosts:
+            try:
+                for name in names:
+                    self.client(h).volumes.get(name)
+            except Exception:
+                continue
+            _.append(h)
+        return _
+
+    def _place_and_run(self, container_name, image_name, image_tag, network_id, vol_dict, scratch, env=None):
+        """ Place a session and create its container (one at a time, so each placement sees the previous ones) """
+        with self._place_lock:
+            host = self.place(vol_dict)
+            if host is None:
+                raise APIError("No Docker host available")
+            dc = self.client(host)
+            remote = self.is_remote(host)
+            logger.info(f"docker hosts - placing {container_name} in {host}")
+            if remote and self.dataset_cache and self.dataset_cache.cache_dir in (vol_dict or {}):
+                # The dataset cache is a directory of the local host, filled by the hub: not in the other hosts
+                logger.info(f"docker hosts - {container_name} in {host}, without the dataset cache")
+                vol_dict = {k: v for k, v in vol_dict.items() if k != self.dataset_cache.cache_dir}
+            c = self._run_session_container(dc, container_name, image_name, image_tag,
+                                            None if remote else network_id, vol_dict, scratch,
+                                            ports={"6901/tcp": None} if remote else None,
+                                            labels={self.session_label: "true"},
+                                            command_prefix=f"docker -H {self.hosts[host]}", env=env)
+            self._remember(c, host)
+        return host, c
+
+    def place(self, vol_dict=None):
+        """ :return: host for a new session, None if no host is available """
+        loads = self.host_loads()
+        sticky = self._hosts_with_volumes(list(loads), vol_dict)
+        return choose_docker_host({h: loads[h] for h in sticky} if sticky else loads)
+
+    def containers_on_node(self, node):
+        if node not in self.hosts:
+            return []
+        containers = self.client(node).containers.list(filters={"label": self.session_label, "status": "running"})
+        for c in containers:
+            self._remember(c, node)
+        return [c.name for c in containers]
+
+    def cordon_node(self, node, cordon=True):
+        if node not in self.hosts:
+            return False
+        if cordon:
+            self.cordoned.add(node)
+        else:
+            self.cordoned.discard(node)
+        return True
+
+    # "relaunch_container" not supported: the volumes of a session are in its host
+
+    def get_tdscontainers(self, prefix=""):
+        names = []
+        for h in self.hosts:
+            try:
+                containers = self.client(h).containers.list(all=True)
+            except Exception as e:
+                logger.warning(f"docker host {h} not available: {e!r}")
+                continue
+            for c in containers:
+                if c.name.startswith(prefix):
+                    self._remember(c, h)
+                    names.append(c.name)
+        return names
+
+    def create_volume(self, name, type_):
+        pass  # Created by "docker run", in the host of the container
+
+    def remove_volume(self, volume_name):
+        for h in self.hosts:
+            try:
+                self.client(h).volumes.get(volume_name).remove()
+            except Exception:
+                pass
+
+    def get_container_activity(self, container_name):
+        from tsliceh.helpers import calculate_cpu_percent
+        c, h = self._container(container_name)
+        if c is None:
+            return -1
+        try:
+            with tracer.child_span("docker", command=f"docker -H {self.hosts[h]} stats --no-stream {container_name}"):
+                pct = calculate_cpu_percent(c.stats(stream=False))
+        except (docker.errors.NotFound, KeyError):  # Removed, or not running
+            return -1
+        self._cpu_used[c.name] = pct
+        return pct
+
+    def get_container_network_io(self, container_name):
+        c, h = self._container(container_name)
+        if c is None:
+            return None
+        try:
+            networks = c.stats(stream=False).get("networks", {}).values()
+            return sum(n["rx_bytes"] for n in networks), sum(n["tx_bytes"] for n in networks)
+        except (docker.errors.NotFound, KeyError):
+            return None
+
+    def get_container_ip(self, name_id, network_id):
+        c, h = self._container(name_id)
+        if c is None:
+            return super().get_container_ip(name_id, network_id)  # Base containers, in the local Docker
+        if self.is_remote(h):
+            return docker_host_address(self.hosts[h])
+        try:
+            network = self.client(h).networks.get(network_id)
+            return c.attrs["NetworkSettings"]["Networks"][network.name]["IPAddress"]
+        except (docker.errors.NotFound, KeyError):
+            return ""
+
+    def get_session_port(self, name_id):
+        c, h = self._container(name_id)
+        if c is None or not self.is_remote(h):
+            return super().get_session_port(name_id)
+        try:
+            return int(c.ports["6901/tcp"][0]["HostPort"])
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    def get_container_status(self, name_id):
+        c, h = self._container(name_id)
+        return c.status if c is not None else None
+
+    def get_container_stats(self, container_name):
+        c, h = self._container(container_name)
+        return c.stats(stream=False) if c is not None else None
+
+    async def start_container(self, container_name, image_name, image_tag,
+                              network_id=None, vol_dict=None, uid=None, wait_until_running=True, use_gpu=False,
+                              scratch=None, env=None):
+        host, c = await asyncio.to_thread(self._place_and_run, container_name, image_name, image_tag, network_id,
+                                          vol_dict, scratch, env)
+        dc = self.client(host)
+        if wait_until_running:
+            c = await self._wait_until_running(dc, c.id)
+        return c
+
+    def get_scratch_usage(self, container_name, path):
+        c, h = self._container(container_name)
+        if c is None:
+            return None
+        try:
+            code, output = c.exec_run(["df", "-Pk", path])
+        except docker.errors.APIError:  # Removed, or not running
+            return None
+        return df_used_bytes(output.decode(errors="replace")) if code == 0 else None
+
+    def set_cpu_limit(self, container_name, cpus):
+        c, h = self._container(container_name)
+        return docker_set_cpu_limit(c, cpus) if c is not None else False
+
+    def set_cpu_weight(self, container_name, weight):
+        c, h = self._container(container_name)
+        return docker_set_cpu_weight(c, weight) if c is not None else False
+
+    def populate_shared_cache(self, source, image_name, image_tag, mount, script):
+        # A copy of the cache in each host
+        for h in self.hosts:
+            with tracer.child_span("docker", command=f"docker -H {self.hosts[h]} run --rm -v {source}:{mount} "
+                                                     f"{image_name}:{image_tag}"):
+                self.client(h).containers.run(image=f"{image_name}:{image_tag}",
+                                              entrypoint=["/bin/sh", "-c"],
+                                              command=[script],
+                                              volumes={source: {"bind": mount, "mode": "rw"}},
+                                              user="root",
+                                              remove=True)
+
+    def stop_container(self, name):
+        c, h = self._container(name)
+        if c is None:
+            logger.info(f"{name} container already removed")
+            return None
+        if c.status == "running":
+            try:
+                c.stop()
+                c.reload()
+            except docker.errors.APIError:
+                logger.warning(f"can't stop container {name}")
+                return False
+        return c.status == "exited"
+
+    def remove_container(self, name, force=False):
+        c, h = self._container(name)
+        if c is None:
+            logger.info(f"{name} container already removed")
+            return None
+        try:
+            c.remove(force=force)
+        except docker.errors.APIError:
+            logger.info(f"can't remove {name}")
+            return False
+        self._forget_container(name)
+        logger.info(f"container {name} : removed")
+        return True
+
+    def create_image(self, image_name, image_tag):
+        for h in self.hosts:
+            dc = self.client(h)
+            try:
+                dc.images.get(f"{image_name}:{image_tag}")
+            except docker.errors.ImageNotFound:
+                with tracer.child_span("docker", command=f"docker -H {self.hosts[h]} pull {image_name}:{image_tag}"):
+                    dc.images.pull(image_name, tag=image_tag)
+
+
 class Kubernetes(IContainerOrchestrator):
     """
 START
@@ -273,16 +871,45 @@ kubectl apply -f tsliceh/kubernetes/tdsh.yaml
 kubectl logs -f proxy-shub -c nginx-container
 
     """
+    relaunches_containers = True
+
     def __init__(self):
         self._port = 8080  # Slicer Hub backend internal port
         self._app_label = "slicer"
+        self._pods = None  # Informers, see "create_informers"
+        self._deployments = None
+        self._service_ips = dict()  # container name -> ClusterIP of its Service (fixed for the life of the Service)
+        self.cpu_limit = 4  # CPU allowance of a session pod
+        self.cpu_request = 3
+        self._resize_failures = 0  # Consecutive, see "set_cpu_limit"
+        self.relaunch_timeout_sec = 900  # Rollout of a relaunched session, see "relaunch_container"
 
     def get_valid_name(self, name):
         # Replace "_" by "-"
         return name.replace("_", "-")
 
     @staticmethod
-    def _exec_kubectl(desc, cmd, output_type=None):
+    def _run_kubectl(desc, cmd, timeout):
+        """
+        :return: completed process. DeadlineExceeded if it does not finish in time, ServiceUnavailable if the API
+                 server cannot be reached (the command did not get an answer)
+        """
+        with tracer.child_span("kubectl", command=' '.join(cmd), description=desc) as sp:
+            try:
+                proc = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                sp.set_attribute("timeout", True)
+                raise DeadlineExceeded(f"kubectl {cmd[1]}", timeout)
+            sp.set_attribute("returncode", proc.returncode)
+        if proc.returncode != 0 and any(_ in proc.stderr.lower() for _ in KUBECTL_UNREACHABLE):
+            raise ServiceUnavailable(f"Kubernetes API server unreachable: {proc.stderr.strip().splitlines()[-1]}")
+        return proc
+
+    @staticmethod
+    def _exec_kubectl(desc, cmd, output_type=None, timeout=None):
+        """
+        :param timeout: deadline of the command, KUBECTL_TIMEOUT_SEC if None. Reads are retried with backoff
+        """
         # Execute cmd
         if output_type is None:
             output = []
@@ -292,11 +919,14 @@ kubectl logs -f proxy-shub -c nginx-container
             output = ["-o", "json"]
         elif output_type.lower() == "wide":
             output = ["-o", "wide"]
+        elif output_type.lower() == "raw":
+            output = []
 
         # Build, execute, get output
         cmd = ["kubectl"] + cmd + output
         logger.debug(f"CMD {desc}: {' '.join(cmd)}")
-        proc = subprocess.run(cmd, capture_output=True, text=True)
+        proc = retry_call(Kubernetes._run_kubectl, desc, cmd, timeout or kubectl_timeout_sec(),
+                          attempts=3 if cmd[1] in ("get", "top") else 1)
         _ = proc.stdout
         logger.debug(f"  OUTPUT: {_}\n")
         logger.debug(f"  ERROR: {proc.stderr}\n----------------")
@@ -311,13 +941,16 @@ kubectl logs -f proxy-shub -c nginx-container
                 return json.loads(_)
             elif output_type.lower() == "yaml":
                 return yaml.load(_, Loader=yaml.FullLoader)
+            elif output_type.lower() == "raw":
+                return _ if proc.returncode == 0 else None
         except:
             return None
 
-    def _container_action(self, container_name, image_name, vol_dict, network_id, uid, use_gpu = False, operation="apply"):
+    def _container_action(self, container_name, image_name, vol_dict, network_id, uid, use_gpu = False, operation="apply",
+                          scratch=None, avoid_nodes=(), env=None):
         # assign cpu resource to pod or container https://kubernetes.io/docs/tasks/configure-pod-container/assign-cpu-resource/ 
-        cpu_limit = "4"
-        cpu_requested = "3"
+        cpu_limit = f"{self.cpu_limit:g}"
+        cpu_requested = f"{self.cpu_request:g}"
         cpu_attemp_to_use = "3"
 
         mount_type = "NFS"
@@ -326,11 +959,12 @@ kubectl logs -f proxy-shub -c nginx-container
             # Assume NODES have an NFS mount point with the same name in all nodes
             b_dir = f"{mount_nfs_base}/{container_name}/"
             # "volumes"
-            _ = "\n".join([f"- name: vol-{container_name}-{i}\n  hostPath:\n    path: {b_dir}{i}" for i, (k, v) in enumerate(vol_dict.items())])
+            # (keys starting with "/" are directories of the node, e.g. the datasets cache, instead of user volumes)
+            _ = "\n".join([f"- name: vol-{container_name}-{i}\n  hostPath:\n    path: {k if k.startswith('/') else f'{b_dir}{i}'}" for i, (k, v) in enumerate(vol_dict.items())])
             indentation = 8
             container_vols = textwrap.indent(_, " " * indentation)
             # "volumeMounts"
-            _ = "\n".join([f"- name: vol-{container_name}-{i}\n  mountPath: \"{v['bind']}\"" for i, (k, v) in enumerate(vol_dict.items())])
+            _ = "\n".join([f"- name: vol-{container_name}-{i}\n  mountPath: \"{v['bind']}\"" + ("\n  readOnly: true" if v.get("mode") == "ro" else "") for i, (k, v) in enumerate(vol_dict.items())])
             indentation = 10
             container_vol_mounts = textwrap.indent(_, " " * indentation)
         if use_gpu:
@@ -344,6 +978,26 @@ kubectl logs -f proxy-shub -c nginx-container
         else:
             nvidia_gpu =""
             gpu_toleration=""
+        dataset_cache_init = self._dataset_cache_init_container(container_name) if self.dataset_cache else ""
+        session_env = "\n".join(f"        - name: {k}\n          value: {json.dumps(v)}"
+                                 for k, v in (env or {}).items())
+        if avoid_nodes:
+            # Not in these nodes (e.g. being drained)
+            indent = " "*6
+            node_affinity = "\n".join([f"{indent}affinity:",
+                                       f"{indent}  nodeAffinity:",
+                                       f"{indent}    requiredDuringSchedulingIgnoredDuringExecution:",
+                                       f"{indent}      nodeSelectorTerms:",
+                                       f"{indent}      - matchExpressions:",
+                                       f"{indent}        - key: kubernetes.io/hostname",
+                                       f"{indent}          operator: NotIn",
+                                       f"{indent}          values: {json.dumps(list(avoid_nodes))}"])
+        else:
+            node_affinity = ""
+        if scratch:
+            # Memory-backed scratch space (counts against the memory of the pod)
+            container_vols += f"\n        - name: scratch-{container_name}\n          emptyDir:\n            medium: Memory\n            sizeLimit: {scratch[1]}Mi"
+            container_vol_mounts += f"\n          - name: scratch-{container_name}\n            mountPath: \"{scratch[0]}\""
                                     
             
 
@@ -368,6 +1022,7 @@ spec:
     spec:
       volumes:
 {container_vols}              
+{dataset_cache_init}
       containers:
       - name: {container_name}
         image: {image_name}
@@ -390,13 +1045,35 @@ spec:
         env:
         - name: VNC_DISABLE_AUTH
           value: "true"
+{session_env}
         volumeMounts:
 {container_vol_mounts}        
         ports:
         - containerPort: 6901
         - containerPort: 8085
+        readinessProbe:  # KasmVNC serving, not just the process started (also gates the Service endpoints)
+          httpGet:
+            path: /
+            port: 6901
+          initialDelaySeconds: 2
+          periodSeconds: 2
+          failureThreshold: 90
 {gpu_toleration}
-                
+{node_affinity}
+---
+apiVersion: v1
+kind: Service
+metadata:
+  name: {self._service_name(container_name)}
+  labels:
+    app: {self._app_label}
+spec:
+  selector:
+    app-user: {container_name}
+  ports:
+  - name: vnc
+    port: 6901
+    targetPort: 6901
         """
 
         # Write string to a temporary file
@@ -405,15 +1082,134 @@ spec:
             f.write(_)
             f.close()
             if operation == "apply":
-                desc = "Create Slicer, apply Deployment manifest"
+                desc = "Create Slicer, apply Deployment and Service manifest"
                 cmd = ["apply", "-f", f.name]
             elif operation == "delete":
-                desc = "Delete Slicer, delete Deployment manifest"
+                desc = "Delete Slicer, delete Deployment and Service manifest"
                 cmd = ["delete", "-f", f.name]
             res = Kubernetes._exec_kubectl(desc, cmd)
             os.remove(f.name)
         return res
 
+    def _dataset_cache_init_container(self, container_name):
+        """
+        Volumes (source and cache directories of the node) and init container filling the datasets cache in the node
+        of the pod, before Slicer starts. Its report is the termination message (see "dataset_cache_report")
+        """
+        cache = self.dataset_cache
+        _ = f"""- name: datasets-source-{container_name}
+  hostPath:
+    path: {cache.source_dir}
+- name: datasets-cache-{container_name}
+  hostPath:
+    path: {cache.cache_dir}
+    type: DirectoryOrCreate"""
+        volumes = textwrap.indent(_, " " * 8)
+        command = json.dumps(["python", "-m", "tsliceh.dataset_cache", "--source", cache.source_dir,
+                              "--cache", cache.cache_dir, "--max-gb", str(cache.max_bytes / 1024 ** 3),
+                              "--datasets", ",".join(self.datasets), "--report", "/dev/termination-log"])
+        _ = f"""initContainers:
+- name: dataset-cache
+  image: {self.dataset_cache_image}
+  imagePullPolicy: IfNotPresent
+  command: {command}
+  env:
+  - name: NODE_NAME
+    valueFrom:
+      fieldRef:
+        fieldPath: spec.nodeName
+  volumeMounts:
+  - name: datasets-source-{container_name}
+    mountPath: {cache.source_dir}
+    readOnly: true
+  - name: datasets-cache-{container_name}
+    mountPath: {cache.cache_dir}"""
+        return volumes + "\n" + textwrap.indent(_, " " * 6)
+
+    def fill_dataset_cache(self, container_name):
+        return None  # Filled by the init container of the pod, in its node
+
+    def get_scratch_usage(self, container_name, path):
+        cmd = ["exec", f"deploy/deploy-{container_name}", "--", "df", "-Pk", path]
+        res = Kubernetes._exec_kubectl("Get scratch usage", cmd, "raw")
+        return df_used_bytes(res) if res else None
+
+    def shared_cache_source(self, version):
+        # NFS, mounted in all the nodes (like the user volumes)
+        return f"/mnt/opendx28/slicer-shared/{version}"
+
+    def populate_shared_cache(self, source, image_name, image_tag, mount, script):
+        """ A Job running the image in any node (the cache is in NFS), waiting for its completion """
+        job = f"populate-{os.path.basename(source)}"
+        _ = f"""
+apiVersion: batch/v1
+kind: Job
+metadata:
+  name: {job}
+  labels:
+    app: slicer-shared-cache
+spec:
+  backoffLimit: 1
+  ttlSecondsAfterFinished: 600
+  template:
+    spec:
+      restartPolicy: Never
+      volumes:
+      - name: shared-cache
+        hostPath:
+          path: {source}
+          type: DirectoryOrCreate
+      containers:
+      - name: populate
+        image: {image_name}:{image_tag}
+        command: ["/bin/sh", "-c", {json.dumps(script)}]
+        securityContext:
+          runAsUser: 0
+        volumeMounts:
+        - name: shared-cache
+          mountPath: {mount}
+        """
+        with tempfile.NamedTemporaryFile(mode="w", delete=False) as f:
+            f.write(_)
+        try:
+            Kubernetes._exec_kubectl("Populate shared cache, apply Job manifest", ["apply", "-f", f.name])
+        finally:
+            os.remove(f.name)
+        res = Kubernetes._exec_kubectl("Populate shared cache, wait for the Job",
+                                       ["wait", "--for=condition=complete", f"job/{job}", "--timeout=3600s"], "raw",
+                                       timeout=3600 + kubectl_timeout_sec())
+        Kubernetes._exec_kubectl("Populate shared cache, delete Job", ["delete", "job", job])
+        if res is None:
+            raise RuntimeError(f"Job {job} populating the shared cache {source} did not complete")
+
+    def dataset_cache_report(self, container_name):
+        if not self.dataset_cache:
+            return None
+        cmd = ["get", "pod", "-l", f"app-user={container_name}"]
+        res = Kubernetes._exec_kubectl("Get POD init containers", cmd, "json")
+        for pod in (res or {}).get("items", []):
+            for cs in pod.get("status", {}).get("initContainerStatuses", []):
+                message = cs.get("state", {}).get("terminated", {}).get("message") if cs["name"] == "dataset-cache" else None
+                if message:
+                    try:
+                        return json.loads(message)
+                    except ValueError:
+                        logger.warning(f"dataset cache - unexpected report of {container_name}: {message}")
+        return None
+
+    def create_informers(self, prefix, names=(), resync_period=300.0):
+        # Every Slicer pod and Deployment has the label, regardless of "prefix"; the base containers are not cached
+        selector = f"app={self._app_label}"
+        self._pods = Informer("pods", KubernetesSource("pods", selector, timeout_sec=resync_period), resync_period)
+        self._deployments = Informer("deployments", KubernetesSource("deployments", selector,
+                                                                     timeout_sec=resync_period), resync_period)
+        return [self._pods, self._deployments]
+
+    def _forget(self, container_name):
+        for informer in (self._pods, self._deployments):
+            if informer is not None:
+                informer.forget(container_name)
+
     def get_tdscontainers(self, prefix):
         """
         Obtain 3d slicer instances, looking for Deployments (depends on the template launched with "_container_action")
@@ -421,6 +1217,8 @@ spec:
         :param prefix:
         :return:
         """
+        if self._deployments is not None and self._deployments.synced:
+            return self._deployments.names()
         cmd = ["get", "deployments", "-l", f"app={self._app_label}"]
         res = Kubernetes._exec_kubectl("Get Slicer containers", cmd, "wide")
         _ = []
@@ -449,10 +1247,11 @@ spec:
 
     def get_container_activity(self, container_name):
         # Check if the deployment exists
-        cmd = ["get", "deployment", f"deploy-{container_name}"]
-        res = Kubernetes._exec_kubectl("Get activity, check deployment exists", cmd, "wide")
-        if res is None:
-            return -1
+        if self._lookup(self._deployments, container_name) is None:
+            cmd = ["get", "deployment", f"deploy-{container_name}"]
+            res = Kubernetes._exec_kubectl("Get activity, check deployment exists", cmd, "wide")
+            if res is None:
+                return -1
 
         # Obtain the CPU usage
         cmd = ["top", "pod", "-l", f"app-user={container_name}"]  # -> CPU, MEMORY
@@ -467,7 +1266,72 @@ spec:
             print(f"CPU %: {_}")
             return _
 
+    def set_cpu_limit(self, container_name, cpus):
+        # Lowering the request too frees room in the node for other pods
+        limit = self.cpu_limit if cpus is None else cpus
+        return self._resize_pod(container_name, limit, min(limit, self.cpu_request))
+
+    def set_cpu_weight(self, container_name, weight):
+        # CPU shares of a pod are proportional to its request
+        return self._resize_pod(container_name, self.cpu_limit, min(self.cpu_limit, self.cpu_request * weight))
+
+    def _resize_pod(self, container_name, limit, request):
+        # In-place resize of the pod (InPlacePodVerticalScaling, "resize" subresource): the pod is not restarted.
+        # The Deployment keeps the full allowance
+        if self._resize_failures >= 3:
+            return False  # Not supported by the cluster
+        c = self._lookup(self._pods, container_name)
+        pod = c.resource_name if c is not None else Kubernetes._exec_kubectl(
+            "Get pod name", ["get", "pod", "-l", f"app-user={container_name}",
+                             "-o", "jsonpath={.items[0].metadata.name}"], "raw")
+        if not pod:
+            return False
+        resources = dict(limits=dict(cpu=f"{limit:g}"), requests=dict(cpu=f"{request:.3g}"))
+        patch = json.dumps(dict(spec=dict(containers=[dict(name=container_name, resources=resources)])))
+        cmd = ["patch", "pod", pod, "--subresource", "resize", "--patch", patch]
+        if Kubernetes._exec_kubectl("Resize pod CPU", cmd, "raw") is None:
+            self._resize_failures += 1
+            if self._resize_failures >= 3:
+                logger.warning("in-place resize of pods not available, sessions keep their CPU allowance and share")
+            return False
+        self._resize_failures = 0
+        return True
+
+    def containers_on_node(self, node):
+        cmd = ["get", "pods", "-l", f"app={self._app_label}", "--field-selector", f"spec.nodeName={node}"]
+        res = Kubernetes._exec_kubectl("Get Slicer pods in node", cmd, "json")
+        if res is None:
+            return None
+        return [p["metadata"]["labels"]["app-user"] for p in res.get("items", [])
+                if p["metadata"].get("deletionTimestamp") is None and "app-user" in p["metadata"].get("labels", {})]
+
+    def cordon_node(self, node, cordon=True):
+        cmd = ["cordon" if cordon else "uncordon", node]
+        return Kubernetes._exec_kubectl("Cordon node" if cordon else "Uncordon node", cmd, "raw") is not None
+
+    async def relaunch_container(self, container_name, image_name, image_tag, network_id, vol_dict, uid,
+                                 use_gpu=False, scratch=None, avoid_nodes=(), env=None):
+        # Same Deployment and Service, with node affinity: a rolling update, the new pod is started in another node
+        # and the old one removed once the new one is Ready (the Service then points to it)
+        await asyncio.to_thread(self._container_action, container_name, f"{image_name}:{image_tag}", vol_dict,
+                                network_id, uid, use_gpu=use_gpu, scratch=scratch, avoid_nodes=avoid_nodes, env=env)
+        cmd = ["rollout", "status", f"deployment/deploy-{container_name}", f"--timeout={self.relaunch_timeout_sec}s"]
+        res = await asyncio.to_thread(Kubernetes._exec_kubectl, "Wait for relaunched pod", cmd, "raw",
+                                      timeout=self.relaunch_timeout_sec + kubectl_timeout_sec())
+        self._forget(container_name)
+        if res is None:
+            raise RuntimeError(f"relaunch of {container_name} did not finish in {self.relaunch_timeout_sec} s")
+
+    def get_container_network_io(self, container_name):
+        # Counters of the pod network namespace (the same for all its containers)
+        cmd = ["exec", f"deploy/deploy-{container_name}", "--", "cat", "/proc/net/dev"]
+        res = Kubernetes._exec_kubectl("Get network counters", cmd, "raw")
+        return parse_proc_net_dev(res) if res else None
+
     def get_container_ip(self, name_id, network_id):
+        c = self._lookup(self._pods, name_id)
+        if c is not None and c.status == "Running" and c.ip():
+            return c.ip()
         cmd = ["get", "pod", "-l", f"app-user={name_id}"]  # IP
         res = Kubernetes._exec_kubectl("Get POD IP", cmd, "wide")
         if res is None:
@@ -481,11 +1345,28 @@ spec:
         logger.debug(f"IP: {_}")
         return _
 
+    @staticmethod
+    def _service_name(container_name):
+        return f"svc-{container_name}"
+
+    def get_service_address(self, container_name):
+        # Routes to the ClusterIP survive the pod being rescheduled (new pod IP)
+        if container_name not in self._service_ips:
+            cmd = ["get", "service", self._service_name(container_name), "-o", "jsonpath={.spec.clusterIP}"]
+            ip = Kubernetes._exec_kubectl("Get Service ClusterIP", cmd, "raw")
+            if not ip or ip == "None":
+                return None
+            self._service_ips[container_name] = ip
+        return self._service_ips[container_name]
+
     def get_container_port(self, name_id):
         # Always the same port
         return self._port
 
     def get_container_status(self, container_name):
+        c = self._lookup(self._pods, container_name)
+        if c is not None:
+            return c.status
         cmd = ["get", "pod", "-l", f"app-user={container_name}"]
         res = Kubernetes._exec_kubectl("Get POD status", cmd, "wide")
         if res is None:
@@ -495,7 +1376,8 @@ spec:
         return _
 
     async def start_container(self, container_name, image_name, image_tag,
-                              network_id=None, vol_dict=None, uid=None, wait_until_running=True, use_gpu = False):
+                              network_id=None, vol_dict=None, uid=None, wait_until_running=True, use_gpu = False,
+                              scratch=None, env=None):
         # TODO How to indicate the network and the volumes?
         logger.debug(f"Network id 2: {network_id}")
 
@@ -507,17 +1389,27 @@ spec:
         c.name = container_name
         c.logs = None
         active = False
-        self._container_action(container_name, f"{image_name}:{image_tag}", vol_dict, network_id, uid, use_gpu =use_gpu)
+        await asyncio.to_thread(self._container_action, container_name, f"{image_name}:{image_tag}", vol_dict,
+                                network_id, uid, use_gpu=use_gpu, scratch=scratch, env=env)
+        self._forget(container_name)  # A previous pod could still be in the cache
         if wait_until_running:
+            iteration = 0
             while not active:
                 await asyncio.sleep(3)
-                c.status = self.get_container_status(container_name)
-                if c.status.lower() == "running":
+                iteration += 1
+                with tracer.child_span("start_container.poll", iteration=iteration) as sp:
+                    c.status = await asyncio.to_thread(self.get_container_status, container_name)
+                    sp.set_attribute("status", c.status)
+                if (c.status or "").lower() == "running":
                     active = True
                     logger.info("container running")
-                elif c.status.lower() == "exited":
+                elif (c.status or "").lower() == "exited":
                     logger.info("container exited")
                     break
+                elif (c.status or "").lower() in POD_FAILED_STATUSES:
+                    # Not going to run without a change (image, configuration), do not wait for the deadline
+                    logger.error(f"container {container_name} failed to start: {c.status}")
+                    break
         return c
 
     def stop_container(self, container_name):
@@ -528,7 +1420,9 @@ spec:
             return
         # Set the number of replicas to 0
         cmd = ["scale", "--replicas=0", f"deployment/deploy-{container_name}"]
-        res = Kubernetes._exec_kubectl("Stop container, set RS replicas to 0", cmd)
+        res = Kubernetes._exec_kubectl("Stop container, set RS replicas to 0", cmd, "raw")
+        self._forget(container_name)
+        return res is not None  # Like DockerCompose: True if stopped, so "stop_remove_container" removes it
 
     def restart_container(self, container_name):
         # First check the deployment exists
@@ -539,10 +1433,17 @@ spec:
         # Set the number of replicas to 1
         cmd = ["scale", "--replicas=1", f"deployment/deploy-{container_name}"]
         res = Kubernetes._exec_kubectl("Restart container, set RS replicas to 1", cmd)
+        self._forget(container_name)
 
-    def remove_container(self, container_name):
+    def remove_container(self, container_name, force=False):
+        # "force" is not needed: the Deployment was scaled to 0 or, if not, deleting it deletes its pod
         cmd = ["delete", "deployment", f"deploy-{container_name}"]
-        res = Kubernetes._exec_kubectl("Remove deployment", cmd)
+        res = Kubernetes._exec_kubectl("Remove deployment", cmd, "raw")
+        cmd = ["delete", "service", self._service_name(container_name), "--ignore-not-found"]
+        Kubernetes._exec_kubectl("Remove service", cmd)
+        self._service_ips.pop(container_name, None)
+        self._forget(container_name)
+        return res is not None
 
     def create_image(self, image_name, image_tag):
         # TODO
@@ -564,6 +1465,281 @@ spec:
         return Kubernetes._exec_kubectl("Start base containers", cmd)
 
 
+class SimulatedContainer:
+    def __init__(self, name, image, ip):
+        self.id = name  # Value used by "get_container_ip" (and get_container_port), as in Kubernetes
+        self.name = name
+        self.image = image
+        self.ip = ip
+        self.status = "created"
+        self.logs = None
+        self.started_at = time.monotonic()
+        self.cpu_pct = None  # Forced activity (see "set_container_activity"), None -> use the activity pattern
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.io_at = self.started_at
+        self.volumes = dict()  # vol_dict of "start_container"
+        self.env = dict()  # env of "start_container"
+        self.scratch = None  # (path, MiB)
+        self.scratch_used = 0  # Bytes, see "get_scratch_usage"
+        self.cpu_limit = None  # CPUs, see "set_cpu_limit"
+        self.cpu_weight = 1.0  # See "set_cpu_weight"
+        self.node = None
+
+
+class Simulated(IContainerOrchestrator):
+    """
+    In-memory container orchestrator, to drive the hub (login, launch, checker, nginx refresh) through its real code
+    paths without Docker or Kubernetes, e.g. for load tests on a laptop or a CI box.
+
+    Select it with CONTAINER_ORCHESTRATOR=simulated. Behaviour is configured with (see "container_orchestrator_factory"):
+      SIM_START_LATENCY_SEC: time for a container to go from "created" to "running"
+      SIM_READY_LATENCY_SEC: time for a "running" container to pass the readiness probe (KasmVNC up)
+      SIM_FAILURE_RATE: probability [0, 1] of a container exiting instead of reaching "running"
+      SIM_API_LATENCY_SEC: latency added to every (blocking) call, like a slow Docker daemon or API server
+      SIM_ACTIVITY: CPU pattern of the containers
+        - "idle": always below the activity threshold
+        - "busy": always above
+        - "random:<p>": active with probability p in each sample
+        - "periodic:<active_sec>:<idle_sec>": active for active_sec, then idle for idle_sec, repeated
+      SIM_SEED: seed for the random generator, for reproducible runs
+      SIM_NODES: comma separated names of the nodes, where the containers are placed in turn
+    The base containers (NGINX_NAME, TDSLICERHUB_NAME) are simulated as always running.
+    """
+    relaunches_containers = True
+
+    def __init__(self, start_latency=0.0, failure_rate=0.0, api_latency=0.0, activity="busy", seed=None,
+                 base_containers=(), ready_latency=0.0, nodes=("sim-node-1", "sim-node-2")):
+        self.start_latency = start_latency
+        self.ready_latency = ready_latency
+        self.failure_rate = failure_rate
+        self.api_latency = api_latency
+        self.activity = activity
+        self._random = random.Random(seed)
+        self._containers = dict()  # name -> SimulatedContainer
+        self._volumes = set()
+        self._images = set()
+        self._ip_counter = 0
+        self.nginx_reloads = 0
+        self._shared_caches = set()
+        self.shared_cache_populations = 0
+        self.nodes = list(nodes)
+        self.cordoned = set()
+        self._placements = 0
+        self.unreachable = False  # Outage of the API, every call fails
+        for name in base_containers:
+            self._containers[name] = self._new_container(name, "base")
+            self._containers[name].status = "running"
+
+    def _new_container(self, name, image):
+        self._ip_counter += 1
+        ip = f"10.{(self._ip_counter >> 16) & 255}.{(self._ip_counter >> 8) & 255}.{self._ip_counter & 255}"
+        return SimulatedContainer(name, image, ip)
+
+    def _api_call(self):
+        if self.api_latency > 0:
+            sleep(self.api_latency)
+        if self.unreachable:
+            raise ServiceUnavailable("simulated orchestrator unreachable")
+
+    def _activity_pct(self, c):
+        if c.cpu_pct is not None:
+            return c.cpu_pct
+        pattern = self.activity.split(":")
+        if pattern[0] == "idle":
+            return self._random.uniform(0, 2)
+        elif pattern[0] == "random":
+            p = float(pattern[1]) if len(pattern) > 1 else 0.5
+            return self._random.uniform(20, 80) if self._random.random() < p else self._random.uniform(0, 2)
+        elif pattern[0] == "periodic":
+            active_sec, idle_sec = float(pattern[1]), float(pattern[2])
+            t = (time.monotonic() - c.started_at) % (active_sec + idle_sec)
+            return self._random.uniform(20, 80) if t < active_sec else self._random.uniform(0, 2)
+        else:  # "busy"
+            return self._random.uniform(20, 80)
+
+    def _next_node(self, avoid=()):
+        """ Next node in turn, not cordoned nor in "avoid". None if there is none """
+        nodes = [n for n in self.nodes if n not in self.cordoned and n not in avoid]
+        if not nodes:
+            return None
+        self._placements += 1
+        return nodes[self._placements % len(nodes)]
+
+    def set_container_activity(self, container_name, pct):
+        """ Force the CPU percentage reported for a container (None to go back to the activity pattern) """
+        self._containers[container_name].cpu_pct = pct
+
+    def get_valid_name(self, name):
+        return name.replace("_", "-")
+
+    def get_tdscontainers(self, prefix=""):
+        self._api_call()
+        return [name for name in self._containers if name.startswith(prefix)]
+
+    def create_network(self, network_name):
+        return network_name
+
+    def create_volume(self, name, type_):
+        self._api_call()
+        self._volumes.add(f"{name}_{type_}")
+
+    def remove_volume(self, volume_name):
+        self._api_call()
+        self._volumes.discard(volume_name)
+
+    def get_container_activity(self, container_name):
+        self._api_call()
+        c = self._containers.get(container_name)
+        if c is None or c.status != "running":
+            return -1
+        pct = self._activity_pct(c)
+        return min(pct, 100 * c.cpu_limit) if c.cpu_limit is not None else pct
+
+    def set_cpu_limit(self, container_name, cpus):
+        self._api_call()
+        c = self._containers.get(container_name)
+        if c is None or c.status != "running":
+            return False
+        c.cpu_limit = cpus
+        return True
+
+    def set_cpu_weight(self, container_name, weight):
+        self._api_call()
+        c = self._containers.get(container_name)
+        if c is None or c.status != "running":
+            return False
+        c.cpu_weight = weight
+        return True
+
+    def get_container_network_io(self, container_name):
+        self._api_call()
+        c = self._containers.get(container_name)
+        if c is None or c.status != "running":
+            return None
+        # VNC traffic grows with the activity: input events in, frame updates out (bytes/s)
+        now = time.monotonic()
+        pct = self._activity_pct(c)
+        c.rx_bytes += int(pct * 50 * (now - c.io_at))
+        c.tx_bytes += int(pct * 2000 * (now - c.io_at))
+        c.io_at = now
+        return c.rx_bytes, c.tx_bytes
+
+    def get_container_ip(self, name_id, network_id):
+        self._api_call()
+        c = self._containers.get(name_id)
+        return c.ip if c else ""
+
+    def get_container_port(self, name_id):
+        return 6901
+
+    def get_container_status(self, container_name):
+        self._api_call()
+        c = self._containers.get(container_name)
+        return c.status if c else None
+
+    async def start_container(self, container_name, image_name, image_tag,
+                              network_id=None, vol_dict=None, uid=None, wait_until_running=True, use_gpu=False,
+                              scratch=None, env=None):
+        self._api_call()
+        if container_name in self._containers:
+            raise APIError(f"Conflict. The container name {container_name} is already in use")
+        c = self._new_container(container_name, f"{image_name}:{image_tag}")
+        c.volumes = dict(vol_dict or {})
+        c.env = dict(env or {})
+        c.scratch = scratch
+        c.node = self._next_node()
+        self._containers[container_name] = c
+
+        async def boot():
+            await asyncio.sleep(self.start_latency)
+            if c.status == "created":
+                c.status = "exited" if self._random.random() < self.failure_rate else "running"
+                c.started_at = time.monotonic()
+
+        if wait_until_running:
+            await boot()
+        else:
+            asyncio.get_running_loop().create_task(boot())
+        return c
+
+    def containers_on_node(self, node):
+        self._api_call()
+        return [name for name, c in self._containers.items() if c.node == node and c.status == "running"]
+
+    def cordon_node(self, node, cordon=True):
+        if node not in self.nodes:
+            return False
+        if cordon:
+            self.cordoned.add(node)
+        else:
+            self.cordoned.discard(node)
+        return True
+
+    async def relaunch_container(self, container_name, image_name, image_tag, network_id, vol_dict, uid,
+                                 use_gpu=False, scratch=None, avoid_nodes=(), env=None):
+        self._api_call()
+        old = self._containers.get(container_name)
+        node = self._next_node(avoid_nodes)
+        if old is None or node is None:
+            raise RuntimeError(f"cannot relaunch {container_name}: " + ("no container" if old is None else "no node"))
+        c = self._new_container(container_name, f"{image_name}:{image_tag}")
+        c.volumes, c.env, c.scratch, c.node = dict(vol_dict or {}), dict(env or {}), scratch, node
+        await asyncio.sleep(self.start_latency)
+        c.status = "running"
+        c.started_at = time.monotonic()
+        self._containers[container_name] = c  # The old one is gone
+        return c
+
+    async def probe_readiness(self, address):
+        ip = address.rsplit(":", 1)[0]
+        c = next((c for c in self._containers.values() if c.ip == ip), None)
+        return c is not None and c.status == "running" and time.monotonic() - c.started_at >= self.ready_latency
+
+    def stop_container(self, container_name):
+        self._api_call()
+        c = self._containers.get(container_name)
+        if c is None:
+            return None
+        c.status = "exited"
+        return True
+
+    def remove_container(self, container_name, force=False):
+        self._api_call()
+        c = self._containers.get(container_name)
+        if c is None:
+            return None
+        if c.status == "running" and not force:
+            return False
+        del self._containers[container_name]
+        return True
+
+    def create_image(self, image_name, image_tag):
+        self._api_call()
+        self._images.add(f"{image_name}:{image_tag}")
+
+    def get_scratch_usage(self, container_name, path):
+        self._api_call()
+        c = self._containers.get(container_name)
+        if c is None or c.status != "running" or not c.scratch:
+            return None
+        return c.scratch_used
+
+    def populate_shared_cache(self, source, image_name, image_tag, mount, script):
+        self._api_call()
+        if source not in self._shared_caches:
+            self._shared_caches.add(source)
+            self.shared_cache_populations += 1
+
+    def execute_cmd_in_nginx_container(self, container_name, cmd):
+        self._api_call()
+        self.nginx_reloads += 1
+        return "simulated"
+
+    def start_base_containers(self):
+        pass
+
+
 def create_docker_network(network_name):
     """
     A partir del nomber de red que aparece en .env crea una red.
@@ -572,7 +1748,7 @@ def create_docker_network(network_name):
     :return: network_id
     TODO revisar si viene bien hacer borrón y cuenta nueva
     """
-    dc = docker.from_env()
+    dc = docker_client()
     # print("networks inside container " + dc.networks.list(names = network_name))
     networks_list = dc.networks.list(names=network_name)
     for n in networks_list:
@@ -603,18 +1779,20 @@ def create_volume(name, type_):
     :param label: Scome more information about the volume as
     :return:
     """
-    dc = docker.from_env()
+    dc = docker_client()
     try:
-        volume = dc.volumes.get(f"{name}_{type_}")
+        with tracer.child_span("docker", command=f"docker volume inspect {name}_{type_}"):
+            volume = dc.volumes.get(f"{name}_{type_}")
     except docker.errors.NotFound:
-        volume = dc.volumes.create(name=f"{name}_{type_}", driver='local')
+        with tracer.child_span("docker", command=f"docker volume create {name}_{type_}"):
+            volume = dc.volumes.create(name=f"{name}_{type_}", driver='local')
         print(f"new volume {volume.name} created")
     except Exception as e:
         print(e.message, e.args)
 
 
 def remove_volume(name):
-    dc = docker.from_env()
+    dc = docker_client()
     volume = dc.volumes.get(name)
     try:
         volume.remove()
@@ -626,38 +1804,145 @@ def remove_volume(name):
         print(f"cant remove volume {name}")
 
 
-def docker_container_pct_activity(container_id_name):
+def df_used_bytes(output):
+    """ Used bytes in the output of "df -Pk <path>" (second line: filesystem, 1024-blocks, used, ...) """
+    lines = output.strip().splitlines()
+    try:
+        return int(lines[1].split()[2]) * 1024
+    except (IndexError, ValueError):
+        return None
+
+
+def parse_docker_hosts(spec):
+    """
+    :param spec: "name=url,..." e.g. "local=unix:///var/run/docker.sock,node2=tcp://10.0.0.2:2375"
+    :return: dictionary host name -> Docker daemon URL, in order
+    """
+    hosts = dict()
+    for item in (spec or "").split(","):
+        if item.strip():
+            name, _, url = item.partition("=")
+            if not name.strip() or not url.strip():
+                raise ValueError(f"Docker host '{item.strip()}' is not 'name=url'")
+            hosts[name.strip()] = url.strip()
+    if not hosts:
+        raise ValueError("No Docker hosts")
+    return hosts
+
+
+def docker_host_address(url):
+    """ Address where the published ports of a Docker daemon are reached. None for a local daemon (socket) """
+    if url.startswith(("unix://", "npipe://")):
+        return None
+    return urllib.parse.urlsplit(url).hostname
+
+
+def choose_docker_host(loads):
+    """
+    Least loaded host: the one where a new session would get the largest share of CPU, its CPU headroom (CPUs not
+    used by its sessions) divided by its running sessions plus the new one. Ties go to the host with fewer sessions
+
+    :param loads: dictionary host -> (running sessions, CPUs, CPU used by the sessions in percent of one CPU)
+    :return: host name, None if there are no hosts
+    """
+    def share(h):
+        n, cpus, used = loads[h]
+        return max(100 * cpus - used, 0) / (n + 1), -n
+    return max(loads, key=share) if loads else None
+
+
+def docker_set_cpu_limit(c, cpus):
+    """ "docker update --cpus" of a container (CFS quota); None removes the limit """
+    try:
+        with tracer.child_span("docker", command=f"docker update --cpus {cpus or 0} {c.name}"):
+            c.update(cpu_period=100000, cpu_quota=int(cpus * 100000) if cpus is not None else -1)
+    except docker.errors.APIError as e:
+        logger.warning(f"could not change the CPU limit of {c.name}: {e!r}")
+        return False
+    return True
+
+
+def docker_set_cpu_weight(c, weight):
+    """ "docker update --cpu-shares" of a container, 1024 (the default) times the weight """
+    try:
+        with tracer.child_span("docker", command=f"docker update --cpu-shares {int(1024 * weight)} {c.name}"):
+            c.update(cpu_shares=max(2, int(1024 * weight)))
+    except docker.errors.APIError as e:
+        logger.warning(f"could not change the CPU shares of {c.name}: {e!r}")
+        return False
+    return True
+
+
+def docker_container_pct_activity(container_id_name, container_id=None):
     """
     Obtain the percentage of activity of a container
     -1 if the container does not exist
 
     :param container_id_name: container id or name
+    :param container_id: container id, if already known (informer cache), to avoid looking the container up
     :return: -c if such container does not exist or real cpu percentage
     """
-    dc = docker.from_env()
+    dc = docker_client()
     try:
-        c = dc.containers.get(container_id_name)
-        stats = container_stats(c.id)
+        if container_id is None:
+            container_id = dc.containers.get(container_id_name).id
+        with tracer.child_span("docker", command=f"docker stats --no-stream {container_id_name}"):
+            stats = container_stats(container_id)
         from tsliceh.helpers import calculate_cpu_percent
         return calculate_cpu_percent(stats)
-    except:
+    except (docker.errors.NotFound, KeyError):  # Removed, or not running
         return -1
 
 
+def docker_container_network_io(container_id_name):
+    """
+    Cumulative network counters of a container
+
+    :param container_id_name: container id or name
+    :return: (rx_bytes, tx_bytes) summed over the interfaces of the container, None if it does not exist
+    """
+    dc = docker_client()
+    try:
+        c = dc.containers.get(container_id_name)
+        with tracer.child_span("docker", command=f"docker stats --no-stream {container_id_name}"):
+            stats = container_stats(c.id)
+        networks = stats.get("networks", {}).values()
+        return sum(n["rx_bytes"] for n in networks), sum(n["tx_bytes"] for n in networks)
+    except (docker.errors.NotFound, KeyError):
+        return None
+
+
+def parse_proc_net_dev(text):
+    """
+    Sum the counters of "/proc/net/dev", skipping the loopback interface
+
+    :return: (rx_bytes, tx_bytes)
+    """
+    rx = tx = 0
+    for line in text.splitlines()[2:]:
+        iface, _, counters = line.partition(":")
+        if iface.strip() == "lo" or not counters:
+            continue
+        _ = counters.split()
+        rx += int(_[0])
+        tx += int(_[8])
+    return rx, tx
+
+
 def get_container_ip(name_id, network_id):
     # TODO get ip without network info possible..
-    dc = docker.from_env()
+    dc = docker_client()
     try:
         c = dc.containers.get(name_id)
         network = dc.networks.get(network_id)
         ip = c.attrs['NetworkSettings']['Networks'][network.name]['IPAddress']
-    except:
+    except (docker.errors.NotFound, KeyError):
         ip = ""
     return ip
 
 
 def get_container_port(name_id):
-    dc = docker.from_env()
+    dc = docker_client()
     try:
         c = dc.containers.get(name_id)
         tmp = list(c.ports.keys())
@@ -665,7 +1950,7 @@ def get_container_port(name_id):
             port = tmp[-1].split('/')[0]
         else:
             port = ""
-    except:
+    except docker.errors.NotFound:
         port = ""
     return port
 
@@ -676,7 +1961,7 @@ def containers_status(name_id):
     :param name_id:
     :return: None, "runnung" or "exited
     """
-    dc = docker.from_env()
+    dc = docker_client()
     try:
         c = dc.containers.get(name_id)
         status = c.status
@@ -685,12 +1970,12 @@ def containers_status(name_id):
         else:
             sleep(3)
             c.reload()
-    except:
+    except docker.errors.NotFound:
         return None
 
 
 def container_stats(name_id=None):
-    client = docker.DockerClient(base_url='unix:///var/run/docker.sock')
+    client = docker_client()
     if name_id:
         container = client.containers.get(name_id)
         stats = container.stats(decode=None, stream=False)
@@ -703,9 +1988,10 @@ def container_stats(name_id=None):
 
 
 def create_image(image_name, image_tag):
-    dc = docker.from_env()
+    dc = docker_client()
     image_full_name = f"{image_name}:{image_tag}"
-    images = dc.images.list()
+    with tracer.child_span("docker", command="docker images"):
+        images = dc.images.list()
     tags = sum([image.tags for image in images], [])
     if image_full_name in tags:
         print(f"image {image_full_name} already in the system")
@@ -720,7 +2006,8 @@ def create_image(image_name, image_tag):
         # TODO PUSH TO localhost:5000 respository (seams that is not supported)
     else:
         try:
-            dc.images.pull(image_name, tag=image_tag)
+            with tracer.child_span("docker", command=f"docker pull {image_full_name}"):
+                dc.images.pull(image_name, tag=image_tag)
         except docker.errors.APIError as e:
             raise Exception(e)
 
@@ -734,6 +2021,99 @@ def docker_compose_up():
             raise APIError(500, f"Error running {container.name} : status : {status}")
 
 
+def decorate_orchestrator(co: IContainerOrchestrator, decorator):
+    """
+    Wrap every public method of an orchestrator instance (metrics, tracing, ...)
+
+    :param co: orchestrator object, modified in place (methods are replaced by instance attributes)
+    :param decorator: function (method_name, bound_method) -> wrapped bound method
+    :return: the same orchestrator object
+    """
+    for name in dir(type(co)):
+        if name.startswith("_") or not callable(getattr(type(co), name)):
+            continue
+        setattr(co, name, decorator(name, getattr(co, name)))
+    return co
+
+
+# Errors of a call to an orchestrator meaning it did not answer (kubectl, Docker API requests)
+ORCHESTRATOR_UNREACHABLE = (ServiceUnavailable,) + DOCKER_UNREACHABLE
+# Methods without I/O, not subject to the breaker
+_UNGUARDED_METHODS = ("get_valid_name", "create_informers", "assign_container_host")
+_guarded_call = contextvars.ContextVar("guarded_call", default=False)
+
+
+def guard_orchestrator(co: IContainerOrchestrator, breaker, start_timeout_sec=900.0):
+    """
+    Circuit breaker and deadlines around the calls to an orchestrator (see "tsliceh.resilience"): when it does not
+    answer, calls fail at once with CircuitOpenError instead of waiting for it.
+    Calls made by a method of the orchestrator to other methods go straight through (the outer call accounts for
+    them). Starts and relaunches of containers must finish within "start_timeout_sec" (DeadlineExceeded); missing
+    that deadline is not a failure of the orchestrator (the cluster may be full, or an image slow to pull).
+    Errors of the Docker API client meaning the daemon did not answer are raised as ServiceUnavailable.
+
+    :param breaker: CircuitBreaker
+    :return: the same orchestrator object
+    """
+    def call(method, *args, **kwargs):
+        try:
+            return breaker.call(method, *args, failures=ORCHESTRATOR_UNREACHABLE, **kwargs)
+        except ServiceUnavailable:
+            raise
+        except ORCHESTRATOR_UNREACHABLE as e:
+            raise ServiceUnavailable(f"{breaker.name} unreachable: {e}") from e
+
+    def decorator(name, method):
+        if name in _UNGUARDED_METHODS:
+            return method
+        if asyncio.iscoroutinefunction(method):
+            timeout = start_timeout_sec if name in ("start_container", "relaunch_container") else None
+
+            async def run(*args, **kwargs):
+                try:
+                    return await asyncio.wait_for(method(*args, **kwargs), timeout)
+                except DeadlineExceeded:  # Of a call to the orchestrator, not of the whole operation
+                    raise
+                except asyncio.TimeoutError:
+                    breaker.timed_out(name)
+                    raise TimeoutError(f"{name} did not finish in {timeout:g} s")
+
+            async def wrapper(*args, **kwargs):
+                if _guarded_call.get():
+                    return await method(*args, **kwargs)
+                token = _guarded_call.set(True)
+                try:
+                    breaker.check()
+                    try:
+                        r = await run(*args, **kwargs)
+                    except ORCHESTRATOR_UNREACHABLE as e:
+                        if isinstance(e, DeadlineExceeded):
+                            breaker.timed_out(e.operation)
+                        breaker.record_failure()
+                        if isinstance(e, ServiceUnavailable):
+                            raise
+                        raise ServiceUnavailable(f"{breaker.name} unreachable: {e}") from e
+                    except Exception:
+                        breaker.record_success()
+                        raise
+                    breaker.record_success()
+                    return r
+                finally:
+                    _guarded_call.reset(token)
+        else:
+            def wrapper(*args, **kwargs):
+                if _guarded_call.get():
+                    return method(*args, **kwargs)
+                token = _guarded_call.set(True)
+                try:
+                    return call(method, *args, **kwargs)
+                finally:
+                    _guarded_call.reset(token)
+        return wrapper
+
+    return decorate_orchestrator(co, decorator)
+
+
 def container_orchestrator_factory(s) -> IContainerOrchestrator:
     """
     Factory method for container orchestrators
@@ -742,7 +2122,20 @@ def container_orchestrator_factory(s) -> IContainerOrchestrator:
     """
     if s.lower() in ("docker", "docker_compose"):
         return DockerCompose()
+    elif s.lower() == "docker_hosts":
+        return DockerHosts(parse_docker_hosts(os.getenv("DOCKER_HOSTS")),
+                           max_pool_size=int(os.getenv("DOCKER_HOSTS_POOL_SIZE", default=10)))
     elif s.lower() == "kubernetes":
         return Kubernetes()
+    elif s.lower() == "simulated":
+        return Simulated(start_latency=float(os.getenv("SIM_START_LATENCY_SEC", default=0)),
+                         ready_latency=float(os.getenv("SIM_READY_LATENCY_SEC", default=0)),
+                         failure_rate=float(os.getenv("SIM_FAILURE_RATE", default=0)),
+                         api_latency=float(os.getenv("SIM_API_LATENCY_SEC", default=0)),
+                         activity=os.getenv("SIM_ACTIVITY", default="busy"),
+                         seed=os.getenv("SIM_SEED"),
+                         nodes=os.getenv("SIM_NODES", default="sim-node-1,sim-node-2").split(","),
+                         base_containers=[name for name in (os.getenv("NGINX_NAME"), os.getenv("TDSLICERHUB_NAME"))
+                                          if name])
     else:
         raise Exception(f"Orchestrator {s} not implemented")
@@ -0,0 +1,101 @@
+"""
+Bulk pre-provisioning of sessions for classes and workshops: before the class starts, an administrator launches the
+sessions of a list of users (or of the members of an LDAP group), so the logins of the students are reconnects
+instead of cold starts arriving all at the same time.
+
+The launches of a batch run concurrently (at most PROVISION_PARALLELISM at a time) and the reverse proxy is
+reconfigured once, when all of them finished. The batch keeps the outcome of each user:
+  - "launch": a session was created by the batch (its progress is the one of its launch job)
+  - "existing": the user already had a session
+  - "no_capacity": the hub was full (MAX_SESSIONS)
+  - "error": the session could not be created
+"""
+import time
+import uuid
+from typing import List, Optional
+
+import ldap3
+from ldap3.utils.conv import escape_filter_chars
+from pydantic import BaseModel
+
+GROUP_CLASSES = ("posixGroup", "groupOfNames", "groupOfUniqueNames")
+
+
+class ProvisionRequest(BaseModel):
+    users: List[str] = []
+    group: Optional[str] = None  # "cn" of an LDAP group under "ldap_base"
+    gpu: bool = False
+    parallelism: Optional[int] = None  # Overrides PROVISION_PARALLELISM
+
+
+def group_members(attributes):
+    """
+    Users of an LDAP group entry
+
+    :param attributes: attributes of the group: "memberUid" (posixGroup) and/or "member", "uniqueMember" (DNs, of
+                       which the "uid" is taken)
+    :return: user ids, in order and without repetitions
+    """
+    users = list(attributes.get("memberUid") or [])
+    for dn in list(attributes.get("member") or []) + list(attributes.get("uniqueMember") or []):
+        rdn = dn.split(",", 1)[0].strip()
+        if rdn.lower().startswith("uid="):
+            users.append(rdn[4:])
+    return list(dict.fromkeys(u.strip() for u in users if u.strip()))
+
+
+def ldap_group_members(address, base, group, bind_dn=None, password=None, timeout=None):
+    """
+    Search an LDAP group and return its users (blocking, call it in a thread)
+
+    :param bind_dn: anonymous bind if None
+    :param timeout: seconds to connect, and to wait for each answer of the server
+    :return: user ids. LookupError if the group does not exist
+    """
+    classes = "".join(f"(objectClass={c})" for c in GROUP_CLASSES)
+    with ldap3.Connection(ldap3.Server(address, connect_timeout=timeout), user=bind_dn, password=password,
+                          read_only=True, receive_timeout=timeout) as conn:
+        conn.search(base, f"(&(cn={escape_filter_chars(group)})(|{classes}))",
+                    attributes=["memberUid", "member", "uniqueMember"])
+        entries = [e for e in conn.response if e.get("type") == "searchResEntry"]
+    if not entries:
+        raise LookupError(f"LDAP group {group} not found")
+    return group_members(entries[0].get("attributes", {}))
+
+
+class ProvisionBatch:
+    def __init__(self, users, admin=None, group=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.admin = admin
+        self.group = group
+        self.users = list(dict.fromkeys(users))
+        self.created_at = time.time()
+        self.finished_at = None
+        self.outcomes = {u: dict(outcome="pending", session=None, error=None) for u in self.users}
+        self.task = None
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    def record(self, user, outcome, session=None, error=None):
+        self.outcomes[user] = dict(outcome=outcome, session=session, error=error)
+
+    def status(self, launch_status):
+        """
+        :param launch_status: function (session uuid) -> status of its launch job (see "LaunchJob.status"), or None
+        :return: outcome and launch phase of each user
+        """
+        users = []
+        for user in self.users:
+            o = self.outcomes[user]
+            st = launch_status(o["session"]) if o["session"] else None
+            users.append(dict(user=user, outcome=o["outcome"], session=str(o["session"]) if o["session"] else None,
+                              phase=st["phase"] if st else None, error=o["error"] or (st["error"] if st else None)))
+        counts = dict()
+        for u in users:
+            key = u["phase"] if u["outcome"] == "launch" else u["outcome"]
+            counts[key] = counts.get(key, 0) + 1
+        return dict(batch=self.id, admin=self.admin, group=self.group, done=self.done, created=self.created_at,
+                    elapsed_sec=round((self.finished_at or time.time()) - self.created_at, 1), counts=counts,
+                    users=users)
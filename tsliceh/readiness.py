@@ -0,0 +1,78 @@
+"""
+Readiness of a 3DSlicer session: the container being "running" only means its process started, KasmVNC and the Slicer
+UI take longer. Before redirecting a user to a new session the hub probes what the browser will use, through the
+same address as the reverse proxy ("service_address"):
+  - HTTP: "GET /" answers with a non 5xx status
+  - websocket: the upgrade of "/websockify" (proxied from "/{uuid}-ws") answers "101 Switching Protocols"
+Probes are repeated with exponential backoff until both succeed or a deadline passes.
+"""
+import asyncio
+import base64
+import os
+import time
+
+from fastapi.logger import logger
+
+
+async def _http_status(address, path, headers=(), timeout=2.0):
+    """
+    Send a GET request and read the status line of the response
+
+    :param address: "host:port"
+    :return: HTTP status code, None if the connection failed or the answer was not HTTP
+    """
+    host, port = address.rsplit(":", 1)
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), timeout)
+    except (OSError, asyncio.TimeoutError, ValueError):
+        return None
+    try:
+        request = [f"GET {path} HTTP/1.1", f"Host: {address}"] + list(headers) + ["Connection: close", "", ""]
+        writer.write("\r\n".join(request).encode())
+        await writer.drain()
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        parts = line.decode("latin-1").split()
+        return int(parts[1]) if len(parts) >= 2 and parts[0].startswith("HTTP/") and parts[1].isdigit() else None
+    except (OSError, asyncio.TimeoutError, UnicodeDecodeError):
+        return None
+    finally:
+        writer.close()
+
+
+async def probe_http(address, path="/", timeout=2.0):
+    status = await _http_status(address, path, timeout=timeout)
+    return status is not None and status < 500
+
+
+async def probe_websocket(address, path="/websockify", timeout=2.0):
+    key = base64.b64encode(os.urandom(16)).decode()
+    headers = ["Upgrade: websocket", "Connection: Upgrade", f"Sec-WebSocket-Key: {key}",
+               "Sec-WebSocket-Version: 13", "Sec-WebSocket-Protocol: binary"]
+    return await _http_status(address, path, headers, timeout) == 101
+
+
+async def probe_session(address, ws_path="/websockify", timeout=2.0):
+    """ True if both the HTTP and the websocket endpoints of a session answer """
+    return await probe_http(address, "/", timeout) and await probe_websocket(address, ws_path, timeout)
+
+
+async def wait_until_usable(probe, deadline_sec=120.0, initial_delay=0.5, max_delay=5.0):
+    """
+    Repeat a probe with exponential backoff (initial_delay, x2 each attempt, at most max_delay) until it succeeds
+
+    :param probe: coroutine function without arguments, returning True when the session is usable
+    :return: (usable, seconds waited, attempts)
+    """
+    t0 = time.monotonic()
+    delay = initial_delay
+    attempts = 0
+    while True:
+        attempts += 1
+        if await probe():
+            return True, time.monotonic() - t0, attempts
+        remaining = deadline_sec - (time.monotonic() - t0)
+        if remaining <= 0:
+            logger.warning(f"readiness: not usable after {attempts} probes in {deadline_sec} s")
+            return False, time.monotonic() - t0, attempts
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
@@ -0,0 +1,250 @@
+"""
+Replay a journal of session lifecycle events (recorded with JOURNAL_FILE, see "tsliceh.journal") through the hub,
+at accelerated speed, with the "Simulated" container orchestrator. Used to tune capacity (MAX_SESSIONS) and
+inactivity timeout (INACTIVITY_TIME_SEC) offline against real traffic: class starts, lunch-break idling,
+reconnect storms...
+
+  - logins, shares, unshares and closes are sent to the hub at their (scaled) recorded times
+  - recorded CPU activity samples drive the CPU reported by the simulated containers
+  - the sessions checker sweeps every "--sweep-period" seconds of recorded time; expirations are decided by the hub
+    with the settings being tested, not copied from the journal
+
+Usage:
+  python -m tsliceh.replay /srv/journal.log --speed 60 --max-sessions 40 --inactivity-sec 1800 --out replay.json
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from tsliceh import benchmarks
+from tsliceh.journal import read_journal
+
+
+def load_events(paths, since=None, until=None):
+    """
+    :param paths: journal files (each one with its rotated files)
+    :param since: UNIX time, skip events before it
+    :param until: UNIX time, skip events after it
+    :return: list of events sorted by time
+    """
+    events = []
+    for path in paths:
+        for ev in read_journal(path):
+            if (since is None or ev["t"] >= since) and (until is None or ev["t"] <= until):
+                events.append(ev)
+    events.sort(key=lambda ev: ev["t"])
+    return events
+
+
+def recorded_summary(events):
+    """ Figures of the recorded traffic, to compare with the replay """
+    logins = [ev for ev in events if ev["e"] == "login"]
+    concurrent = 0
+    peak = 0
+    for ev in events:
+        if (ev["e"] == "login" and ev.get("o") == "launch") or ev["e"] == "admit":
+            concurrent += 1
+            peak = max(peak, concurrent)
+        elif ev["e"] in ("close", "expire"):
+            concurrent = max(0, concurrent - 1)
+    return dict(start=datetime.datetime.fromtimestamp(events[0]["t"]).isoformat() if events else None,
+                duration_sec=events[-1]["t"] - events[0]["t"] if events else 0,
+                logins=len(logins),
+                launched=sum(1 for ev in logins if ev.get("o") == "launch") + sum(1 for ev in events if ev["e"] == "admit"),
+                queued=sum(1 for ev in logins if ev.get("o") == "queued"),
+                closed=sum(1 for ev in events if ev["e"] == "close"),
+                expired=sum(1 for ev in events if ev["e"] == "expire"),
+                peak_sessions=peak)
+
+
+class Replayer:
+    def __init__(self, main, speed=60.0, sweep_period=60.0):
+        self.main = main
+        self.speed = speed
+        self.sweep_period = sweep_period
+        self.sessions = dict()  # user -> session uuid (as returned by the hub in this replay)
+        self.tickets = dict()  # user -> waiting room ticket id
+        self.login_results = []
+        self.queue_waits = []
+        self.sweep_times = []
+        self.expired = 0
+        self.peak_sessions = 0
+        self.peak_queue = 0
+        self.skipped = 0
+
+    def container_name(self, user):
+        co = self.main.container_orchestrator
+        return self.main.CONTAINER_NAME_PREFIX + co.get_valid_name(user)
+
+    async def do_login(self, user):
+        latency, outcome = await benchmarks.login(self.main, user)
+        self.login_results.append((latency, outcome))
+        if outcome == "queued":
+            for t in self.main.waiting_room._waiting.values():
+                if t.user == user:
+                    self.tickets[user] = t.id
+        elif outcome == "session":
+            async with self.main.orm_session_maker() as sess:
+                s = await self.main.get_session_by_user(sess, user)
+            if s:
+                self.sessions[user] = str(s.uuid)
+
+    async def do_post(self, path):
+        status, _, _ = await benchmarks.asgi_request(self.main.app, "POST", path)
+        return status
+
+    def handle(self, ev):
+        """ Apply an event. Logins are launched as tasks, so they overlap like real ones """
+        e = ev["e"]
+        user = ev.get("u")
+        if e == "login":
+            if ev.get("o") in ("launch", "reconnect", "queued"):
+                return asyncio.get_running_loop().create_task(self.do_login(user))
+        elif e == "activity":
+            cpu = ev.get("cpu", -1)
+            name = self.container_name(user)
+            co = self.main.container_orchestrator
+            if cpu >= 0 and co.get_container_status(name) == "running":
+                co.set_container_activity(name, cpu)
+            else:
+                self.skipped += 1
+        elif e in ("share", "unshare", "close"):
+            uuid = self.sessions.get(user)
+            if uuid is None:
+                self.skipped += 1
+                return
+            if e == "share":
+                path = f"/sessions/{uuid}/share?interactive={int(bool(ev.get('i')))}"
+            elif e == "unshare":
+                path = f"/sessions/{uuid}/unshare"
+            else:
+                path = f"/sessions/{uuid}/close"
+                del self.sessions[user]
+            return asyncio.get_running_loop().create_task(self.do_post(path))
+        # "phase", "admit", "expire": outcomes of the recorded run, not inputs of the replay
+
+    async def checker(self):
+        """ The sessions checker loop, accelerated """
+        main = self.main
+        while True:
+            await asyncio.sleep(self.sweep_period / self.speed)
+            t0 = time.perf_counter()
+            states = await main.runner.sweep(main.orm_session_maker)
+            self.sweep_times.append(time.perf_counter() - t0)
+            self.expired += states["expired"]
+            self.peak_sessions = max(self.peak_sessions, states["active"] + states["idle"])
+            self.peak_queue = max(self.peak_queue, len(main.waiting_room))
+            # Users in the waiting room keep their page open (poll their tickets)
+            for user, ticket_id in list(self.tickets.items()):
+                t = main.waiting_room.get(ticket_id)
+                if t is None:
+                    del self.tickets[user]
+                elif t.session_uuid:
+                    self.sessions[user] = str(t.session_uuid)
+                    self.queue_waits.append((t.admitted_at - t.enqueued_at) * self.speed)
+                    del self.tickets[user]
+            main.waiting_room.expire_abandoned()
+            await main.admit_waiting_users()
+
+    async def run(self, events):
+        if not events:
+            return
+        loop = asyncio.get_running_loop()
+        checker = loop.create_task(self.checker())
+        tasks = []
+        t0 = events[0]["t"]
+        wall0 = loop.time()
+        for ev in events:
+            delay = wall0 + (ev["t"] - t0) / self.speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = self.handle(ev)
+            if task:
+                tasks.append(task)
+        await asyncio.gather(*tasks)
+        # One last sweep period, for the expirations of the end of the recording
+        await asyncio.sleep(self.sweep_period / self.speed)
+        checker.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await checker
+
+    def summary(self):
+        _ = benchmarks.summarize_logins(self.login_results)
+        _.update(expired=self.expired,
+                 peak_sessions=self.peak_sessions,
+                 peak_queue=self.peak_queue,
+                 queue_wait_sec=benchmarks.percentiles(self.queue_waits),
+                 sweep_time=benchmarks.percentiles(self.sweep_times),
+                 skipped_events=self.skipped)
+        return _
+
+
+def container_start_latency(events):
+    """ Median recorded time to start a container (seconds), None if there is no launch in the journal """
+    _ = [ev["d"] for ev in events if ev["e"] == "phase" and ev.get("p") == "container_start" and "d" in ev]
+    return statistics.median(_) if _ else None
+
+
+def run(args):
+    events = load_events(args.journal, since=args.since, until=args.until)
+    start_latency = args.start_latency
+    if start_latency is None:
+        start_latency = container_start_latency(events) or 0
+    work_dir = tempfile.mkdtemp(prefix="tsliceh-replay-")
+    benchmarks.configure_environment(work_dir, max_sessions=args.max_sessions, inactivity_sec=args.inactivity_sec,
+                                     sim=dict(SIM_START_LATENCY_SEC=start_latency / args.speed,
+                                              SIM_ACTIVITY="idle", SIM_SEED=args.seed))
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull if not args.verbose else sys.stdout):
+        main = benchmarks.load_hub()
+        # Settings being tested (the inactivity timeout runs on the accelerated clock)
+        main.max_sessions = args.max_sessions
+        main.allowed_inactivity_time_in_seconds = args.inactivity_sec / args.speed
+        main.activity_tracker.tau_sec /= args.speed
+        main.activity_tracker.max_unattended_sec /= args.speed
+        benchmarks.reset_hub(main)
+        replayer = Replayer(main, speed=args.speed, sweep_period=args.sweep_period)
+        t0 = time.perf_counter()
+        asyncio.run(replayer.run(events))
+        wall_time = time.perf_counter() - t0
+        benchmarks.reset_hub(main)
+    return dict(meta=dict(date=datetime.datetime.now().isoformat(), git_revision=benchmarks.git_revision(),
+                          journal=args.journal, speed=args.speed, max_sessions=args.max_sessions,
+                          inactivity_sec=args.inactivity_sec, start_latency_sec=start_latency,
+                          wall_time=wall_time, events=len(events)),
+                recorded=recorded_summary(events),
+                replayed=replayer.summary())
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a journal of 3DSlicer Hub sessions (simulated containers)")
+    parser.add_argument("journal", nargs="+", help="Journal file(s), rotated files are read too")
+    parser.add_argument("--speed", type=float, default=60, help="Acceleration factor (60: one hour in one minute)")
+    parser.add_argument("--max-sessions", type=int, default=1000, help="MAX_SESSIONS to test")
+    parser.add_argument("--inactivity-sec", type=int, default=900, help="INACTIVITY_TIME_SEC to test")
+    parser.add_argument("--sweep-period", type=float, default=60, help="Period of the sessions checker (seconds)")
+    parser.add_argument("--start-latency", type=float, default=None,
+                        help="Container start time (seconds); default: median recorded 'container_start' phase")
+    parser.add_argument("--since", type=float, default=None, help="Replay events from this UNIX time")
+    parser.add_argument("--until", type=float, default=None, help="Replay events until this UNIX time")
+    parser.add_argument("--seed", type=int, default=0, help="SIM_SEED")
+    parser.add_argument("--out", default="-", help="JSON output file ('-' for stdout)")
+    parser.add_argument("--verbose", action="store_true", help="Do not hide the output of the hub")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run(args)
+    if args.out == "-":
+        json.dump(results, sys.stdout, indent=2, default=str)
+    else:
+        with open(args.out, "wt") as f:
+            json.dump(results, f, indent=2, default=str)
+        print(f"Results written to {args.out}", file=sys.stderr)
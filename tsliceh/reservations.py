@@ -0,0 +1,87 @@
+"""
+Reservations: sessions booked for a time window (a class in the timetable), for a list of users and/or the members of
+an LDAP group, with a resource profile.
+
+  - RESERVATION_LEAD_SEC before the window starts, the scheduler of the sessions checker launches the sessions of the
+    users without one (bulk provisioning, see "tsliceh.provisioning") and holds them: they are not expired by
+    inactivity before the window starts (from then, the inactivity is counted since the start)
+  - from that moment until the end of the window, the room of the users still without a session is reserved, so
+    ad-hoc logins cannot take it (they go to the waiting room)
+  - a held session is claimed when its user logs in. When the window passes the reservation is released, removing
+    the sessions that were not claimed
+"""
+import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+PROFILES = dict(default=dict(gpu=False), gpu=dict(gpu=True))  # Resource profile -> launch options
+OPEN_STATES = ("scheduled", "launched")
+
+
+class ReservationRequest(BaseModel):
+    name: Optional[str] = None
+    starts_at: datetime.datetime
+    ends_at: datetime.datetime
+    users: List[str] = []
+    group: Optional[str] = None  # "cn" of an LDAP group under "ldap_base"
+    profile: str = "default"
+
+
+def session_profile(gpu):
+    """ Resource profile of a session """
+    return "gpu" if gpu else "default"
+
+
+def parse_profile_values(spec, defaults):
+    """
+    :param spec: "profile=value,..." e.g. "default=2048,gpu=8192"
+    :param defaults: dictionary profile -> value, for the profiles not in "spec"
+    :return: dictionary profile -> value (int), for all the profiles
+    """
+    values = dict(defaults)
+    for item in (spec or "").split(","):
+        if "=" in item:
+            k, v = item.split("=", 1)
+            if k.strip() not in PROFILES:
+                raise ValueError(f"Unknown resource profile '{k.strip()}', expected one of {list(PROFILES)}")
+            values[k.strip()] = int(v)
+    return values
+
+
+def local_naive(t):
+    """ Datetimes of the hub are naive, in local time """
+    return t.astimezone().replace(tzinfo=None) if t.tzinfo else t
+
+
+def holds_room(r, now, lead_sec):
+    """ True if a reservation is about to start (within the lead time) or in progress """
+    return r.state in OPEN_STATES and r.starts_at - datetime.timedelta(seconds=lead_sec) <= now < r.ends_at
+
+
+def reserved_room(reservations, users_with_session, now, lead_sec, user=None, reservation_id=None):
+    """
+    Room held by the reservations: their users without a session yet
+
+    :param users_with_session: set of users who have a session
+    :param user: do not count the reservations of this user (logging in, the room is theirs)
+    :param reservation_id: do not count this reservation (launching its sessions)
+    :return: number of sessions
+    """
+    held = set()
+    for r in reservations:
+        users = set(r.users or [])
+        if r.id == reservation_id or user in users or not holds_room(r, now, lead_sec):
+            continue
+        held |= users - users_with_session
+    return len(held)
+
+
+def reservation_status(r, sessions):
+    """
+    :param sessions: sessions of the reservation
+    :return: dict, for the administration API
+    """
+    return dict(id=str(r.id), name=r.name, state=r.state, profile=r.profile, group=r.group,
+                starts_at=r.starts_at.isoformat(), ends_at=r.ends_at.isoformat(), created_by=r.created_by,
+                users=list(r.users or []), launched=len(sessions), held=sum(1 for s in sessions if s.held))
@@ -0,0 +1,152 @@
+"""
+Fail fast when a service the hub depends on (the container orchestrator: Docker daemons or the Kubernetes API server;
+LDAP) is degraded, instead of piling up coroutines and threads waiting for it.
+
+  - deadlines: every kubectl command (KUBECTL_TIMEOUT_SEC), Docker API request (DOCKER_TIMEOUT_SEC) and LDAP
+    operation (LDAP_TIMEOUT_SEC) has a timeout, and the long orchestrator operations (start and relaunch of a
+    container) have their own deadline (ORCHESTRATOR_START_TIMEOUT_SEC). Missing one raises "DeadlineExceeded"
+  - retries: idempotent operations (reads) are retried with exponential backoff and jitter, see "backoff_delays"
+  - circuit breakers: after BREAKER_FAILURES consecutive failures of a service (unreachable, timed out) its breaker
+    opens, and calls fail at once with "CircuitOpenError" for BREAKER_RESET_SEC. Then a single trial call is let
+    through ("half_open"): if it works the breaker closes, otherwise it opens again
+Answers of the service, even errors (a missing container, a wrong password), are not failures: it is working.
+The state of the breakers and the deadlines missed are exported in /metrics.
+"""
+import random
+import threading
+import time
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATES = (CLOSED, HALF_OPEN, OPEN)
+
+
+class ServiceUnavailable(RuntimeError):
+    """ A service the hub depends on is not working: unreachable, timed out, or its circuit breaker is open """
+
+
+class DeadlineExceeded(ServiceUnavailable, TimeoutError):
+    def __init__(self, operation, timeout_sec):
+        super().__init__(f"{operation} did not finish in {timeout_sec:g} s")
+        self.operation = operation
+        self.timeout_sec = timeout_sec
+
+
+class CircuitOpenError(ServiceUnavailable):
+    pass
+
+
+def backoff_delays(attempts, initial_delay=0.5, max_delay=10.0):
+    """
+    Delays before the retries of an operation: exponential, with +-25% jitter so callers do not retry in lockstep
+
+    :param attempts: total number of attempts (the first one is not delayed)
+    :return: generator of attempts - 1 delays, in seconds
+    """
+    delay = initial_delay
+    for _ in range(attempts - 1):
+        yield min(delay, max_delay) * random.uniform(0.75, 1.25)
+        delay *= 2
+
+
+def retry_call(fn, *args, attempts=3, initial_delay=0.5, max_delay=10.0, retry_on=(ServiceUnavailable,), **kwargs):
+    """
+    Call a function, retrying with backoff while it raises one of "retry_on". Only for idempotent operations.
+    An open circuit is not retried: the breaker already knows the service is down
+    """
+    delays = backoff_delays(attempts, initial_delay, max_delay)
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except CircuitOpenError:
+            raise
+        except retry_on:
+            delay = next(delays, None)
+            if delay is None:
+                raise
+            time.sleep(delay)
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_timeout_sec=30.0):
+        """
+        :param name: name of the protected service, e.g. "orchestrator", "ldap"
+        :param failure_threshold: consecutive failures opening the breaker
+        :param reset_timeout_sec: time the breaker stays open before a trial call is let through
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_sec = reset_timeout_sec
+        self._lock = threading.Lock()  # Used from the event loop and from threads
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = False  # A trial call is in progress (half open)
+        self.on_timeout = []  # Callbacks (operation), see "timed_out"
+
+    def _reset_due(self):
+        return time.monotonic() - self._opened_at >= self.reset_timeout_sec
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and self._reset_due():
+                return HALF_OPEN
+            return self._state
+
+    def check(self):
+        """ Raise CircuitOpenError if calls are not allowed now. When half open, only one trial call is allowed """
+        with self._lock:
+            if self._state == CLOSED:
+                return
+            if self._state == OPEN and not self._reset_due():
+                retry_in = self.reset_timeout_sec - (time.monotonic() - self._opened_at)
+                raise CircuitOpenError(f"{self.name} unavailable ({self._failures} consecutive failures), "
+                                       f"retrying in {retry_in:.0f} s")
+            if self._trial:
+                raise CircuitOpenError(f"{self.name} unavailable, checking whether it recovered")
+            self._state = HALF_OPEN
+            self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def timed_out(self, operation):
+        """ A call to the service missed its deadline (also a failure, recorded by the caller) """
+        for cb in self.on_timeout:
+            cb(operation)
+
+    def call(self, fn, *args, failures=(ServiceUnavailable,), **kwargs):
+        """
+        Call a function through the breaker
+
+        :param failures: exceptions meaning the service is not working. Other exceptions are answers of the service
+        """
+        self.check()
+        try:
+            r = fn(*args, **kwargs)
+        except failures as e:
+            if isinstance(e, DeadlineExceeded):
+                self.timed_out(e.operation)
+            self.record_failure()
+            raise
+        except Exception:
+            self.record_success()
+            raise
+        self.record_success()
+        return r
+
+    def status(self):
+        with self._lock:
+            return dict(breaker=self.name, state=self._state if not (self._state == OPEN and self._reset_due())
+                        else HALF_OPEN, failures=self._failures)
@@ -8,7 +8,7 @@ from dotenv import load_dotenv
 
 from fastapi.testclient import TestClient
 import asyncio
-from tsliceh.main import app, orm_session_maker, allowed_inactivity_time_in_seconds
+from tsliceh.main import app, orm_session_maker, allowed_inactivity_time_in_seconds, get_session_by_user
 from tsliceh import Session3DSlicer
 import pytest
 import os
@@ -38,19 +38,23 @@ def compare_time_min(file):
     return (file_mod_time.tm_mday, file_mod_time.tm_hour,file_mod_time.tm_min == now.tm_mday, now.tm_hour, now.tm_min)
 
 
+async def find_session(user, delete=False):
+    async with orm_session_maker() as session:
+        s = await get_session_by_user(session, user)
+        if s and delete:
+            try:
+                await session.delete(s)
+                await session.commit()
+            except Exception as e:
+                logger.info(e.args)
+        return s
+
+
 @pytest.fixture(autouse="module")
 def clean_user_container():
     yield
-    session = orm_session_maker()
-    s = session.query(Session3DSlicer).filter(Session3DSlicer.user == data["username"]).first()
-    if s:
-        try:
-            session.delete(s)
-            session.commit()
-        except Exception as e:
-            logger.info(e.args)
-        finally:
-            remove_container()
+    if asyncio.run(find_session(data["username"], delete=True)):
+        remove_container()
 
 
 @pytest.fixture
@@ -115,8 +119,7 @@ def test_delete_container_and_session(client):
     tic = time.perf_counter()
     time.sleep(waiting)
     # any 3DslicerSession?
-    session = orm_session_maker()
-    s = session.query(Session3DSlicer).filter(Session3DSlicer.user == data["username"]).first()
+    s = asyncio.run(find_session(data["username"]))
     assert s is None
     index_file = os.getenv("INDEX_PATH")
     nginx_conf_file = os.getenv("NGINX_CONFIG_FILE")
@@ -134,13 +137,14 @@ def test_create_volume(client):
     from tsliceh.volumes import volume_dict, vol_dict
     test_launch_container(client)
     dc = docker.from_env()
-    volumes = volume_dict(data["username"])
     container = dc.containers.get(CONTAINER_NAME_PREFIX + data["username"])
+    binds = container.attrs["HostConfig"]["Binds"]
+    shared = [b.split(":")[0] for b in binds if b.startswith("slicer-shared-")]  # Shared cache, if it was populated
+    volumes = volume_dict(data["username"], shared_cache=shared[0] if shared else None)
     l = list()
     # "{f"{user}_{k}": {"bind": v, "mode": "rw"}})"
     for k,v in volumes.items():
         l.append(k + ":" + v["bind"] + ":" + v["mode"])
     l.sort()
-    binds = container.attrs["HostConfig"]["Binds"]
     binds.sort()
     assert l == binds
@@ -0,0 +1,86 @@
+from tsliceh.activity import ActivityTracker, ProxyAccessLog, RingBuffer, parse_signal_values, DEFAULT_WEIGHTS, \
+    DEFAULT_THRESHOLDS, parse_cpu_steps, cpu_allowance
+from tsliceh.fair_share import FairShare, parse_class_weights, parse_user_quotas
+from tsliceh.orchestrators import parse_proc_net_dev
+
+
+def test_ring_buffer():
+    b = RingBuffer(3)
+    for v in (1, None, 3, 4):
+        b.append(v)
+    assert len(b) == 3
+    assert b.values() == [None, 3, 4]
+
+
+def test_reading_user_is_active_and_runaway_loop_is_not():
+    tracker = ActivityTracker(policy="weighted", tau_sec=180, max_unattended_sec=3600)
+    rx = tx = 0
+    for i in range(10):  # A user reading a scene: almost no CPU, mouse events and small frame updates
+        rx, tx = rx + 60 * 800, tx + 60 * 5000
+        a = tracker.sample("reader", cpu=1, net=(rx, tx), t=i * 60)
+    assert a.active
+
+    for i in range(10):  # A single CPU spike fades away in a few minutes
+        a = tracker.sample("idle", cpu=90 if i == 5 else 0.5, net=(0, 0), t=i * 60)
+        assert a.active == (i in (5, 6, 7))
+
+    for i in range(90):  # A forgotten background loop: busy CPU, nobody in front of it
+        a = tracker.sample("runaway", cpu=100, net=(0, 0), t=i * 60)
+    assert not a.active
+    assert tracker.get("runaway").history()[-1]["cpu"] == 100
+
+    tracker = ActivityTracker(policy="cpu")
+    assert tracker.sample("x", cpu=50, t=0).active and not tracker.sample("y", cpu=5, t=0).active
+
+
+def test_signal_values_and_parsers(tmp_path):
+    assert parse_signal_values("rx=3", DEFAULT_WEIGHTS)["rx"] == 3
+    steps = parse_cpu_steps("600=0.5, 300=1")
+    assert steps == [(300, 1), (600, 0.5)]
+    assert [cpu_allowance(t, steps) for t in (0, 300, 599, 3600)] == [None, 1, 1, 0.5]
+    assert parse_cpu_steps("") == []
+    assert parse_proc_net_dev("h1\nh2\n  lo: 10 0 0 0 0 0 0 0 10 0\neth0: 100 1 0 0 0 0 0 0 200 2\n") == (100, 200)
+
+    log = tmp_path / "access.log"
+    uuid = "0b5a0f3c-6d1e-4a53-9d6c-2a1e5a3b7f10"
+    log.write_text(f'1.2.3.4 - - [01/Jan/2024:00:00:00 +0000] "GET /{uuid}/app.js HTTP/1.1" 200 1500 "-" "ua"\n')
+    proxy = ProxyAccessLog(str(log))
+    proxy.read()
+    with open(log, "a") as f:
+        f.write(f'1.2.3.4 - - [01/Jan/2024:00:00:01 +0000] "GET /{uuid}-ws HTTP/1.1" 101 700 "-" "ua"\n')
+    proxy.read()
+    assert proxy.session_bytes(uuid) == 2200
+
+
+def test_add_missing_columns(tmp_path):
+    from sqlalchemy import create_engine, inspect, text
+    from tsliceh import create_tables
+    engine = create_engine(f"sqlite:///{tmp_path}/old.sqlite")
+    with engine.begin() as conn:  # "sessions" before sharing flags and activity had their own columns
+        conn.execute(text("CREATE TABLE sessions (uuid CHAR(32) PRIMARY KEY, created_at DATETIME, "
+                          "last_activity DATETIME, user VARCHAR(64) NOT NULL UNIQUE, url_path VARCHAR(1024), "
+                          "service_address VARCHAR(1024), container_name VARCHAR(128), restart BOOLEAN NOT NULL, "
+                          "gpu BOOLEAN NOT NULL, info JSON)"))
+        conn.execute(text("INSERT INTO sessions (uuid, user, restart, gpu, info) VALUES "
+                          "('0b5a0f3c6d1e4a539d6c2a1e5a3b7f10', 'u1', 0, 0, "
+                          "'{\"CPU_pct\": 3, \"shared\": true, \"shared_interactive\": 1}'), "
+                          "('1b5a0f3c6d1e4a539d6c2a1e5a3b7f10', 'u2', 0, 0, '{\"CPU_pct\": 3, \"shared\": false}')"))
+    create_tables(engine)
+    assert "session_activity" in inspect(engine).get_table_names()
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT user, shared, shared_interactive, cpu_pct, state FROM sessions "
+                                 "ORDER BY user"))
+        assert [tuple(r) for r in rows] == [("u1", 1, 1, None, "routed"), ("u2", 0, 0, None, "routed")]
+    create_tables(engine)  # Idempotent
+
+
+def test_fair_share_classes_and_weights():
+    fs = FairShare(DEFAULT_THRESHOLDS, parse_class_weights("batch=0.25"), parse_user_quotas("teacher=2"), batch_cpu=150)
+    assert fs.decide("s1", "ana", dict(cpu=20, rx=900, tx=None, proxy=None)) == ("interactive", 4.0, True)
+    assert fs.decide("s2", "bob", dict(cpu=380, rx=10, tx=50000, proxy=None)) == ("batch", 0.25, True)
+    assert fs.decide("s3", "teacher", dict(cpu=5, rx=0, tx=0, proxy=None)) == ("normal", 2.0, True)
+    fs.applied("s1", 4.0)
+    assert fs.decide("s1", "ana", dict(cpu=20, rx=900)) == ("interactive", 4.0, False)  # Unchanged, not set again
+    fs.reset("s1")
+    assert fs.decide("s1", "ana", dict(cpu=20, rx=900))[2] is True
+    assert fs.counts() == dict(interactive=1, normal=1, batch=1)
@@ -0,0 +1,284 @@
+import asyncio
+import os
+import tempfile
+import time
+
+import pytest
+from sqlalchemy import update
+
+from tsliceh import benchmarks
+
+_tmp_dir = tempfile.mkdtemp(prefix="tsliceh-test-")
+for k, v in dict(CONTAINER_ORCHESTRATOR="simulated", MODE="local", INACTIVITY_TIME_SEC="900", MAX_SESSIONS="2",
+                 DB_CONNECTION_STRING=f"sqlite:///{_tmp_dir}/sessions.sqlite",
+                 NGINX_CONFIG_FILE=f"{_tmp_dir}/nginx.conf").items():
+    os.environ.setdefault(k, v)
+
+
+@pytest.fixture(scope="module")
+def hub():
+    try:
+        main = benchmarks.load_hub()
+    except RuntimeError as e:
+        pytest.skip(str(e))
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    max_sessions = main.max_sessions
+    main.max_sessions = 100000
+    yield main
+    benchmarks.reset_hub(main)
+    main.max_sessions = max_sessions
+    loop.close()
+
+
+def test_percentiles():
+    assert benchmarks.percentiles([]) == dict(p50=None, p95=None, p99=None)
+    p = benchmarks.percentiles(list(range(1, 101)))
+    assert p == dict(p50=50, p95=95, p99=99)
+
+
+def test_scenarios_smoke(hub):
+    r = benchmarks.scenario_login_storm(hub, users=10, seconds=0.1)
+    assert r["launched"] == 10 and r["errors"] == 0
+    r = benchmarks.scenario_steady_state(hub, sessions=10, rounds=2, churn=0.2)
+    assert r["expired"] == 4 and r["errors"] == 0
+    r = benchmarks.scenario_mass_expiry(hub, sessions=10)
+    assert r["remaining"] == 0
+    r = benchmarks.scenario_scaling(hub, sizes=[5, 20], logins_per_size=2)
+    assert [e["sessions"] for e in r] == [5, 20]
+
+
+def test_journal_round_trip(tmp_path):
+    from tsliceh.journal import Journal, read_journal
+    j = Journal()
+    j.configure(str(tmp_path / "journal.log"), max_bytes=200, backup_count=5)
+    for i in range(20):
+        j.record("activity", u=f"user{i}", s=None, cpu=1.23456)
+    events = list(read_journal(str(tmp_path / "journal.log")))
+    assert len(list(tmp_path.iterdir())) > 1  # Rotated
+    assert [ev["u"] for ev in events][-3:] == ["user17", "user18", "user19"]
+    assert events[-1] == dict(t=events[-1]["t"], e="activity", u="user19", cpu=1.235)
+
+
+def test_replay_smoke(hub):
+    from tsliceh.replay import Replayer
+    t0 = 1700000000
+    events = [dict(t=t0, e="login", u="free_user_r0", o="launch"),
+              dict(t=t0 + 1, e="login", u="free_user_r1", o="launch"),
+              dict(t=t0 + 60, e="activity", u="free_user_r0", cpu=50),
+              dict(t=t0 + 61, e="share", u="free_user_r0", i=True),
+              dict(t=t0 + 120, e="close", u="free_user_r1")]
+    benchmarks.reset_hub(hub)
+    replayer = Replayer(hub, speed=100)
+    asyncio.get_event_loop().run_until_complete(replayer.run(events))
+    r = replayer.summary()
+    assert r["launched"] == 2 and r["errors"] == 0 and r["skipped_events"] == 0
+    assert list(replayer.sessions) == ["free_user_r0"]
+
+
+def test_no_db_session_leaks_under_concurrent_load(hub):
+    from tsliceh.metrics import DB_CONNECTIONS_IN_USE
+
+    async def client(i):
+        user = f"free_user_leak{i}"
+        await benchmarks.login(hub, user)
+        await benchmarks.login(hub, user)  # Reconnect
+        await benchmarks.asgi_request(hub.app, "GET", "/index.html")
+        async with hub.orm_session_maker() as sess:
+            s = await hub.get_session_by_user(sess, user)
+        await benchmarks.asgi_request(hub.app, "GET", f"/sessions/{s.uuid}")
+        await benchmarks.asgi_request(hub.app, "POST", f"/sessions/{s.uuid}/share?interactive=1")
+        await benchmarks.asgi_request(hub.app, "GET", f"/sessions/{s.uuid}/activity")
+        if i % 2:
+            await benchmarks.asgi_request(hub.app, "POST", f"/sessions/{s.uuid}/close")
+        with pytest.raises(Exception):  # Error path
+            await benchmarks.asgi_request(hub.app, "POST", "/sessions/00000000000000000000000000000000/close")
+
+    async def load():
+        await asyncio.gather(*[client(i) for i in range(20)], hub.runner.sweep(hub.orm_session_maker))
+
+    benchmarks.reset_hub(hub)
+    asyncio.get_event_loop().run_until_complete(load())
+    assert DB_CONNECTIONS_IN_USE._value.get() == 0
+    assert benchmarks.count_sessions(hub) == 10
+
+
+def test_reconcile_reattaches_live_sessions_in_parallel(hub):
+    co = hub.container_orchestrator
+    benchmarks.reset_hub(hub)
+    benchmarks.populate(hub, 40, prefix="free_user_live")
+    benchmarks.populate(hub, 1, prefix="free_user_dead")
+    co.stop_container(hub.CONTAINER_NAME_PREFIX + "free-user-dead0")
+    benchmarks.run_sync(co.start_container(hub.CONTAINER_NAME_PREFIX + "orphan", "slicer", "latest"))
+
+    async def stale_addresses():
+        async with hub.orm_session_maker() as sess:
+            await sess.execute(update(hub.Session3DSlicer).values(service_address="stale:6901"))
+            await sess.commit()
+
+    benchmarks.run_sync(stale_addresses())
+
+    co.api_latency = 0.05  # 40 sessions x 2 calls: 4 s if sequential
+    try:
+        t0 = time.perf_counter()
+        counts = benchmarks.run_sync(hub.runner.reconcile(hub.orm_session_maker))
+        elapsed = time.perf_counter() - t0
+    finally:
+        co.api_latency = 0
+    assert counts == dict(reattached=40, relaunched=0, deleted=1, orphans=2)
+    assert elapsed < 2
+    assert benchmarks.count_sessions(hub) == 40
+
+    async def addresses():
+        async with hub.orm_session_maker() as sess:
+            return {s.service_address for s in await hub.all_sessions(sess)}
+
+    assert "stale:6901" not in benchmarks.run_sync(addresses())
+    assert sorted(co.get_tdscontainers(hub.CONTAINER_NAME_PREFIX)) == \
+        sorted(hub.CONTAINER_NAME_PREFIX + f"free-user-live{i}" for i in range(40))
+
+
+def test_bulk_provisioning_launches_in_parallel_with_one_proxy_reload(hub):
+    from tsliceh.provisioning import ProvisionBatch, group_members
+    co = hub.container_orchestrator
+    benchmarks.reset_hub(hub)
+    benchmarks.populate(hub, 1, prefix="free_user_class")  # free_user_class0 already has a session
+    assert group_members(dict(memberUid=["free_user_class1"],
+                              member=["uid=free_user_class2,ou=jupyterhub,dc=opendx,dc=org", "cn=teachers"])) == \
+        ["free_user_class1", "free_user_class2"]
+
+    batch = ProvisionBatch([f"free_user_class{i}" for i in range(21)], admin="teacher")
+    reloads = co.nginx_reloads
+    co.start_latency = 0.2  # 20 launches: 4 s if sequential
+    try:
+        t0 = time.perf_counter()
+        benchmarks.run_sync(hub.provision_sessions(batch, parallelism=10))
+        elapsed = time.perf_counter() - t0
+    finally:
+        co.start_latency = 0
+    assert elapsed < 2
+    assert co.nginx_reloads == reloads + 1
+    st = batch.status(lambda session_id: hub.launch_status(session_id, None))
+    assert st["done"] and st["counts"] == dict(existing=1, routed=20)
+    assert benchmarks.count_sessions(hub) == 21
+
+    # The students log in to their already running sessions
+    latency, outcome = benchmarks.run_sync(benchmarks.login(hub, "free_user_class7"))
+    assert outcome == "session"
+
+
+def test_concurrent_logins_do_not_exceed_capacity(hub, monkeypatch):
+    benchmarks.reset_hub(hub)
+    max_sessions = hub.max_sessions
+    hub.max_sessions = 3
+    try:
+        async def logins():
+            return await asyncio.gather(*[benchmarks.login(hub, f"free_user_race{i}", wait_usable=False)
+                                          for i in range(8)])
+
+        outcomes = sorted(outcome for _, outcome in benchmarks.run_sync(logins()))
+        assert outcomes == ["queued"] * 5 + ["session"] * 3
+        assert benchmarks.count_sessions(hub) == 3
+
+        def no_stats(container_name):
+            raise AssertionError("the capacity check must not sample the activity of the sessions")
+
+        async def used_capacity():
+            async with hub.orm_session_maker() as sess:
+                return await hub.used_capacity(sess)
+
+        benchmarks.run_sync(hub.launch_jobs.join())
+        monkeypatch.setattr(hub.container_orchestrator, "get_container_activity", no_stats)
+        assert benchmarks.run_sync(used_capacity()) == 3
+    finally:
+        hub.max_sessions = max_sessions
+        benchmarks.reset_hub(hub)
+
+
+def test_reservation_holds_room_and_sessions_until_its_window(hub):
+    import datetime
+    benchmarks.reset_hub(hub)
+    now = datetime.datetime.now()
+    max_sessions = hub.max_sessions
+    hub.max_sessions = 3
+    try:
+        async def reserve():
+            async with hub.orm_session_maker() as sess:
+                starts_at = now + datetime.timedelta(seconds=hub.reservation_lead_sec / 2)  # Within the lead time
+                r = hub.Reservation(name="anatomy", starts_at=starts_at,
+                                    ends_at=now + datetime.timedelta(hours=2), users=["free_user_s0", "free_user_s1"])
+                sess.add(r)
+                await sess.commit()
+                return r
+
+        r = benchmarks.run_sync(reserve())
+        # Two of the three sessions are booked: a single ad-hoc user fits
+        assert benchmarks.run_sync(benchmarks.login(hub, "free_user_adhoc0"))[1] == "session"
+        assert benchmarks.run_sync(benchmarks.login(hub, "free_user_adhoc1"))[1] == "queued"
+
+        batches = benchmarks.run_sync(hub.runner.schedule_reservations(hub.orm_session_maker))
+        benchmarks.run_sync(asyncio.wait({b.task for b in batches}))
+        assert [b.outcomes[u]["outcome"] for b in batches for u in b.users] == ["launch", "launch"]
+
+        # Idle before the window starts: only the ad-hoc session expires
+        benchmarks.make_idle(hub, hub.allowed_inactivity_time_in_seconds + 1)
+        assert benchmarks.run_sync(hub.runner.sweep(hub.orm_session_maker))["expired"] == 1
+        assert benchmarks.run_sync(benchmarks.login(hub, "free_user_s0"))[1] == "session"  # Claimed
+
+        async def end_window():
+            async with hub.orm_session_maker() as sess:
+                (await sess.get(hub.Reservation, r.id)).ends_at = now
+                await sess.commit()
+
+        benchmarks.run_sync(end_window())
+        benchmarks.run_sync(hub.runner.schedule_reservations(hub.orm_session_maker))
+
+        async def state():
+            async with hub.orm_session_maker() as sess:
+                return (await sess.get(hub.Reservation, r.id)).state, \
+                    sorted(s.user for s in await hub.all_sessions(sess) if s.reservation_id)
+
+        assert benchmarks.run_sync(state()) == ("released", ["free_user_s0"])  # The unclaimed session was removed
+    finally:
+        hub.max_sessions = max_sessions
+        benchmarks.reset_hub(hub)
+
+
+def test_shared_cache_populated_once_and_mounted_read_only(hub):
+    co = hub.container_orchestrator
+    benchmarks.reset_hub(hub)
+
+    async def logins():
+        return await asyncio.gather(*[benchmarks.login(hub, f"free_user_ext{i}") for i in range(5)])
+
+    populations = co.shared_cache_populations
+    assert [outcome for _, outcome in benchmarks.run_sync(logins())] == ["session"] * 5
+    assert co.shared_cache_populations <= populations + 1  # Once per image version (maybe already at startup)
+    volumes = co._containers[hub.CONTAINER_NAME_PREFIX + "free-user-ext0"].volumes
+    assert volumes[co.shared_cache_source(hub.tdslicer_image_tag)] == dict(bind="/opt/slicer-shared", mode="ro")
+    assert volumes["free_user_ext0_extensions"]["mode"] == "rw"  # User installed extras
+    assert "free_user_ext0_cache_apt" not in volumes  # Packages from the shared cache
+    env = co._containers[hub.CONTAINER_NAME_PREFIX + "free-user-ext0"].env
+    assert env == dict(SLICER_ADDITIONAL_SETTINGS="/opt/slicer-shared/extensions/Slicer-shared.ini",
+                       APT_CONFIG="/opt/slicer-shared/apt/apt.conf")
+
+
+def test_failed_shared_cache_population_is_not_retried_at_once(hub, monkeypatch):
+    co = hub.container_orchestrator
+    attempts = []
+
+    def fail(*args):
+        attempts.append(args)
+        raise RuntimeError("no network")
+
+    monkeypatch.setattr(hub, "shared_cache_version_", "broken")  # Not populated yet
+    monkeypatch.setattr(co, "populate_shared_cache", fail)
+    assert benchmarks.run_sync(hub.ensure_shared_cache()) is None
+    assert benchmarks.run_sync(hub.ensure_shared_cache()) is None
+    assert len(attempts) == 1
+    # Sessions launched meanwhile keep their own apt cache
+    benchmarks.reset_hub(hub)
+    assert benchmarks.run_sync(benchmarks.login(hub, "free_user_nocache"))[1] == "session"
+    c = co._containers[hub.CONTAINER_NAME_PREFIX + "free-user-nocache"]
+    assert "free_user_nocache_cache_apt" in c.volumes and not c.env
+    benchmarks.reset_hub(hub)
@@ -0,0 +1,33 @@
+import os
+
+from tsliceh.dataset_cache import DatasetCache, main
+
+
+def make_dataset(source, name, size):
+    os.makedirs(os.path.join(source, name, "series"))
+    with open(os.path.join(source, name, "series", "volume.nrrd"), "wb") as f:
+        f.write(b"\0" * size)
+
+
+def test_read_through_and_lru_eviction(tmp_path):
+    source, cache_dir = str(tmp_path / "nfs"), str(tmp_path / "ssd")
+    for name in ("anatomy", "neuro", "cardio"):
+        make_dataset(source, name, 1000)
+    cache = DatasetCache(source, cache_dir, max_bytes=2500, node="node1")
+
+    r = cache.fill(["anatomy", "neuro"])
+    assert (r["hits"], r["misses"], r["evicted"], r["bytes"]) == ([], ["anatomy", "neuro"], [], 2000)
+    os.utime(os.path.join(cache_dir, "neuro"), (1, 1))  # Used long ago
+    r = cache.fill(["anatomy", "../etc", "unknown"])
+    assert (r["hits"], r["missing"]) == (["anatomy"], ["../etc", "unknown"])
+
+    r = cache.fill(["cardio"])  # Over the cap: the least recently used goes
+    assert (r["misses"], r["evicted"], r["bytes"]) == (["cardio"], ["neuro"], 2000)
+    assert sorted(os.listdir(cache_dir)) == [".lock", "anatomy", "cardio"]
+    with open(os.path.join(cache_dir, "cardio", "series", "volume.nrrd"), "rb") as f:
+        assert len(f.read()) == 1000
+
+    report = tmp_path / "termination-log"
+    main(["--source", source, "--cache", cache_dir, "--max-gb", "1", "--datasets", "neuro,cardio",
+          "--report", str(report)])
+    assert '"hits": ["cardio"], "misses": ["neuro"]' in report.read_text()
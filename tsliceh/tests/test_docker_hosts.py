@@ -0,0 +1,162 @@
+import asyncio
+import itertools
+
+import docker
+import pytest
+import requests
+
+from tsliceh.orchestrators import DockerHosts, choose_docker_host, parse_docker_hosts, docker_host_address
+from tsliceh.resilience import ServiceUnavailable
+
+_ids = itertools.count()
+
+
+class StandInContainer:
+    def __init__(self, name, labels=None, published_port=None, network=None):
+        self.id = f"id{next(_ids)}"
+        self.name = name
+        self.labels = labels or {}
+        self.status = "running"
+        self.ports = {"6901/tcp": [{"HostIp": "0.0.0.0", "HostPort": str(published_port)}]} if published_port else {}
+        self.attrs = {"NetworkSettings": {"Networks": {network: {"IPAddress": "172.18.0.5"}} if network else {}}}
+        self.removed = False
+
+    def stats(self, stream=False):
+        return {"cpu_stats": {"online_cpus": 2, "cpu_usage": {"total_usage": 150}, "system_cpu_usage": 1000},
+                "precpu_stats": {"cpu_usage": {"total_usage": 100}, "system_cpu_usage": 900}}
+
+    def stop(self):
+        self.status = "exited"
+
+    def reload(self):
+        pass
+
+    def remove(self, force=False):
+        self.removed = True
+
+
+class StandInDaemon:
+    """ The part of a DockerClient used by DockerHosts """
+    def __init__(self, cpus, volumes=()):
+        self.cpus = cpus
+        self._containers = dict()
+        self._volumes = set(volumes)
+        self._ports = itertools.count(32768)
+        self.containers = self
+        self.volumes = self
+        self.networks = self
+        self.down = False  # Not answering
+
+    def _answer(self):
+        if self.down:
+            raise requests.exceptions.ConnectionError("Connection refused")
+
+    def info(self):
+        return {"NCPU": self.cpus}
+
+    def list(self, all=False, filters=None):
+        self._answer()
+        _ = [c for c in self._containers.values() if not c.removed and (all or c.status == "running")]
+        if filters and "label" in filters:
+            _ = [c for c in _ if filters["label"] in c.labels]
+        return _
+
+    def get(self, name_id):
+        self._answer()
+        for c in self._containers.values():
+            if not c.removed and (c.name == name_id or c.id == name_id):
+                return c
+        if name_id in self._volumes or name_id == "3dslicerhub_default":
+            return type("Resource", (), dict(name=name_id))()
+        raise docker.errors.NotFound(name_id)
+
+    def run(self, image, name, ports=None, labels=None, network=None, **kwargs):
+        c = StandInContainer(name, labels, next(self._ports) if ports else None, network)
+        c.volumes = kwargs.get("volumes")
+        self._containers[name] = c
+        return c
+
+
+@pytest.fixture
+def hosts():
+    co = DockerHosts(dict(local="unix:///var/run/docker.sock", node2="tcp://10.0.0.2:2375"))
+    co._clients = dict(local=StandInDaemon(4, volumes=["ana_workspace"]), node2=StandInDaemon(16))
+    return co
+
+
+def start(co, name, vol_dict=None):
+    return asyncio.run(co.start_container(name, "slicer", "latest", "3dslicerhub_default", vol_dict,
+                                          wait_until_running=False))
+
+
+def test_choose_docker_host():
+    assert choose_docker_host({}) is None
+    assert choose_docker_host(dict(a=(0, 4, 0), b=(0, 16, 0))) == "b"
+    assert choose_docker_host(dict(a=(0, 4, 0), b=(3, 16, 0))) == "a"  # Same share, fewer sessions
+    assert choose_docker_host(dict(a=(1, 4, 350), b=(1, 4, 50))) == "b"  # CPU headroom
+
+
+def test_parse_docker_hosts():
+    hosts = parse_docker_hosts("local=unix:///var/run/docker.sock, node2=tcp://10.0.0.2:2375")
+    assert hosts == dict(local="unix:///var/run/docker.sock", node2="tcp://10.0.0.2:2375")
+    assert docker_host_address(hosts["local"]) is None
+    assert docker_host_address(hosts["node2"]) == "10.0.0.2"
+    with pytest.raises(ValueError):
+        parse_docker_hosts("node2")
+
+
+def test_docker_hosts_placement_and_routing(hosts):
+    for user in ("u1", "u2", "u3"):
+        start(hosts, f"h__tds__{user}")
+    assert [hosts.get_container_host(f"h__tds__{u}") for u in ("u1", "u2", "u3")] == ["node2"] * 3
+    start(hosts, "h__tds__u4")  # node2 share 400 (1600 / 4), local 400 (400 / 1) and fewer sessions
+    assert hosts.get_container_host("h__tds__u4") == "local"
+    start(hosts, "h__tds__ana", dict(ana_workspace={"bind": "/home", "mode": "rw"}))  # Stays with its volumes
+    assert hosts.get_container_host("h__tds__ana") == "local"
+
+    # Remote sessions are reached at the published port of their host, local ones by IP in the network of the hub
+    assert hosts.get_container_ip("h__tds__u1", "3dslicerhub_default") == "10.0.0.2"
+    assert hosts.get_session_port("h__tds__u1") == 32768
+    assert hosts.get_container_ip("h__tds__u4", "3dslicerhub_default") == "172.18.0.5"
+    assert hosts.get_session_port("h__tds__u4") == 6901
+    assert hosts.get_container_activity("h__tds__u1") == 100.0
+
+    # A new hub instance finds the containers in their hosts
+    co = DockerHosts(hosts.hosts)
+    co._clients = hosts._clients
+    assert sorted(co.get_tdscontainers("h__tds__")) == ["h__tds__ana", "h__tds__u1", "h__tds__u2", "h__tds__u3",
+                                                         "h__tds__u4"]
+    assert co.get_container_host("h__tds__u2") == "node2"
+    assert co.stop_container("h__tds__u2") is True
+    assert hosts._clients["node2"]._containers["h__tds__u2"].status == "exited"
+    assert co.remove_container("h__tds__u2") is True
+    assert co.get_container_status("h__tds__u2") is None and co.get_container_host("h__tds__u2") is None
+    assert co.stop_container("h__tds__u2") is None
+
+
+def test_docker_host_outage_is_not_a_gone_container(hosts):
+    start(hosts, "h__tds__u1")
+    hosts._clients["node2"].down = True
+    with pytest.raises(ServiceUnavailable):  # Not -1 (no container): the session must not be expired
+        hosts.get_container_activity("h__tds__u1")
+    with pytest.raises(ServiceUnavailable):
+        hosts.get_container_status("h__tds__unknown")  # Could be in node2
+    hosts._clients["node2"].down = False
+    assert hosts.get_container_activity("h__tds__u1") == 100.0
+
+
+def test_dataset_cache_only_in_the_local_host(hosts, tmp_path):
+    from tsliceh.dataset_cache import DatasetCache
+    cache_dir = str(tmp_path / "cache")
+    hosts.configure_dataset_cache(DatasetCache(str(tmp_path / "source"), cache_dir, 1024 ** 3), ["anatomy"])
+    vol_dict = {"u1_Documents": {"bind": "/home/kasm-user/Documents", "mode": "rw"},
+                cache_dir: {"bind": "/home/kasm-user/Datasets", "mode": "ro"}}
+    start(hosts, "h__tds__u1", dict(vol_dict))
+    assert hosts.get_container_host("h__tds__u1") == "node2"
+    # Not bind mounted in the remote host, where the directory would be empty (and created by Docker as root)
+    assert list(hosts._clients["node2"]._containers["h__tds__u1"].volumes) == ["u1_Documents"]
+    start(hosts, "h__tds__u2", dict(vol_dict))
+    start(hosts, "h__tds__u3", dict(vol_dict))
+    start(hosts, "h__tds__u4", dict(vol_dict))
+    assert hosts.get_container_host("h__tds__u4") == "local"
+    assert hosts._clients["local"]._containers["h__tds__u4"].volumes == vol_dict
@@ -0,0 +1,116 @@
+import json
+import queue
+import subprocess
+
+from tsliceh import informer as informer_module
+from tsliceh.informer import CachedContainer, Informer, KubernetesSource, pod_to_container, deployment_to_container
+
+
+class FakeSource:
+    """ Lists a dictionary; the watch yields the events put in a queue, None ends it (disconnection) """
+    def __init__(self, objects):
+        self.objects = objects
+        self.events = queue.Queue()
+        self.lists = 0
+
+    def list(self):
+        self.lists += 1
+        return dict(self.objects)
+
+    def watch(self):
+        while True:
+            ev = self.events.get()
+            if ev is None:
+                return
+            yield ev
+
+    def close(self):
+        self.events.put(None)
+
+
+def wait(condition, timeout=5):
+    import time
+    t0 = time.monotonic()
+    while not condition() and time.monotonic() - t0 < timeout:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_informer_list_watch_and_resync():
+    source = FakeSource({"h__tds__a": CachedContainer("h__tds__a", "running", {"net": "10.0.0.2"})})
+    informer = Informer("test", source, resync_period=60, retry_delay=0.01)
+    resyncs = []
+    informer.on_resync.append(resyncs.append)
+    assert informer.lookup("h__tds__a") is None and informer.staleness() == float("inf")
+    informer.start()
+    try:
+        assert informer.wait_for_sync(5)
+        assert informer.lookup("h__tds__a").ip("net") == "10.0.0.2"
+
+        source.events.put(("ADDED", "h__tds__b", CachedContainer("h__tds__b", "created")))
+        source.events.put(("DELETED", "h__tds__a", None))
+        assert wait(lambda: informer.lookup("h__tds__a") is None)
+        assert informer.names("h__tds__") == ["h__tds__b"] and informer.staleness() < 5
+
+        source.objects["h__tds__c"] = CachedContainer("h__tds__c", "running")
+        source.events.put(None)  # Watch disconnected: listed again
+        assert wait(lambda: informer.lookup("h__tds__c") is not None)
+        assert resyncs == ["initial", "disconnect"]
+        assert informer.lookup("h__tds__b") is None  # The list replaces the cache
+
+        informer.forget("h__tds__c")
+        assert informer.lookup("h__tds__c") is None
+    finally:
+        informer.stop()
+
+
+def test_kubernetes_objects():
+    pod = dict(metadata=dict(name="deploy-slicer-u1-5d8f", labels=dict(app="slicer", **{"app-user": "slicer-u1"})),
+               status=dict(phase="Running", podIP="10.1.2.3", containerStatuses=[dict(state=dict(running={}))]))
+    c = pod_to_container(pod)
+    assert (c.name, c.status, c.ip()) == ("slicer-u1", "Running", "10.1.2.3")
+
+    pod["status"]["containerStatuses"] = [dict(state=dict(waiting=dict(reason="CrashLoopBackOff")))]
+    c = pod_to_container(pod)
+    assert (c.status, c.ip()) == ("CrashLoopBackOff", "")
+    pod["metadata"]["deletionTimestamp"] = "2024-01-01T00:00:00Z"
+    assert pod_to_container(pod).status == "Terminating"
+
+    deployment = dict(metadata=dict(name="deploy-slicer-u1"),
+                      spec=dict(selector=dict(matchLabels={"app-user": "slicer-u1"})), status=dict(readyReplicas=1))
+    assert deployment_to_container(deployment).name == "slicer-u1"
+
+
+def slicer_pod(name, phase, terminating=False):
+    metadata = dict(name=name, resourceVersion="2", labels={"app": "slicer", "app-user": "slicer-u1"})
+    if terminating:
+        metadata["deletionTimestamp"] = "2024-01-01T00:00:00Z"
+    return dict(metadata=metadata, status=dict(phase=phase, podIP="10.1.2.3" if phase == "Running" else None))
+
+
+def test_kubernetes_watch_keeps_the_running_pod_of_a_rolling_update(monkeypatch):
+    old, new = "deploy-slicer-u1-old", "deploy-slicer-u1-new"
+    events = [("ADDED", slicer_pod(new, "Pending")),
+              ("MODIFIED", slicer_pod(new, "Running")),
+              ("MODIFIED", slicer_pod(old, "Running", terminating=True)),
+              ("DELETED", slicer_pod(old, "Running", terminating=True))]
+
+    class Watch:
+        stdout = [json.dumps(dict(type=t, object=o)) + "\n" for t, o in events]
+
+        def poll(self):
+            return 0
+
+    listed = json.dumps(dict(metadata=dict(resourceVersion="1"), items=[slicer_pod(old, "Running")]))
+    monkeypatch.setattr(informer_module.subprocess, "run",
+                        lambda cmd, **kwargs: subprocess.CompletedProcess(cmd, 0, listed, ""))
+    monkeypatch.setattr(informer_module.subprocess, "Popen", lambda cmd, **kwargs: Watch())
+    source = KubernetesSource("pods", "app=slicer", namespace="default")
+    cache = source.list()
+    for _, name, c in source.watch():
+        if c is None:
+            cache.pop(name, None)
+        else:
+            cache[name] = c
+    # The events of the old pod (Terminating, deleted) did not replace nor remove the new one
+    assert cache["slicer-u1"].resource_name == new and cache["slicer-u1"].status == "Running"
@@ -0,0 +1,34 @@
+import asyncio
+
+from tsliceh.readiness import probe_session, wait_until_usable
+
+
+def test_probe_with_backoff_until_kasmvnc_answers():
+    requests = []
+
+    async def handle(reader, writer):
+        line = (await reader.readline()).decode()
+        while (await reader.readline()) not in (b"\r\n", b""):
+            pass
+        requests.append(line.split()[1])
+        if len(requests) <= 2:  # KasmVNC still starting behind the port
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\n\r\n")
+        elif line.startswith("GET /websockify"):
+            writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n\r\n")
+        else:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        address = "127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+        async with server:
+            usable = await wait_until_usable(lambda: probe_session(address), 5, initial_delay=0.01, max_delay=0.02)
+        not_usable = await wait_until_usable(lambda: probe_session(address), 0.05, initial_delay=0.01)
+        return usable, not_usable
+
+    (usable, waited, attempts), not_usable = asyncio.run(run())
+    assert usable and attempts == 3 and waited < 5
+    assert requests[-2:] == ["/", "/websockify"]
+    assert not not_usable[0]  # Server closed: deadline reached
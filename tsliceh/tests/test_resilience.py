@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from tsliceh.orchestrators import Simulated, guard_orchestrator
+from tsliceh.resilience import CircuitBreaker, CircuitOpenError, DeadlineExceeded, ServiceUnavailable, \
+    backoff_delays, retry_call
+
+
+def test_circuit_breaker_opens_and_recovers(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("tsliceh.resilience.time.monotonic", lambda: now[0])
+    b = CircuitBreaker("api", failure_threshold=2, reset_timeout_sec=30)
+    timeouts = []
+    b.on_timeout.append(timeouts.append)
+
+    def fail():
+        raise DeadlineExceeded("get pods", 5)
+
+    for _ in range(2):
+        with pytest.raises(DeadlineExceeded):
+            b.call(fail)
+    assert b.state == "open" and timeouts == ["get pods", "get pods"]
+    with pytest.raises(CircuitOpenError):
+        b.call(lambda: 1)
+
+    # After the reset timeout, a single trial call: it fails, open again
+    now[0] = 31
+    assert b.state == "half_open"
+    with pytest.raises(DeadlineExceeded):
+        b.call(fail)
+    assert b.state == "open"
+
+    # A trial call which works closes the breaker. Answers of the service, even errors, are not failures
+    now[0] = 62
+    with pytest.raises(LookupError):
+        b.call(lambda: {}["missing"])
+    assert b.status() == dict(breaker="api", state="closed", failures=0)
+
+
+def test_retry_with_backoff(monkeypatch):
+    monkeypatch.setattr("tsliceh.resilience.time.sleep", lambda _: None)
+    delays = list(backoff_delays(5, initial_delay=1, max_delay=3))
+    assert len(delays) == 4 and 0.75 <= delays[0] <= 1.25 and delays[-1] <= 3 * 1.25
+
+    calls = []
+
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ServiceUnavailable("unreachable")
+        return "ok"
+
+    assert retry_call(flaky, attempts=3) == "ok"
+    calls.clear()
+    with pytest.raises(ServiceUnavailable):
+        retry_call(flaky, attempts=2)
+
+
+def test_guarded_orchestrator_fails_fast():
+    b = CircuitBreaker("orchestrator", failure_threshold=3, reset_timeout_sec=30)
+    co = guard_orchestrator(Simulated(seed=1, start_latency=0.2), b, start_timeout_sec=0.05)
+    with pytest.raises(TimeoutError, match="start_container did not finish"):
+        asyncio.run(co.start_container("h--tds--u1", "slicer", "latest"))
+    assert b.state == "closed"  # The orchestrator answered, the container is just slow to start
+
+    co.unreachable = True
+    for _ in range(3):
+        with pytest.raises(ServiceUnavailable):
+            co.get_container_status("h--tds--u1")
+    assert b.state == "open"
+    co.unreachable = False
+    with pytest.raises(CircuitOpenError):
+        co.get_container_activity("h--tds--u1")
+    assert co.get_valid_name("h__tds__u1") == "h--tds--u1"  # No I/O, not guarded
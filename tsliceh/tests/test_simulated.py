@@ -0,0 +1,527 @@
+import asyncio
+import collections
+import datetime
+import gzip
+import http.server
+import os
+import re
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import types
+import urllib.request
+
+import pytest
+
+# The hub reads its configuration when "tsliceh.main" is imported: use the in-memory orchestrator and a scratch DB
+_tmp_dir = tempfile.mkdtemp(prefix="tsliceh-test-")
+os.environ.setdefault("CONTAINER_ORCHESTRATOR", "simulated")
+os.environ.setdefault("MODE", "local")
+os.environ.setdefault("INACTIVITY_TIME_SEC", "900")
+os.environ.setdefault("MAX_SESSIONS", "2")
+os.environ.setdefault("DB_CONNECTION_STRING", f"sqlite:///{_tmp_dir}/sessions.sqlite")
+os.environ.setdefault("NGINX_CONFIG_FILE", f"{_tmp_dir}/nginx.conf")
+
+from fastapi.testclient import TestClient
+
+from tsliceh.orchestrators import Simulated
+
+
+def test_simulated_container_lifecycle():
+    co = Simulated(activity="busy", seed=1)
+    c = asyncio.run(co.start_container("h--tds--user1", "slicer", "latest"))
+    assert c.status == "running"
+    assert co.get_container_status("h--tds--user1") == "running"
+    assert co.get_container_ip(c.id, None).startswith("10.")
+    assert co.get_container_activity("h--tds--user1") > 10
+    assert co.get_tdscontainers("h--tds--") == ["h--tds--user1"]
+    assert co.remove_container("h--tds--user1") is False  # Running, not forced
+    assert co.stop_container("h--tds--user1") is True
+    assert co.remove_container("h--tds--user1") is True
+    assert co.get_container_status("h--tds--user1") is None
+    assert co.get_container_activity("h--tds--user1") == -1
+    assert co.stop_container("h--tds--user1") is None
+
+
+def test_simulated_failures_and_activity():
+    co = Simulated(failure_rate=1.0, activity="idle", seed=1)
+    c = asyncio.run(co.start_container("h--tds--user1", "slicer", "latest"))
+    assert c.status == "exited"
+    assert co.get_container_activity("h--tds--user1") == -1
+
+    co = Simulated(activity="idle", seed=1)
+    asyncio.run(co.start_container("h--tds--user2", "slicer", "latest"))
+    assert co.get_container_activity("h--tds--user2") < 10
+    co.set_container_activity("h--tds--user2", 55)
+    assert co.get_container_activity("h--tds--user2") == 55
+
+
+@pytest.fixture(scope="module")
+def hub():
+    from tsliceh import main
+    if not isinstance(main.container_orchestrator, Simulated):
+        pytest.skip("the hub was already imported with another container orchestrator")
+    return main
+
+
+def wait_until(fetch, done, timeout=5):
+    t0 = time.monotonic()
+    while True:
+        r = fetch()
+        if done(r) or time.monotonic() - t0 > timeout:
+            return r
+        time.sleep(0.05)
+
+
+def test_login_capacity_and_waiting_room(hub):
+    with TestClient(hub.app) as client:  # One event loop for the requests and the background launches
+        sessions = []
+        hub.container_orchestrator.start_latency = 0.5
+        try:
+            for i in range(hub.max_sessions):
+                r = client.post("/login", data=dict(username=f"free_user_sim{i}", password="test"),
+                                allow_redirects=False)
+                assert r.status_code == 302
+                assert r.headers["location"].startswith("/sessions/")
+                sessions.append(r.headers["location"])
+            # Login returns at once, the session page shows the launch until the session is usable
+            assert "Starting session" in client.get(sessions[0]).text
+        finally:
+            hub.container_orchestrator.start_latency = 0
+        for url in sessions:
+            st = wait_until(lambda: client.get(f"{url}/launch").json(), lambda st: st["done"])
+            assert st["phase"] == "routed" and [p["phase"] for p in st["phases"]] == \
+                ["queued", "pulling", "starting", "ready", "routed"]
+        assert "Manage Session" in client.get(sessions[0]).text
+
+        # The hub is full: next user goes to the waiting room
+        r = client.post("/login", data=dict(username="free_user_waiting", password="test"), allow_redirects=False)
+        assert r.status_code == 302
+        ticket_url = r.headers["location"]
+        assert ticket_url.startswith("/queue/")
+        st = client.get(f"{ticket_url}/status").json()
+        assert st["position"] == 1 and st["session"] is None
+
+        # Closing a session admits the waiting user
+        r = client.post(f"{sessions[0]}/close", allow_redirects=False)
+        assert r.status_code == 302
+        st = wait_until(lambda: client.get(f"{ticket_url}/status").json(), lambda st: st["session"])
+        assert st["position"] == 0 and st["session"] is not None
+        st = wait_until(lambda: client.get(f"/sessions/{st['session']}/launch").json(), lambda st: st["done"])
+        assert st["phase"] == "routed"
+        assert hub.container_orchestrator.get_container_status(
+            hub.CONTAINER_NAME_PREFIX + hub.container_orchestrator.get_valid_name("free_user_waiting")) == "running"
+
+        r = client.get("/metrics")
+        assert "tsliceh_login_phase_seconds" in r.text
+
+
+def login_count(client, outcome):
+    m = re.search(rf'^tsliceh_login_seconds_count{{outcome="{outcome}"}} (\S+)$', client.get("/metrics").text, re.M)
+    return float(m.group(1)) if m else 0.0
+
+
+def test_login_is_traced_and_counted(hub, monkeypatch):
+    from tsliceh.tracing import span_tree, tracer
+
+    monkeypatch.setattr(hub, "max_sessions", hub.max_sessions + 1)  # The sessions of the other tests may fill the hub
+    with TestClient(hub.app) as client:
+        launches = login_count(client, "launch")
+        r = client.post("/login", data=dict(username="free_user_traced", password="test"), allow_redirects=False)
+        assert r.status_code == 302 and r.headers["location"].startswith("/sessions/")
+        url = r.headers["location"]
+        st = wait_until(lambda: client.get(f"{url}/launch").json(), lambda st: st["done"])
+        assert st["phase"] == "routed"
+        assert login_count(client, "launch") == launches + 1
+
+        # The login request and its background launch: two traces, the launch one with the orchestrator calls
+        login = next(t for t in tracer.recent_traces(root_name="login")
+                     if t[-1].attributes.get("user") == "free_user_traced")
+        assert login[-1].attributes["outcome"] == "launch" and login[-1].end is not None
+        assert "check_credentials" in [s.name for s in login]
+        launch = next(t for t in tracer.recent_traces(root_name="launch")
+                      if t[-1].attributes.get("user") == "free_user_traced")
+        tree = span_tree(launch)
+        assert tree[0][1].name == "launch" and tree[1][1].name == "launch_3dslicer_web_container"
+        assert (2, "Simulated.start_container") in [(d, s.name) for d, s in tree]
+        assert {s.trace_id for s in launch} == {launch[-1].trace_id} != {login[-1].trace_id}
+
+        assert client.post(f"{url}/close", allow_redirects=False).status_code == 302
+
+
+def test_sweep_writes_activity_samples(hub):
+    from tsliceh import ActivitySample
+    from sqlalchemy import func, select
+
+    async def sweep_and_count():
+        states = await hub.runner.sweep(hub.orm_session_maker)
+        async with hub.orm_session_maker() as sess:
+            sessions = await hub.all_sessions(sess)
+            n_samples = (await sess.execute(select(func.count()).select_from(ActivitySample))).scalar()
+        return states, sessions, n_samples
+
+    states, sessions, n_samples = asyncio.run(sweep_and_count())
+    assert states["active"] + states["idle"] == len(sessions) > 0
+    assert n_samples >= len(sessions)
+    assert all(s.cpu_pct is not None for s in sessions)
+
+
+def test_sweep_follows_moved_containers(hub):
+    async def move_and_sweep():
+        async with hub.orm_session_maker() as sess:
+            s = (await hub.all_sessions(sess))[0]
+        hub.container_orchestrator._containers[s.container_name].ip = "10.99.0.1"  # E.g. rescheduled pod
+        await hub.runner.sweep(hub.orm_session_maker)
+        async with hub.orm_session_maker() as sess:
+            return (await sess.get(hub.Session3DSlicer, s.uuid)).service_address
+
+    assert asyncio.run(move_and_sweep()) == "10.99.0.1:6901"
+    with open(hub.nginx_config_path) as f:
+        assert "10.99.0.1:6901" in f.read()
+
+
+def test_sweep_reports_scratch_usage(hub):
+    async def fill_and_sweep():
+        async with hub.orm_session_maker() as sess:
+            s = (await hub.all_sessions(sess))[0]
+        c = hub.container_orchestrator._containers[s.container_name]
+        assert c.scratch == hub.session_scratch(s)
+        c.scratch_used = 300 * 1024 ** 2
+        await hub.runner.sweep(hub.orm_session_maker)
+        async with hub.orm_session_maker() as sess:
+            return await sess.get(hub.Session3DSlicer, s.uuid)
+
+    s = asyncio.run(fill_and_sweep())
+    assert s.scratch_bytes == 300 * 1024 ** 2
+    scratch = hub.session_activity(s.uuid, s)["scratch"]
+    assert scratch == dict(path=hub.scratch_path, size_bytes=hub.scratch_size_mb["default"] * 1024 ** 2,
+                           used_bytes=300 * 1024 ** 2)
+
+
+def test_sweep_throttles_idle_sessions(hub):
+    async def sweep_idle_for(s, idle_sec, cpu_pct):
+        hub.container_orchestrator.set_container_activity(s.container_name, cpu_pct)
+        hub.activity_tracker.forget(s.uuid)  # No history: the sample decides
+        async with hub.orm_session_maker() as sess:
+            _ = await sess.get(hub.Session3DSlicer, s.uuid)
+            _.last_activity = datetime.datetime.now() - datetime.timedelta(seconds=idle_sec)
+            await sess.commit()
+        await hub.runner.sweep(hub.orm_session_maker)
+        async with hub.orm_session_maker() as sess:
+            return (await sess.get(hub.Session3DSlicer, s.uuid)).cpu_limit
+
+    async def first_session():
+        async with hub.orm_session_maker() as sess:
+            return (await hub.all_sessions(sess))[0]
+
+    s = asyncio.run(first_session())
+    c = hub.container_orchestrator._containers[s.container_name]
+    try:
+        assert asyncio.run(sweep_idle_for(s, 60, 0)) is None
+        assert c.cpu_weight == hub.fair_share.weight(s.user, "normal")
+        assert asyncio.run(sweep_idle_for(s, 400, 0)) == 1 and c.cpu_limit == 1
+        assert asyncio.run(sweep_idle_for(s, 700, 0)) == 0.5 and c.cpu_limit == 0.5
+        assert asyncio.run(sweep_idle_for(s, 700, 45)) is None and c.cpu_limit is None  # Active again
+        # Busy with user input (VNC traffic of the simulated container, a rate from the second sample): interactive,
+        # with a larger CPU share
+        asyncio.run(hub.runner.sweep(hub.orm_session_maker))
+        assert c.cpu_weight == hub.fair_share.weight(s.user, "interactive") > hub.fair_share.weight(s.user, "normal")
+    finally:
+        hub.container_orchestrator.set_container_activity(s.container_name, None)
+
+
+def test_drain_relaunches_sessions_in_other_nodes(hub):
+    co = hub.container_orchestrator
+
+    async def drain():
+        async with hub.orm_session_maker() as sess:
+            node = co._containers[(await hub.all_sessions(sess))[0].container_name].node
+            on_node = await hub.sessions_on_node(sess, node)
+        assert co.cordon_node(node)
+        job = hub.DrainJob(node, [(s.uuid, s.user) for s in on_node])
+        await hub.drain_node(job, 2)
+        async with hub.orm_session_maker() as sess:
+            after = {s.uuid: s for s in await hub.all_sessions(sess)}
+        return node, on_node, job, after
+
+    node, on_node, job, after = asyncio.run(drain())
+    try:
+        assert on_node and job.done and job.status()["counts"] == dict(routed=len(on_node))
+        assert co.containers_on_node(node) == []
+        with open(hub.nginx_config_path) as f:
+            nginx_conf = f.read()
+        for s in on_node:
+            # Same session and volumes, new instance in another node, routed to it
+            c = co._containers[s.container_name]
+            assert c.node != node and c.volumes
+            assert after[s.uuid].service_address == f"{c.ip}:6901" != s.service_address
+            assert after[s.uuid].service_address in nginx_conf
+    finally:
+        co.cordon_node(node, False)
+
+
+def test_drain_refused_if_orchestrator_cannot_relaunch(hub, monkeypatch):
+    co = hub.container_orchestrator
+    monkeypatch.setattr(hub, "admin_users", ["free_user_admin"])
+    monkeypatch.setattr(co, "relaunches_containers", False)  # Like DockerHosts
+    with TestClient(hub.app) as client:
+        r = client.post("/admin/nodes/sim-node-1/drain", auth=("free_user_admin", "test"))
+    assert r.status_code == 400 and "cannot relaunch" in r.json()["error"]
+    assert "sim-node-1" not in co.cordoned  # Left as it was
+
+
+def test_relaunch_refused_if_orchestrator_cannot_relaunch():
+    from tsliceh.orchestrators import DockerCompose
+
+    co = DockerCompose()
+    assert not co.relaunches_containers
+    with pytest.raises(RuntimeError, match="cannot relaunch"):
+        asyncio.run(co.relaunch_container("h--tds--u1", "slicer", "latest", None, {}, 1000))
+
+
+def test_kubernetes_session_stop_removes_its_service(hub, monkeypatch):
+    from tsliceh.orchestrators import Kubernetes
+
+    commands = []
+
+    def kubectl(desc, cmd, timeout):
+        commands.append(cmd[1:])
+        stdout = "NAME            READY\ndeploy-h--tds--u1   1/1\n" if cmd[1] == "get" else "done\n"
+        return subprocess.CompletedProcess(cmd, 0, stdout, "")
+
+    monkeypatch.setattr(Kubernetes, "_run_kubectl", staticmethod(kubectl))
+    monkeypatch.setattr(hub, "container_orchestrator", Kubernetes())
+    asyncio.run(hub.stop_remove_container("h--tds--u1", True))
+    assert ["scale", "--replicas=0", "deployment/deploy-h--tds--u1"] in commands
+    assert ["delete", "deployment", "deploy-h--tds--u1"] in commands
+    assert ["delete", "service", "svc-h--tds--u1", "--ignore-not-found"] in commands
+
+
+def test_sessions_checker_survives_errors(hub, monkeypatch):
+    runner = hub.BackgroundRunner()
+    sweeps = []
+
+    class Stop(Exception):
+        pass
+
+    async def bug(sm):
+        raise RuntimeError("bug")
+
+    async def sweep(sm):
+        sweeps.append(sm)
+        if len(sweeps) == 1:
+            raise RuntimeError("bug")
+
+    async def sleep(delay):
+        if len(sweeps) == 2:
+            raise Stop()
+
+    monkeypatch.setattr(runner, "reconcile", bug)
+    monkeypatch.setattr(runner, "sweep", sweep)
+    monkeypatch.setattr(hub.asyncio, "sleep", sleep)
+    with pytest.raises(Stop):
+        asyncio.run(runner.sessions_checker(hub.orm_session_maker))
+    assert len(sweeps) == 2  # The failed reconciliation and sweep did not end the checker
+
+
+def test_launch_of_a_closed_session_fails_its_job(hub):
+    session_id = "f" * 32  # Closed (deleted) before its launch started
+
+    async def launch():
+        hub.launch_jobs.start(session_id, "free_user_gone", hub.launch_session(session_id, "free_user_gone"))
+        return await hub.launch_jobs.wait(session_id)
+
+    job = asyncio.run(launch())
+    assert job.phase == "failed" and job.error == "session closed before its launch"
+
+
+def test_orchestrator_outage_fails_fast(hub, monkeypatch):
+    from tsliceh.resilience import ServiceUnavailable
+
+    async def session_ids():
+        async with hub.orm_session_maker() as sess:
+            return {s.uuid for s in await hub.all_sessions(sess)}
+
+    co = hub.container_orchestrator
+    monkeypatch.setattr(hub, "admin_users", ["free_user_admin"])
+    before = asyncio.run(session_ids())
+    assert before
+    co.unreachable = True
+    try:
+        for _ in range(hub.breaker_failures):
+            with pytest.raises(ServiceUnavailable):
+                asyncio.run(hub.runner.sweep(hub.orm_session_maker))
+        assert hub.orchestrator_breaker.state == "open"
+        with TestClient(hub.app) as client:
+            r = client.get("/admin/nodes/sim-node-1/sessions", auth=("free_user_admin", "test"))
+            assert r.status_code == 503 and "orchestrator unavailable" in r.json()["error"]
+            assert 'tsliceh_circuit_breaker_state{breaker="orchestrator"} 2.0' in client.get("/metrics").text
+    finally:
+        co.unreachable = False
+        hub.orchestrator_breaker.record_success()
+    assert asyncio.run(session_ids()) == before  # Nothing expired while the orchestrator did not answer
+
+
+KASMVNC_ASSETS = ["dist/main.bundle.js", "app/styles/fonts/Orbitron700.woff2", "app/images/icons/368x368.png"]
+
+
+def test_nginx_conf_caches_kasmvnc_assets(hub):
+    for path in KASMVNC_ASSETS + ["vendor/pako/lib/zlib/inflate.js"]:
+        assert re.fullmatch(hub.KASMVNC_ASSET_PATTERN, path)
+    for path in ["", "vnc.html", "websockify", "api/get_frame_stats", "app/locale"]:
+        assert not re.fullmatch(hub.KASMVNC_ASSET_PATTERN, path)
+
+    sessions = [types.SimpleNamespace(uuid=f"s{i}", service_address=f"10.0.0.{i}:6901") for i in (1, 2)]
+    conf = hub.nginx_conf(sessions, "hub.test", "10.0.0.100:8000", "/var/cache/nginx/kasmvnc", 512, "sha256-1")
+    assert conf.count("proxy_cache_path /var/cache/nginx/kasmvnc") == 1
+    assert conf.count('proxy_cache_key "sha256-1/$kasm_asset";') == 2  # One cache for all the sessions
+    assert "location /s2-ws" in conf and "proxy_cache kasmvnc_assets" in conf
+    assert "kasmvnc_assets" not in hub.nginx_conf(sessions, "hub.test", "10.0.0.100:8000")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_backends(n, requests):
+    """ Stand-in KasmVNC containers, counting the requests for each path in "requests" """
+    class Backend(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests[self.path] += 1
+            body = b"x" * 4096
+            self.send_response(200)
+            self.send_header("Content-Type", "application/javascript" if self.path.endswith(".js") else "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    backends = [http.server.ThreadingHTTPServer(("127.0.0.1", 0), Backend) for _ in range(n)]
+    for b in backends:
+        threading.Thread(target=b.serve_forever, daemon=True).start()
+    sessions = [types.SimpleNamespace(uuid=f"s{i}", service_address=f"127.0.0.1:{b.server_address[1]}")
+                for i, b in enumerate(backends)]
+    return backends, sessions
+
+
+class ConfProxy:
+    """
+    The locations of a generated nginx.conf applied as nginx does (first matching regex location, else the longest
+    prefix), with "proxy_cache" locations answered from a dictionary by their "proxy_cache_key". Only what
+    "nginx_conf" uses, to check where each request goes without the nginx executable
+    """
+    def __init__(self, conf):
+        self.regex, self.prefix = [], []
+        for regex, path, body in re.findall(r"location\s+(~\s+)?(\S+)\s*\{(.*?)\n\s*\}", conf, re.S):
+            directives = dict(re.findall(r"^\s*(proxy_pass|proxy_cache|proxy_cache_key)\s+\"?([^\";]*)\"?;", body,
+                                         re.M))
+            (self.regex if regex else self.prefix).append((path, directives))
+        self.cache = dict()
+
+    def get(self, path):
+        """ :return: (body, "HIT" or "MISS" if the location is cached, else None) """
+        for pattern, d in self.regex:
+            m = re.match(pattern, path)
+            if m:
+                def expand(text):
+                    return re.sub(r"\$(\w+)", lambda v: m.groupdict().get(v.group(1)) or "", text)
+
+                key = expand(d["proxy_cache_key"]) if "proxy_cache" in d else None
+                if key in self.cache:
+                    return self.cache[key], "HIT"
+                body = self._fetch(expand(d["proxy_pass"]))
+                if key is not None:
+                    self.cache[key] = body
+                return body, "MISS" if key is not None else None
+        location, d = max([(p, d) for p, d in self.prefix if path.startswith(p)], key=lambda _: len(_[0]))
+        upstream = d["proxy_pass"]
+        if re.match(r"http://[^/]+/", upstream):  # With a URI: it replaces the location
+            upstream += path[len(location):]
+        else:
+            upstream += path
+        return self._fetch(upstream), None
+
+    @staticmethod
+    def _fetch(url):
+        with urllib.request.urlopen(url, timeout=5) as r:
+            return r.read()
+
+
+def test_proxy_conf_sends_each_kasmvnc_asset_once_to_a_backend(hub):
+    """ Reloads of the KasmVNC client in several sessions: only the first request for each asset reaches a backend """
+    requests = collections.Counter()
+    backends, sessions = start_backends(2, requests)
+    try:
+        proxy = ConfProxy(hub.nginx_conf(sessions, "localhost", "127.0.0.1:9", "/var/cache/nginx/kasmvnc", 64, "v1"))
+        for _ in range(3):  # Reloads of the page of each session
+            for s in sessions:
+                assert proxy.get(f"/{s.uuid}/vnc.html")[1] is None
+                for asset in KASMVNC_ASSETS:
+                    body, cache_status = proxy.get(f"/{s.uuid}/{asset}")
+        assert cache_status == "HIT" and body == b"x" * 4096
+        # Each asset reached a backend once, for all the sessions; pages always reach the container of the session
+        assert all(requests[f"/{asset}"] == 1 for asset in KASMVNC_ASSETS)
+        assert requests["/vnc.html"] == 3 * len(sessions)
+        # Without the cache every request reaches the container of its session
+        proxy = ConfProxy(hub.nginx_conf(sessions, "localhost", "127.0.0.1:9"))
+        for s in sessions:
+            assert proxy.get(f"/{s.uuid}/{KASMVNC_ASSETS[0]}")[1] is None
+        assert requests[f"/{KASMVNC_ASSETS[0]}"] == 1 + len(sessions)
+    finally:
+        for b in backends:
+            b.shutdown()
+
+
+@pytest.mark.skipif(shutil.which("nginx") is None, reason="needs the nginx executable")
+def test_proxy_serves_kasmvnc_assets_from_cache(hub):
+    """ Same as "test_proxy_conf_sends_each_kasmvnc_asset_once_to_a_backend", with nginx """
+    requests = collections.Counter()
+    backends, sessions = start_backends(2, requests)
+    d = tempfile.mkdtemp(prefix="tsliceh-nginx-")
+    os.chmod(d, 0o755)  # Workers do not run as the user of the test if it is root
+    port = free_port()
+    conf = hub.nginx_conf(sessions, "localhost", "127.0.0.1:9", os.path.join(d, "cache"), 64, "v1")
+    temp_paths = "".join(f"  {kind}_temp_path {d}/{kind};\n" for kind in ("client_body", "proxy", "fastcgi", "uwsgi",
+                                                                           "scgi"))
+    conf = conf.replace("user www-data;", "").replace("listen     80;", f"listen 127.0.0.1:{port};") \
+        .replace("/var/log/nginx/", f"{d}/").replace("http {\n", "http {\n" + temp_paths, 1)
+    with open(os.path.join(d, "nginx.conf"), "w") as f:
+        f.write(conf)
+    proc = subprocess.Popen(["nginx", "-p", d, "-c", os.path.join(d, "nginx.conf"), "-e", os.path.join(d, "error.log"),
+                             "-g", f"daemon off; pid {d}/nginx.pid;"])
+    try:
+        def get(path):
+            req = urllib.request.Request(f"http://127.0.0.1:{port}{path}", headers={"Accept-Encoding": "gzip"})
+            with urllib.request.urlopen(req, timeout=5) as r:
+                return r.headers, r.read()
+
+        def listening():
+            with socket.socket() as sock:
+                return proc.poll() is None and sock.connect_ex(("127.0.0.1", port)) == 0
+
+        wait_until(listening, lambda ok: ok)
+        for _ in range(3):  # Reloads of the page of each session
+            for s in sessions:
+                get(f"/{s.uuid}/vnc.html")
+                for asset in KASMVNC_ASSETS:
+                    headers, body = get(f"/{s.uuid}/{asset}")
+        assert "immutable" in headers["Cache-Control"] and headers["X-Cache-Status"] == "HIT"
+        headers, body = get(f"/s1/{KASMVNC_ASSETS[0]}")
+        assert headers["Content-Encoding"] == "gzip" and gzip.decompress(body) == b"x" * 4096
+
+        # Each asset reached a backend once, for all the sessions; pages always reach the container of the session
+        assert all(requests[f"/{asset}"] == 1 for asset in KASMVNC_ASSETS)
+        assert requests["/vnc.html"] == 3 * len(sessions)
+    finally:
+        proc.terminate()
+        proc.wait()
+        for b in backends:
+            b.shutdown()
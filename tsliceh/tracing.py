@@ -0,0 +1,261 @@
+"""
+Lightweight tracing of the login -> launch -> route pipeline, to find out why one specific login was slow.
+
+A trace is started explicitly (e.g. one per login) with "tracer.span". Instrumented functions ("traced"), orchestrator
+methods, kubectl and Docker calls open child spans, only when they run inside a trace (so periodic tasks like
+the sessions checker do not produce traces).
+
+Finished traces are kept in memory (admin page) and, optionally, exported in a background thread:
+  - TRACE_FILE: append one JSON line per trace
+  - OTLP_ENDPOINT: OTLP/HTTP collector (JSON encoding), e.g. "http://otel-collector:4318"
+"""
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import os
+import queue
+import threading
+import time
+import urllib.request
+from collections import deque
+
+from fastapi.logger import logger
+
+_current_span = contextvars.ContextVar("tsliceh_current_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.end = None
+        self.status = "ok"
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    @property
+    def duration(self):
+        return (self.end if self.end else time.time()) - self.start
+
+    def to_dict(self):
+        return dict(name=self.name, trace_id=self.trace_id, span_id=self.span_id, parent_id=self.parent_id,
+                    start=self.start, end=self.end, duration=self.duration, status=self.status,
+                    attributes=self.attributes)
+
+
+class _NoopSpan:
+    """ Returned by "child_span" outside of a trace """
+    def set_attribute(self, key, value):
+        pass
+
+
+class Tracer:
+    def __init__(self, max_traces=200, service_name="tsliceh"):
+        self.service_name = service_name
+        self._open = dict()  # trace id -> finished spans of traces whose root span is still open
+        self._recent = deque(maxlen=max_traces)  # finished traces (list of spans, root last)
+        self._file_path = None
+        self._otlp_endpoint = None
+        self._export_queue = None
+
+    def configure(self, file_path=None, otlp_endpoint=None):
+        """ Enable exporters. Traces are exported from a daemon thread, never blocking the event loop """
+        self._file_path = file_path
+        self._otlp_endpoint = otlp_endpoint.rstrip("/") if otlp_endpoint else None
+        if (self._file_path or self._otlp_endpoint) and self._export_queue is None:
+            self._export_queue = queue.Queue(maxsize=1000)
+            threading.Thread(target=self._export_loop, name="trace-exporter", daemon=True).start()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """ Open a span, child of the current one or root of a new trace """
+        parent = _current_span.get()
+        if parent:
+            s = Span(name, parent.trace_id, parent.span_id, attributes)
+        else:
+            s = Span(name, os.urandom(16).hex(), None, attributes)
+            self._open[s.trace_id] = []
+        token = _current_span.set(s)
+        try:
+            yield s
+        except BaseException as e:
+            s.status = "error"
+            s.attributes["error"] = repr(e)
+            raise
+        finally:
+            s.end = time.time()
+            _current_span.reset(token)
+            self._finish(s)
+
+    @contextlib.contextmanager
+    def new_trace(self, name, **attributes):
+        """ Like "span", but always the root of a new trace (background jobs started while serving a request) """
+        token = _current_span.set(None)
+        try:
+            with self.span(name, **attributes) as s:
+                yield s
+        finally:
+            _current_span.reset(token)
+
+    @contextlib.contextmanager
+    def child_span(self, name, **attributes):
+        """ Like "span", but does nothing if there is no current trace """
+        if _current_span.get() is None:
+            yield _NoopSpan()
+        else:
+            with self.span(name, **attributes) as s:
+                yield s
+
+    def current_span(self):
+        return _current_span.get() or _NoopSpan()
+
+    def _finish(self, s):
+        if s.trace_id not in self._open:
+            # Span of a background task outliving the root of its trace
+            self._export([s])
+            return
+        self._open[s.trace_id].append(s)
+        if s.parent_id is None:
+            spans = self._open.pop(s.trace_id)
+            self._recent.append(spans)
+            self._export(spans)
+
+    def recent_traces(self, root_name=None, contains=None):
+        """
+        :param root_name: only traces whose root span has this name
+        :param contains: only traces having a span with this name
+        :return: list of traces (list of spans), most recent first
+        """
+        _ = []
+        for spans in reversed(self._recent):
+            if root_name and spans[-1].name != root_name:
+                continue
+            if contains and not any(s.name == contains for s in spans):
+                continue
+            _.append(spans)
+        return _
+
+    # EXPORT
+
+    def _export(self, spans):
+        if self._export_queue is not None:
+            try:
+                self._export_queue.put_nowait(spans)
+            except queue.Full:
+                logger.warning("tracing - export queue full, dropping trace")
+
+    def _export_loop(self):
+        while True:
+            spans = self._export_queue.get()
+            try:
+                if self._file_path:
+                    with open(self._file_path, "a") as f:
+                        f.write(json.dumps([s.to_dict() for s in spans]) + "\n")
+                if self._otlp_endpoint:
+                    data = json.dumps(self._to_otlp(spans)).encode("utf-8")
+                    req = urllib.request.Request(f"{self._otlp_endpoint}/v1/traces", data=data,
+                                                 headers={"Content-Type": "application/json"})
+                    urllib.request.urlopen(req, timeout=5).close()
+            except Exception as e:
+                logger.warning(f"tracing - could not export trace: {e}")
+
+    def _to_otlp(self, spans):
+        def attributes(d):
+            _ = []
+            for k, v in d.items():
+                if isinstance(v, bool):
+                    value = {"boolValue": v}
+                elif isinstance(v, int):
+                    value = {"intValue": str(v)}
+                elif isinstance(v, float):
+                    value = {"doubleValue": v}
+                else:
+                    value = {"stringValue": str(v)}
+                _.append({"key": k, "value": value})
+            return _
+
+        otlp_spans = []
+        for s in spans:
+            otlp_span = {"traceId": s.trace_id,
+                         "spanId": s.span_id,
+                         "name": s.name,
+                         "kind": 1,  # INTERNAL
+                         "startTimeUnixNano": str(int(s.start * 1e9)),
+                         "endTimeUnixNano": str(int(s.end * 1e9)),
+                         "attributes": attributes(s.attributes),
+                         "status": {"code": 2 if s.status == "error" else 1}}
+            if s.parent_id:
+                otlp_span["parentSpanId"] = s.parent_id
+            otlp_spans.append(otlp_span)
+        return {"resourceSpans": [{"resource": {"attributes": attributes({"service.name": self.service_name})},
+                                   "scopeSpans": [{"scope": {"name": "tsliceh"}, "spans": otlp_spans}]}]}
+
+
+tracer = Tracer()
+
+
+def traced(name=None):
+    """ Decorator opening a child span (if inside a trace) for each call of a function or coroutine """
+    def decorator(fn):
+        span_name = name or fn.__name__
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with tracer.child_span(span_name):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with tracer.child_span(span_name):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def trace_orchestrator(co):
+    """
+    Open a child span for every call to the public methods of a container orchestrator
+
+    :param co: IContainerOrchestrator instance, modified in place
+    :return: the same orchestrator
+    """
+    from tsliceh.orchestrators import decorate_orchestrator
+
+    orchestrator = type(co).__name__
+
+    def decorator(method, fn):
+        return traced(f"{orchestrator}.{method}")(fn)
+
+    return decorate_orchestrator(co, decorator)
+
+
+def span_tree(spans):
+    """
+    Order the spans of a trace depth-first, for display
+
+    :return: list of (depth, span)
+    """
+    children = dict()
+    root = None
+    for s in spans:
+        if s.parent_id is None:
+            root = s
+        else:
+            children.setdefault(s.parent_id, []).append(s)
+    _ = []
+
+    def visit(s, depth):
+        _.append((depth, s))
+        for c in sorted(children.get(s.span_id, []), key=lambda x: x.start):
+            visit(c, depth + 1)
+
+    if root:
+        visit(root, 0)
+    return _
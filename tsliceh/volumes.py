@@ -1,21 +1,39 @@
+import re
+
 from tsliceh.orchestrators import IContainerOrchestrator
+from tsliceh.tracing import traced
 
+# Per user volumes. With the shared cache (see "shared_cache_populate_script"), mounted read-only, packages come from
+# it instead of "cache_apt"; "extensions" holds the extras installed by the user
 vol_dict = {"cache_apt": "/var/cache/apt", # este tieme que ser borrado periodicamente? realmente lo necesito??
             # "tmpfiles": "/tmp", # todo parece que da problemas cuando le pongo ese volumen... quizás podría hacer que se destruya siembre
             "logs": "/var/log",
-            "Documents": "/home/kasm-user/Documents"}
+            "Documents": "/home/kasm-user/Documents",
+            "extensions": "/home/kasm-user/.local/share/NA-MIC/Extensions-user"}
             # "/home/paula/Documentos/opendx28/3dslicerhub/researcher": "/home/resercher"}
+SHARED_CACHE_MOUNT = "/opt/slicer-shared"  # Shared extensions and packages cache, read-only in the sessions
+SHARED_SLICER_SETTINGS = f"{SHARED_CACHE_MOUNT}/extensions/Slicer-shared.ini"
+SHARED_APT_CONFIG = f"{SHARED_CACHE_MOUNT}/apt/apt.conf"
+SHARED_CACHE_REPLACES = ("cache_apt",)  # Per user volumes not needed with the shared cache
 
 
-def create_all_volumes(co: IContainerOrchestrator, user):
-    l = [k for k, _ in vol_dict.items()]
+@traced()
+def create_all_volumes(co: IContainerOrchestrator, user, shared_cache=False):
+    l = [k for k, _ in vol_dict.items() if not (shared_cache and k in SHARED_CACHE_REPLACES)]
     for t in l:
         co.create_volume(user, t)
 
 
-def volume_dict(user):
+def volume_dict(user, datasets=None, shared_cache=None):
+    """
+    :param datasets: (directory of the host, mount point) of the shared datasets cache, mounted read-only
+    :param shared_cache: volume (or directory of the host) of the shared extensions and packages cache, mounted
+                         read-only at SHARED_CACHE_MOUNT
+    """
     d = dict()
     for k, v in vol_dict.items():
+        if shared_cache and k in SHARED_CACHE_REPLACES:
+            continue
         # {"pmoreno_workspace": {"bind":"/var/cache/apt", "mode":"ro"}}
         d.update({f"{user}_{k}": {"bind": v, "mode": "rw"}})  # modes??
     # now Slicer.ini is not modifiable by the user... this is a kind of general configuration
@@ -23,4 +41,63 @@ def volume_dict(user):
     # from tsliceh.main import slicer_ini
     # d.update({slicer_ini: {"bind": "/home/researcher/.config/NA-MIC/Slicer.ini", "mode": "ro"}
     #           })
+    if datasets:
+        d[datasets[0]] = {"bind": datasets[1], "mode": "ro"}
+    if shared_cache:
+        d[shared_cache] = {"bind": SHARED_CACHE_MOUNT, "mode": "ro"}
     return d
+
+
+def shared_cache_environment():
+    """
+    Environment variables making a session use the shared cache:
+      - SLICER_ADDITIONAL_SETTINGS: passed by the Slicer image to its launcher (--launcher-additional-settings), which
+        adds the module and library paths of the shared extensions
+      - APT_CONFIG: apt configuration with the shared "apt/archives" as its package cache
+    """
+    return dict(SLICER_ADDITIONAL_SETTINGS=SHARED_SLICER_SETTINGS, APT_CONFIG=SHARED_APT_CONFIG)
+
+
+def shared_cache_version(image_tag, version=None):
+    """ Name of the shared cache of an image version (the tag, unless a version is given, e.g. the image digest) """
+    return re.sub(r"[^a-z0-9-]+", "-", (version or image_tag).lower()).strip("-")[:40]
+
+
+def shared_cache_populate_script(extensions=(), apt_packages=(), slicer="Slicer"):
+    """
+    Shell script populating the shared cache of an image version, run once as root in a container of the image with
+    the cache mounted read-write at SHARED_CACHE_MOUNT. Nothing is done if it was already populated:
+      - "apt/archives": ".deb" files of "apt_packages" and their dependencies, installable without downloading,
+        and "apt/apt.conf" pointing apt at them (read-only: without locking, only those packages can be installed)
+      - "extensions": the Slicer "extensions" and "Slicer-shared.ini", with their module paths ([Modules]
+        AdditionalPaths) and library paths ([LibraryPaths]), the additional launcher settings of the sessions
+
+    :param slicer: Slicer executable in the image
+    """
+    d = SHARED_CACHE_MOUNT
+    lines = ["set -e",
+             f"[ -f {d}/.populated ] && [ -f {SHARED_APT_CONFIG} ] && exit 0",
+             f"mkdir -p {d}/apt/archives/partial {d}/extensions"]
+    if apt_packages:
+        lines += ["apt-get update",
+                  f"apt-get install -y --download-only -o Dir::Cache::archives={d}/apt/archives "
+                  f"{' '.join(apt_packages)}",
+                  f"printf '%s\\n' 'Dir::Cache::archives \"{d}/apt/archives/\";' 'Debug::NoLocking \"true\";' "
+                  f"> {SHARED_APT_CONFIG}"]
+    else:
+        lines += [f": > {SHARED_APT_CONFIG}"]  # Empty, the sessions keep the apt configuration of the image
+    if extensions:
+        run = f"$(command -v xvfb-run >/dev/null && echo xvfb-run -a) {slicer} --no-splash --no-main-window"
+        install = ("em = slicer.app.extensionsManagerModel(); "
+                   f"[em.downloadAndInstallExtensionByName(n, True, True) for n in {list(extensions)!r}]; exit()")
+        lines += [f"{run} --python-code \"slicer.app.revisionUserSettings().setValue('Extensions/InstallPath', "
+                  f"'{d}/extensions'); slicer.app.revisionUserSettings().sync(); exit()\"",
+                  f"{run} --python-code \"{install}\""]
+    lines += [f"PATHS=$(find {d}/extensions -type d \\( -name qt-scripted-modules -o -name qt-loadable-modules "
+              f"-o -name cli-modules \\) | paste -sd, -)",
+              f"printf '[Modules]\\nAdditionalPaths=%s\\n' \"$PATHS\" > {SHARED_SLICER_SETTINGS}",
+              # Loadable modules also need their libraries in the library path (set by the launcher)
+              f"find {d}/extensions -type d -name qt-loadable-modules | awk 'BEGIN {{ print \"[LibraryPaths]\" }} "
+              f"{{ print NR \"\\\\path=\" $0 }} END {{ print \"size=\" NR }}' >> {SHARED_SLICER_SETTINGS}",
+              f"date > {d}/.populated"]
+    return "\n".join(lines)
@@ -0,0 +1,130 @@
+"""
+Waiting room for users logging in while the hub is at capacity ("max_sessions").
+
+Instead of answering "401, try again later" (each retry costs an LDAP bind plus counting the active containers),
+users get a ticket. Tickets are served in FIFO order: each time capacity is freed (session closed or expired) the
+first ticket is admitted and a 3DSlicer session is launched for its user.
+"""
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from tsliceh.metrics import QUEUE_DEPTH, QUEUE_WAIT_SECONDS
+
+
+class Ticket:
+    def __init__(self, user, gpu=False):
+        self.id = uuid.uuid4().hex
+        self.user = user
+        self.gpu = gpu
+        self.enqueued_at = time.monotonic()
+        self.last_seen = self.enqueued_at
+        self.admitted_at = None
+        self.session_uuid = None  # Set once the ticket is admitted and the session created
+        self.error = None  # Set if the launch of the session failed
+
+
+class WaitingRoom:
+    def __init__(self, ticket_timeout_sec=120, release_history=20):
+        """
+        :param ticket_timeout_sec: a ticket not polled for this time is considered abandoned and dropped
+        :param release_history: number of recent capacity releases used to estimate waiting times
+        """
+        self.ticket_timeout_sec = ticket_timeout_sec
+        self._waiting = OrderedDict()  # ticket id -> Ticket, in arrival order
+        self._admitted = dict()  # ticket id -> Ticket, kept until the user is redirected to the session
+        self._releases = deque(maxlen=release_history)  # monotonic times at which capacity was freed
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def enqueue(self, user, gpu=False):
+        """
+        Add a user to the waiting room. A user already waiting keeps the ticket (and position) they had
+
+        :return: the ticket
+        """
+        for t in self._waiting.values():
+            if t.user == user:
+                t.last_seen = time.monotonic()
+                return t
+        t = Ticket(user, gpu)
+        self._waiting[t.id] = t
+        QUEUE_DEPTH.set(len(self._waiting))
+        return t
+
+    def get(self, ticket_id):
+        t = self._waiting.get(ticket_id) or self._admitted.get(ticket_id)
+        if t:
+            t.last_seen = time.monotonic()
+        return t
+
+    def leave(self, ticket_id):
+        self._waiting.pop(ticket_id, None)
+        self._admitted.pop(ticket_id, None)
+        QUEUE_DEPTH.set(len(self._waiting))
+
+    def head(self):
+        """ First waiting ticket, None if nobody is waiting """
+        return next(iter(self._waiting.values()), None)
+
+    def position(self, ticket):
+        """ 1-based position of a waiting ticket, 0 if it is not waiting anymore """
+        for i, ticket_id in enumerate(self._waiting):
+            if ticket_id == ticket.id:
+                return i + 1
+        return 0
+
+    def eta_seconds(self, ticket):
+        """
+        Estimated waiting time, assuming capacity keeps being released at the recently observed rate
+
+        :return: seconds, or None if there is not enough history to estimate it
+        """
+        pos = self.position(ticket)
+        if pos == 0:
+            return 0
+        if len(self._releases) < 2:
+            return None
+        interval = (self._releases[-1] - self._releases[0]) / (len(self._releases) - 1)
+        return int(pos * interval)
+
+    def record_release(self):
+        """ Register that a session was closed or expired, freeing capacity """
+        self._releases.append(time.monotonic())
+
+    def admit(self, ticket, session_uuid=None, error=None):
+        """ Remove the ticket from the queue, recording the session created for it (or the launch error) """
+        self._waiting.pop(ticket.id, None)
+        ticket.admitted_at = time.monotonic()
+        ticket.session_uuid = session_uuid
+        ticket.error = error
+        self._admitted[ticket.id] = ticket
+        QUEUE_DEPTH.set(len(self._waiting))
+        QUEUE_WAIT_SECONDS.observe(ticket.admitted_at - ticket.enqueued_at)
+
+    def expire_abandoned(self):
+        """
+        Drop tickets whose users stopped polling (closed the page). Admitted tickets are also forgotten after the
+        same timeout
+
+        :return: list of dropped waiting tickets
+        """
+        now = time.monotonic()
+        dropped = [t for t in self._waiting.values() if now - t.last_seen > self.ticket_timeout_sec]
+        for t in dropped:
+            del self._waiting[t.id]
+        for t in [t for t in self._admitted.values() if now - t.last_seen > self.ticket_timeout_sec]:
+            del self._admitted[t.id]
+        QUEUE_DEPTH.set(len(self._waiting))
+        return dropped
+
+    def status(self, ticket):
+        """ Dictionary describing the ticket, sent to the waiting page """
+        return dict(ticket=ticket.id,
+                    user=ticket.user,
+                    position=self.position(ticket),
+                    waiting=len(self._waiting),
+                    eta_sec=self.eta_seconds(ticket),
+                    session=str(ticket.session_uuid) if ticket.session_uuid else None,
+                    error=ticket.error)